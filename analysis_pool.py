@@ -0,0 +1,228 @@
+import os
+import queue as queue_module
+import time
+import traceback
+from multiprocessing import Process, Queue, Semaphore
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from frame_ring import STOP, FrameRing
+
+'''
+Analysis pool: Introduction
+    Several worker processes take frames from one FrameRing and run the same
+    function on them; the parent gets the results back in frame order.
+
+        pool = AnalysisPool(ring, analyze, workers=4)
+        pool.start()
+        for sequence, timestamp, result in pool.results():
+            ...                         # sequence 0, 1, 2, ... in order
+        # elsewhere, once the producer is done: ring.stop(pool.workers)
+
+    function(frame, sequence, timestamp) runs in the worker on the
+    zero-copy view of the slot, and its result is pickled back, so it
+    should be small (particle tables, histograms), not the frame itself.
+    If function has a close() method, every worker calls it on exit.
+    Workers finish in any order; results() keeps the early ones in a
+    reorder buffer until the frames before them are done. Frames that
+    never reach a worker because a drop_oldest FrameGate overwrote them
+    are reported by the ring (track_reclaimed), and results() moves on
+    past their sequence numbers.
+
+    Backpressure: a worker needs one of max_in_flight tokens to take a
+    frame, and the token comes back only when results() has handed the
+    result on. A slow worker or a slow consumer of results() therefore
+    stalls the other workers, then the ring fills up and the producer
+    waits or drops frames, instead of the reorder buffer growing. Workers
+    wait for tokens and frames with a timeout and leave after
+    ring.stop(drain=False) even if results() is no longer read.
+
+    Per worker: frames handled, time busy in function, time blocked on
+    the token (backpressure) and utilization = busy / wall time.
+'''
+
+_FRAME = 'frame'
+_DONE = 'done'
+
+
+def _get(ring: FrameRing, timeout: float) -> int:
+    '''
+    Next filled slot, or STOP once the ring is aborted
+    '''
+    while True:
+        try:
+            return ring.get(timeout=timeout)
+        except queue_module.Empty:
+            if ring.aborted():
+                return STOP
+
+
+def _work(
+        ring: FrameRing,
+        function: Callable,
+        worker: int,
+        results: Queue,
+        tokens,
+        timeout: float
+):
+    '''
+    Worker process loop
+    '''
+    frames = 0
+    busy = blocked = 0.0
+    started = time.perf_counter()
+    while True:
+        start = time.perf_counter()
+        token = tokens.acquire(timeout=timeout)
+        while not token and not ring.aborted():
+            token = tokens.acquire(timeout=timeout)
+        blocked += time.perf_counter() - start
+        if not token:
+            break
+
+        index = _get(ring, timeout)
+        if index == STOP:
+            tokens.release()
+            break
+        sequence = ring.sequence(index)
+        timestamp = ring.timestamp(index)
+        result, skipped = None, True
+        try:
+            if not ring.aborted():
+                start = time.perf_counter()
+                result, skipped = function(ring.frame(index), sequence, timestamp), False
+                busy += time.perf_counter() - start
+                frames += 1
+        except Exception:
+            # the sequence is still reported, or the frames after it would
+            # wait in the reorder buffer forever
+            traceback.print_exc()
+        finally:
+            ring.release(index)
+        results.put((_FRAME, worker, sequence, timestamp, result, skipped))
+
+    # e.g. a writer that buffers frames
+    close = getattr(function, 'close', None)
+    if close is not None:
+        close()
+    wall = time.perf_counter() - started
+    results.put((_DONE, worker, {
+        'frames': frames,
+        'busy': busy,
+        'blocked': blocked,
+        'wall': wall,
+        'utilization': busy / wall if wall > 0 else 0.0,
+    }))
+
+
+class AnalysisPool:
+    '''
+    Worker processes on one FrameRing with ordered results
+    '''
+
+    def __init__(
+            self: 'AnalysisPool',
+            ring: FrameRing,
+            function: Callable[[Any, int, float], Any],
+            workers: Optional[int] = None,
+            max_in_flight: Optional[int] = None,
+            first_sequence: int = 0,
+            timeout: float = 0.5
+    ):
+        self.ring = ring
+        self.function = function
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        if self.max_in_flight < self.workers:
+            raise ValueError(f'max_in_flight ({self.max_in_flight}) must be at '
+                             f'least the number of workers ({self.workers})')
+        self.first_sequence = first_sequence
+        self.timeout = timeout
+
+        self.worker_stats: Dict[int, dict] = {}
+        self.reorder_peak = 0
+        self.skipped = 0
+        # sequences overwritten in the ring before a worker took them
+        self.reclaimed = 0
+        ring.track_reclaimed()
+        self._results: Queue = Queue()
+        self._tokens = Semaphore(self.max_in_flight)
+        self._processes: List[Process] = []
+
+    def start(self: 'AnalysisPool'):
+        for worker in range(self.workers):
+            process = Process(
+                target=_work,
+                args=(self.ring, self.function, worker, self._results,
+                      self._tokens, self.timeout)
+            )
+            process.start()
+            self._processes.append(process)
+
+    def results(self: 'AnalysisPool') -> Iterator[Tuple[int, float, Any]]:
+        '''
+        Yield (sequence, timestamp, result) in sequence order until every
+            worker got its STOP. Frames skipped after stop(drain=False),
+            failed in function or reclaimed by the producer are left out.
+        '''
+        pending: Dict[int, tuple] = {}
+        missing: Set[int] = set()
+        next_sequence = self.first_sequence
+        running = set(range(self.workers))
+        while running:
+            # the notice of a reclaimed frame can come after the results
+            # behind it, then it is polled for quickly
+            timeout = 0.01 if pending else self.timeout
+            try:
+                message = self._results.get(timeout=timeout)
+            except queue_module.Empty:
+                # a worker killed from outside never reports done
+                running -= {worker for worker in running
+                            if not self._processes[worker].is_alive()}
+                message = None
+            if message is not None and message[0] == _DONE:
+                _, worker, stats = message
+                self.worker_stats[worker] = stats
+                running.discard(worker)
+            elif message is not None:
+                _, worker, sequence, timestamp, result, skipped = message
+                pending[sequence] = (timestamp, result, skipped)
+                self.reorder_peak = max(self.reorder_peak, len(pending))
+
+            missing.update(sequence for sequence in self.ring.reclaimed()
+                           if sequence >= next_sequence)
+            while next_sequence in pending or next_sequence in missing:
+                if next_sequence in missing:
+                    # never taken by a worker, so it holds no token
+                    missing.discard(next_sequence)
+                    self.reclaimed += 1
+                else:
+                    timestamp, result, skipped = pending.pop(next_sequence)
+                    self._tokens.release()
+                    if skipped:
+                        self.skipped += 1
+                    else:
+                        yield next_sequence, timestamp, result
+                next_sequence += 1
+
+        missing.update(sequence for sequence in self.ring.reclaimed()
+                       if sequence >= next_sequence)
+        self.reclaimed += len(missing)
+        # sequences missing for good (e.g. a dead worker), the rest in order
+        for sequence in sorted(pending):
+            timestamp, result, skipped = pending.pop(sequence)
+            if skipped:
+                self.skipped += 1
+            else:
+                yield sequence, timestamp, result
+
+    def join(self: 'AnalysisPool'):
+        for process in self._processes:
+            process.join()
+        self._processes = []
+
+    def stats(self: 'AnalysisPool') -> Dict[int, dict]:
+        '''
+        Per-worker frames, busy, blocked and wall seconds and utilization,
+            available once results() is exhausted
+        '''
+        return dict(sorted(self.worker_stats.items()))
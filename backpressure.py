@@ -0,0 +1,144 @@
+import time
+from multiprocessing import Array
+from typing import Dict, Optional
+
+from frame_ring import FrameRing
+
+'''
+Backpressure: Introduction
+    The FrameRing caps memory at `slots` frames; FrameGate decides what
+    happens to a new frame when the consumers have not freed a slot yet:
+
+        block        - wait for a slot, nothing is dropped; the camera's own
+                       buffer handling (NewestOnly) drops frames instead
+        drop_newest  - wait up to timeout (none by default: the acquisition
+                       loop must not stall), then drop the new frame
+        drop_oldest  - overwrite the oldest frame still waiting in the ring,
+                       consumers always get the freshest frames
+        adaptive     - admit only every k-th frame; k doubles each time the
+                       ring is full and goes back down by one after
+                       recover_after admitted frames in a row found a slot
+
+    Every frame that does not reach a consumer is counted with its reason.
+    The counters live in shared memory, so the parent can read them while
+    the producer process runs:
+
+        gate = FrameGate(ring, 'drop_oldest')
+        index = gate.acquire()          # producer, instead of ring.acquire
+        if index is not None: ... ring.commit(index)
+        gate.counts()                   # {'offered': ..., 'dropped_newest': ...}
+'''
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+ADAPTIVE = 'adaptive'
+
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST, ADAPTIVE)
+
+COUNTERS = (
+    'offered',          # frames from the camera
+    'admitted',         # frames given a ring slot
+    'dropped_newest',   # new frame dropped, no free slot in time
+    'dropped_oldest',   # waiting frame overwritten by a newer one
+    'decimated',        # skipped by adaptive decimation
+    'blocked_us',       # time spent waiting for a slot, microseconds
+    'decimation',       # current k of the adaptive policy
+)
+
+
+class FrameGate:
+    '''
+    Producer-side admission of frames into a FrameRing under a drop policy
+    '''
+
+    def __init__(
+            self: 'FrameGate',
+            ring: FrameRing,
+            policy: str = DROP_NEWEST,
+            timeout: float = 0.0,
+            max_decimation: int = 16,
+            recover_after: int = 30
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown drop policy {policy}, expected one of {POLICIES}')
+        self.ring = ring
+        self.policy = policy
+        self.timeout = timeout
+        self.max_decimation = max_decimation
+        self.recover_after = recover_after
+        # one writer (the producer), readers only look
+        self._counters = Array('q', len(COUNTERS), lock=False)
+        self._counters[COUNTERS.index('decimation')] = 1
+        self._phase = 0
+        self._streak = 0
+
+    def _add(self: 'FrameGate', counter: str, value: int = 1):
+        self._counters[COUNTERS.index(counter)] += value
+
+    def _add_blocked(self: 'FrameGate', start: float):
+        # in microseconds, so that sub-millisecond waits add up too
+        self._add('blocked_us', round((time.perf_counter() - start) * 1e6))
+
+    def acquire(self: 'FrameGate') -> Optional[int]:
+        '''
+        Slot for the next camera frame, or None if the frame is dropped
+        '''
+        self._add('offered')
+        if self.policy == ADAPTIVE:
+            index = self._acquire_adaptive()
+        elif self.policy == BLOCK:
+            start = time.perf_counter()
+            index = self.ring.acquire(timeout=None)
+            self._add_blocked(start)
+        elif self.policy == DROP_OLDEST:
+            index = self.ring.acquire(timeout=0)
+            if index is None:
+                index = self.ring.reclaim()
+                if index is not None:
+                    self._add('dropped_oldest')
+                else:
+                    # every slot is being read by a consumer right now
+                    index = self._wait(self.timeout)
+        else:
+            index = self._wait(self.timeout)
+        if index is not None:
+            self._add('admitted')
+        return index
+
+    def _wait(self: 'FrameGate', timeout: float) -> Optional[int]:
+        start = time.perf_counter()
+        index = self.ring.acquire(timeout=timeout)
+        self._add_blocked(start)
+        if index is None:
+            self._add('dropped_newest')
+        return index
+
+    def _acquire_adaptive(self: 'FrameGate') -> Optional[int]:
+        decimation = self._counters[COUNTERS.index('decimation')]
+        self._phase = (self._phase + 1) % decimation
+        if self._phase:
+            self._add('decimated')
+            return None
+        index = self.ring.acquire(timeout=0)
+        if index is None:
+            self._add('dropped_newest')
+            decimation = min(decimation * 2, self.max_decimation)
+            self._streak = 0
+        else:
+            self._streak += 1
+            if self._streak >= self.recover_after and decimation > 1:
+                decimation -= 1
+                self._streak = 0
+        self._counters[COUNTERS.index('decimation')] = decimation
+        return index
+
+    def counts(self: 'FrameGate') -> Dict[str, int]:
+        return dict(zip(COUNTERS, self._counters[:]))
+
+    def dropped(self: 'FrameGate') -> int:
+        '''
+        Frames that did not reach a consumer, all reasons together
+        '''
+        counts = self.counts()
+        return counts['dropped_newest'] + counts['dropped_oldest'] + counts['decimated']
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from backpressure import BLOCK, DROP_NEWEST, POLICIES
+from camera_class import Camera
+from decimation import FIXED, MODES, SourceDecimator
+from frame_timing import STAGES
+from sensor_region import SensorGeometry
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+'''
+Benchmark: Introduction
+    Runs Camera(simulated=True) on synthetic frames, no camera needed: the
+    acquisition process, the saver process and everything between them are
+    the ones a real run uses - source decimation, the drop policy of the
+    FrameGate, the exposure loop, the analysis and the writer. The run stops
+    after the requested number of frames from the simulated camera.
+    Reported per run:
+
+        frames/s received and saved, frames dropped by the drop policy and
+            why, frames skipped by the decimator
+        latency percentiles of each stage, from the saver's PipelineStats:
+            copy      - received -> copied into the ring, waiting for a
+                        free slot included
+            queue     - committed -> dequeued by the saver
+            process   - conversion and analysis (with --analyze)
+            write     - writer
+            total     - received -> done
+        peak RSS of this process and of the largest child
+
+    python benchmark.py --width 1936 --height 1464 --pixel-format BGR8 --fps 30
+    python benchmark.py --frames 300 --writer npy --min-fps 25   # CI gate
+    python benchmark.py --analyze                                # with sizing
+'''
+
+
+def peak_rss_mb(children: bool = False) -> Optional[float]:
+    '''
+    Peak RSS of this process, or of the largest child that has ended
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_benchmark(
+        width: int = 1936,
+        height: int = 1464,
+        pixel_format: Optional[str] = 'BGR8',
+        fps: float = 0.0,
+        frames: int = 200,
+        slots: int = 8,
+        every_nth: int = 1,
+        decimation: str = FIXED,
+        target_rate: Optional[float] = None,
+        writer_kind: str = 'npy',
+        writer_options: Optional[dict] = None,
+        analyze: bool = False,
+        policy: Optional[str] = None
+) -> dict:
+    directory = tempfile.mkdtemp(prefix='benchmark_')
+    # a paced source behaves like the camera: a full ring drops the frame,
+    # an unpaced one measures the pipeline capacity and waits for a slot
+    if policy is None:
+        policy = DROP_NEWEST if fps > 0 else BLOCK
+
+    camera = Camera(simulated=True)
+    camera.simulation_options = {
+        'sensor_width': width, 'sensor_height': height, 'fps': fps}
+    camera.sensor = SensorGeometry(width, height)
+    camera.pixel_format = pixel_format
+    camera.decimator = SourceDecimator(
+        decimation, every_nth=every_nth, target_rate=target_rate)
+    camera.ring_slots = slots
+    camera.drop_policy = policy
+    camera.analyze_frames = analyze
+    camera.writer_kind = writer_kind
+    camera.writer_options = writer_options or {}
+    camera.images_directory = os.path.join(directory, 'images')
+    camera.distribution_path = os.path.join(directory, 'distribution.json')
+    camera.preview_enabled = False
+    camera.timing = True
+    camera.stats_path = os.path.join(directory, 'stats.json')
+    # only the final snapshot, written when the saver ends
+    camera.stats_interval = float('inf')
+
+    # the counters are shared with the acquisition process; the first
+    # frame starts the clock, so opening the device is not measured
+    times = {}
+
+    def stop_after_frames():
+        while not camera.stop_event.is_set():
+            received = camera.metrics.get('frames_received_total')
+            if received and 'first' not in times:
+                times['first'] = time.perf_counter()
+            if received >= frames:
+                times['stopped'] = time.perf_counter()
+                camera.stop_event.set()
+            time.sleep(0.001)
+
+    watcher = threading.Thread(target=stop_after_frames, daemon=True)
+    watcher.start()
+    try:
+        camera.start_camera()
+        finished = time.perf_counter()
+        camera.stop_event.set()
+        watcher.join()
+        with open(camera.stats_path) as stats_file:
+            stats = json.load(stats_file)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    metrics = camera.metrics.values()
+    counters = stats['counters']
+    first = times.get('first', finished)
+    received = metrics['frames_received_total']
+    written = metrics['frames_written_total']
+    return {
+        'config': {
+            'width': width, 'height': height,
+            'pixel_format': pixel_format or 'negotiated',
+            'fps': fps, 'frames': frames, 'slots': slots,
+            'decimation': decimation, 'every_nth': every_nth,
+            'writer': writer_kind, 'analyze': analyze, 'policy': policy,
+        },
+        'received_fps': received / max(times.get('stopped', finished) - first, 1e-9),
+        'saved_fps': written / max(finished - first, 1e-9),
+        'dropped': counters['dropped_newest'] + counters['dropped_oldest'],
+        'frames_by_reason': {
+            # frames the decimator skipped never reach the gate
+            'skipped_at_source': int(received - metrics['frames_incomplete_total']
+                                     - counters['offered']),
+            **{reason: counters[reason] for reason in
+               ('admitted', 'dropped_newest', 'dropped_oldest', 'decimated')}},
+        'blocked_ms': counters['blocked_us'] / 1000.0,
+        'received': int(received),
+        'incomplete': int(metrics['frames_incomplete_total']),
+        'consumed': int(metrics['frames_processed_total']),
+        'saved': int(written),
+        'latency_ms': {stage: stats['stages'][stage] for stage in STAGES},
+        'peak_rss_mb': {
+            'parent': peak_rss_mb(),
+            'child': peak_rss_mb(children=True),
+        },
+    }
+
+
+def print_report(report: dict):
+    config = report['config']
+    print(f'{config["width"]}x{config["height"]} {config["pixel_format"]}, '
+          f'fps {config["fps"] or "unpaced"}, {config["frames"]} frames, '
+          f'{config["slots"]} slots, writer {config["writer"]}, '
+          f'{config["decimation"]} every {config["every_nth"]}, '
+          f'policy {config["policy"]}')
+    print(f'received {report["received_fps"]:.1f} frames/s, '
+          f'saved {report["saved_fps"]:.1f} frames/s, '
+          f'dropped {report["dropped"]}, '
+          f'blocked {report["blocked_ms"]:.1f} ms')
+    print('  ' + ', '.join(f'{reason} {count}' for reason, count
+                           in report['frames_by_reason'].items()))
+    columns = ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')
+    print(f'{"stage":<10}{"count":>10}' + ''.join(f'{name:>10}' for name in columns))
+    for stage, summary in report['latency_ms'].items():
+        if summary['count']:
+            print(f'{stage:<10}{summary["count"]:>10}' + ''.join(
+                f'{summary[name]:>10.3f}' for name in columns))
+    rss = report['peak_rss_mb']
+    if rss['parent'] is not None:
+        print(f'peak RSS: parent {rss["parent"]:.0f} MB, '
+              f'largest child {rss["child"]:.0f} MB')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Camera pipeline benchmark on a simulated camera')
+    parser.add_argument('--width', type=int, default=1936)
+    parser.add_argument('--height', type=int, default=1464)
+    parser.add_argument('--pixel-format', default='BGR8',
+                        help='camera pixel format, "auto" negotiates it like Camera')
+    parser.add_argument('--fps', type=float, default=0.0,
+                        help='camera frame rate, 0 runs as fast as possible')
+    parser.add_argument('--frames', type=int, default=200,
+                        help='frames to take from the camera')
+    parser.add_argument('--slots', type=int, default=8)
+    parser.add_argument('--decimation', choices=MODES, default=FIXED)
+    parser.add_argument('--every-nth', type=int, default=1)
+    parser.add_argument('--target-rate', type=float,
+                        help='saved frames per second for target_rate decimation')
+    parser.add_argument('--writer', default='npy')
+    parser.add_argument('--policy', choices=POLICIES,
+                        help='drop policy, default drop_newest when paced, '
+                             'block when unpaced')
+    parser.add_argument('--analyze', action='store_true',
+                        help='run the granulometry analysis on every frame')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--min-fps', type=float,
+                        help='exit with status 1 if fewer frames/s are saved')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_benchmark(
+        width=args.width, height=args.height,
+        pixel_format=None if args.pixel_format == 'auto' else args.pixel_format,
+        fps=args.fps, frames=args.frames, slots=args.slots,
+        every_nth=args.every_nth, decimation=args.decimation,
+        target_rate=args.target_rate, writer_kind=args.writer,
+        analyze=args.analyze, policy=args.policy)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.min_fps is not None and report['saved_fps'] < args.min_fps:
+        print(f'FAILED: saved {report["saved_fps"]:.1f} frames/s < {args.min_fps}')
+        sys.exit(1)
@@ -0,0 +1,283 @@
+import ctypes
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+'''
+Buffer adapter: Introduction
+    The examples copy every Arena buffer with BufferFactory.copy, build a new
+    (ctypes.c_ubyte * num_channels * w * h) type per frame and then copy the
+    NumPy array once more before queueing it. BufferAdapter instead maps the
+    device buffer memory straight to a NumPy view (shape and dtype are worked
+    out once per pixel format and resolution and cached) and copies it at
+    most once, directly into a destination array such as a FrameRing slot.
+
+        buffer = device.get_buffer()
+        frame = adapter.view(buffer)           # no copy, valid until requeue
+        adapter.copy_into(buffer, ring.frame(index))
+        device.requeue_buffer(buffer)
+
+    Packed formats (Mono10p, Mono12p, Mono12Packed) cannot be viewed pixel
+    by pixel: view() unpacks them into a uint16 array kept by the adapter
+    (overwritten by the next view() of that format and size). Pass that
+    array to copy_into(buffer, dst, frame=...) and the buffer is not
+    unpacked a second time, the copy into the ring is a plain copy:
+
+        frame = adapter.view(buffer)           # unpacked once
+        adapter.copy_into(buffer, ring.frame(index), frame=frame)
+
+    negotiate_pixel_format() picks what to ask the camera for: when only
+    luminance is needed a Mono format is a third of the BGR8 bandwidth on
+    the link, in every copy and in the ring. A colour camera that offers
+    no Mono format is still read in colour, copy_into() then converts to
+    grey on the way into a single-channel destination.
+'''
+
+
+def unpack_mono10p(raw: np.ndarray, out: np.ndarray):
+    # 4 pixels in 5 bytes, LSB first
+    b = raw.reshape(-1, 5).astype(np.uint16)
+    p = out.reshape(-1, 4)
+    p[:, 0] = b[:, 0] | ((b[:, 1] & 0x03) << 8)
+    p[:, 1] = (b[:, 1] >> 2) | ((b[:, 2] & 0x0F) << 6)
+    p[:, 2] = (b[:, 2] >> 4) | ((b[:, 3] & 0x3F) << 4)
+    p[:, 3] = (b[:, 3] >> 6) | (b[:, 4] << 2)
+
+
+def unpack_mono12p(raw: np.ndarray, out: np.ndarray):
+    # 2 pixels in 3 bytes, LSB first (GenICam Mono12p)
+    b = raw.reshape(-1, 3).astype(np.uint16)
+    p = out.reshape(-1, 2)
+    p[:, 0] = b[:, 0] | ((b[:, 1] & 0x0F) << 8)
+    p[:, 1] = (b[:, 1] >> 4) | (b[:, 2] << 4)
+
+
+def unpack_mono12packed(raw: np.ndarray, out: np.ndarray):
+    # 2 pixels in 3 bytes, MSB in the outer bytes (GigE Vision Mono12Packed)
+    b = raw.reshape(-1, 3).astype(np.uint16)
+    p = out.reshape(-1, 2)
+    p[:, 0] = (b[:, 0] << 4) | (b[:, 1] & 0x0F)
+    p[:, 1] = (b[:, 2] << 4) | (b[:, 1] >> 4)
+
+
+class PixelFormatInfo(NamedTuple):
+    dtype: type
+    channels: int
+    bits_per_pixel: int
+    unpack: Optional[Callable[[np.ndarray, np.ndarray], None]] = None
+
+
+PIXEL_FORMATS: Dict[str, PixelFormatInfo] = {
+    'Mono8': PixelFormatInfo(np.uint8, 1, 8),
+    'Mono10': PixelFormatInfo(np.uint16, 1, 16),
+    'Mono12': PixelFormatInfo(np.uint16, 1, 16),
+    'Mono16': PixelFormatInfo(np.uint16, 1, 16),
+    'Mono10p': PixelFormatInfo(np.uint16, 1, 10, unpack_mono10p),
+    'Mono12p': PixelFormatInfo(np.uint16, 1, 12, unpack_mono12p),
+    'Mono12Packed': PixelFormatInfo(np.uint16, 1, 12, unpack_mono12packed),
+    'BayerRG8': PixelFormatInfo(np.uint8, 1, 8),
+    'BayerGR8': PixelFormatInfo(np.uint8, 1, 8),
+    'BayerGB8': PixelFormatInfo(np.uint8, 1, 8),
+    'BayerBG8': PixelFormatInfo(np.uint8, 1, 8),
+    'BGR8': PixelFormatInfo(np.uint8, 3, 24),
+    'RGB8': PixelFormatInfo(np.uint8, 3, 24),
+    'BGRa8': PixelFormatInfo(np.uint8, 4, 32),
+    'RGBa8': PixelFormatInfo(np.uint8, 4, 32),
+    'Coord3D_C16': PixelFormatInfo(np.uint16, 1, 16),
+    'Coord3D_ABCY16': PixelFormatInfo(np.uint16, 4, 64),
+    'Coord3D_ABCY16s': PixelFormatInfo(np.int16, 4, 64),
+}
+
+
+# significant bits per sample, the values of the unpacked frame go up to
+# 2 ** bits - 1
+SAMPLE_BITS: Dict[str, int] = {
+    'Mono8': 8, 'Mono10': 10, 'Mono10p': 10, 'Mono12': 12, 'Mono12p': 12,
+    'Mono12Packed': 12, 'Mono16': 16,
+    'BGR8': 8, 'RGB8': 8, 'BGRa8': 8, 'RGBa8': 8,
+}
+
+COLOR_FORMATS = ('BGR8', 'RGB8', 'BGRa8', 'RGBa8')
+
+_TO_GRAY = {
+    'BGR8': cv2.COLOR_BGR2GRAY,
+    'RGB8': cv2.COLOR_RGB2GRAY,
+    'BGRa8': cv2.COLOR_BGRA2GRAY,
+    'RGBa8': cv2.COLOR_RGBA2GRAY,
+}
+
+
+def full_scale(pixel_format) -> int:
+    '''
+    Largest sample value of the format, e.g. 4095 for Mono12
+    '''
+    return (1 << SAMPLE_BITS.get(pixel_format_name(pixel_format), 8)) - 1
+
+
+def negotiate_pixel_format(
+        available: Optional[Iterable[str]] = None,
+        color: bool = False,
+        bit_depth: int = 8,
+        prefer_packed: bool = False
+) -> str:
+    '''
+    Cheapest format the camera offers (available, e.g. the enumentry_names
+        of the PixelFormat node) that still carries what downstream needs:
+        colour, or luminance with at least bit_depth bits. Packed formats
+        save link bandwidth but cost an unpack pass on the host, they are
+        only preferred with prefer_packed. A camera that offers colour
+        formats only is read in colour and converted to 8-bit grey, so it
+        cannot serve bit_depth > 8.
+    '''
+    offered = [name for name in (PIXEL_FORMATS if available is None else available)
+               if name in PIXEL_FORMATS and name in SAMPLE_BITS]
+    if not color:
+        mono = [name for name in offered if name not in COLOR_FORMATS]
+        deep_enough = [name for name in mono if SAMPLE_BITS[name] >= bit_depth]
+        if deep_enough:
+            def cost(name):
+                info = PIXEL_FORMATS[name]
+                packed = info.unpack is not None
+                # bits per pixel on the link, or in host memory once unpacked
+                bits = info.bits_per_pixel if prefer_packed \
+                    else np.dtype(info.dtype).itemsize * 8
+                return bits, packed, SAMPLE_BITS[name]
+            return min(deep_enough, key=cost)
+        if mono:
+            return max(mono, key=lambda name: SAMPLE_BITS[name])
+        if bit_depth > 8:
+            raise ValueError(f'No Mono pixel format offered, colour formats '
+                             f'carry 8 bits, not {bit_depth}: {available}')
+    for name in COLOR_FORMATS:
+        if name in offered:
+            return name
+    raise ValueError(f'None of the offered pixel formats is supported: {available}')
+
+
+class FrameLayout(NamedTuple):
+    shape: Tuple[int, ...]
+    dtype: np.dtype
+    nbytes: int
+    raw_type: type
+    unpack: Optional[Callable[[np.ndarray, np.ndarray], None]]
+
+
+def pixel_format_name(pixel_format) -> str:
+    '''
+    Accepts a PixelFormat enum member or its name
+    '''
+    return getattr(pixel_format, 'name', pixel_format)
+
+
+class BufferAdapter:
+    '''
+    Maps Arena buffers to NumPy arrays, caching the layout per pixel format
+        and resolution
+    '''
+
+    def __init__(self: 'BufferAdapter'):
+        self._layouts: Dict[Tuple[str, int, int], FrameLayout] = {}
+        # unpacked frame of each packed format and resolution, reused
+        self._unpacked: Dict[Tuple[str, int, int], np.ndarray] = {}
+
+    def __getstate__(self: 'BufferAdapter'):
+        # cached ctypes array types cannot be pickled, they are rebuilt on
+        # first use in the other process
+        return {'_layouts': {}, '_unpacked': {}}
+
+    def layout(
+            self: 'BufferAdapter',
+            pixel_format,
+            width: int,
+            height: int
+    ) -> FrameLayout:
+        key = (pixel_format_name(pixel_format), width, height)
+        layout = self._layouts.get(key)
+        if layout is None:
+            try:
+                info = PIXEL_FORMATS[key[0]]
+            except KeyError:
+                raise ValueError(f'Pixel format {key[0]} is not supported') from None
+            if info.channels == 1:
+                shape = (height, width)
+            else:
+                shape = (height, width, info.channels)
+            nbytes = width * height * info.bits_per_pixel // 8
+            layout = FrameLayout(shape, np.dtype(info.dtype), nbytes,
+                                 ctypes.c_ubyte * nbytes, info.unpack)
+            self._layouts[key] = layout
+        return layout
+
+    def frame_spec(
+            self: 'BufferAdapter',
+            pixel_format,
+            width: int,
+            height: int
+    ) -> Tuple[Tuple[int, ...], np.dtype]:
+        '''
+        Shape and dtype of the unpacked frame, e.g. to size a FrameRing
+        '''
+        layout = self.layout(pixel_format, width, height)
+        return layout.shape, layout.dtype
+
+    def raw(self: 'BufferAdapter', buffer) -> np.ndarray:
+        '''
+        Zero-copy uint8 view of the buffer payload
+        '''
+        layout = self.layout(buffer.pixel_format, buffer.width, buffer.height)
+        address = ctypes.cast(buffer.pdata, ctypes.c_void_p).value
+        return np.frombuffer(layout.raw_type.from_address(address), dtype=np.uint8)
+
+    def view(self: 'BufferAdapter', buffer) -> np.ndarray:
+        '''
+        Zero-copy NumPy view of the buffer, valid until the buffer is
+            requeued or destroyed. Packed formats are unpacked instead, into
+            an array that the next view() of the same format and size
+            overwrites.
+        '''
+        layout = self.layout(buffer.pixel_format, buffer.width, buffer.height)
+        raw = self.raw(buffer)
+        if layout.unpack is not None:
+            key = (pixel_format_name(buffer.pixel_format), buffer.width, buffer.height)
+            out = self._unpacked.get(key)
+            if out is None:
+                out = self._unpacked[key] = np.empty(layout.shape, dtype=layout.dtype)
+            layout.unpack(raw, out)
+            return out
+        return raw.view(layout.dtype).reshape(layout.shape)
+
+    def copy_into(
+            self: 'BufferAdapter',
+            buffer,
+            dst: np.ndarray,
+            frame: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        '''
+        Copy (or unpack) the buffer into dst with a single pass and return
+            dst. dst must have the shape from frame_spec() and a dtype that
+            holds its values (Mono8 into uint16 is fine), or be a uint8
+            (height, width) array for a colour buffer, which is then
+            converted to grey. frame is what view() returned for this
+            buffer, if it was called; it is copied from instead of reading
+            (and unpacking) the buffer again.
+        '''
+        layout = self.layout(buffer.pixel_format, buffer.width, buffer.height)
+        name = pixel_format_name(buffer.pixel_format)
+        if name in _TO_GRAY and dst.shape == layout.shape[:2] and dst.dtype == np.uint8:
+            cv2.cvtColor(self.view(buffer) if frame is None else frame,
+                         _TO_GRAY[name], dst=dst)
+            return dst
+        if dst.shape != layout.shape or not np.can_cast(layout.dtype, dst.dtype):
+            raise ValueError(
+                f'Destination {dst.shape} {dst.dtype} does not match frame '
+                f'{layout.shape} {layout.dtype}')
+        if frame is not None:
+            np.copyto(dst, frame)
+            return dst
+        raw = self.raw(buffer)
+        if layout.unpack is not None:
+            layout.unpack(raw, dst)
+        else:
+            np.copyto(dst, raw.view(layout.dtype).reshape(layout.shape))
+        return dst
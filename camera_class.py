@@ -1,65 +1,240 @@
-from arena_api.system import system
-from arena_api.buffer import *
+try:
+    from arena_api.system import system as arena_system
+except ImportError:
+    # без Arena SDK работает только симуляция (simulated = True)
+    arena_system = None
 
-import ctypes
 import numpy as np
 import cv2
+import sys
 import time
-from datetime import datetime, timedelta
-from multiprocessing import Queue, Process
-from typing import List, Any
+from multiprocessing import Event, Process, Value
+from typing import Optional
+
+from backpressure import DROP_NEWEST, FrameGate
+from brightness import BrightnessMeter
+from buffer_adapter import (
+    COLOR_FORMATS, PIXEL_FORMATS, BufferAdapter, full_scale, negotiate_pixel_format)
+from decimation import FIXED, SAVE, SourceDecimator
+from exposure_control import ExposureController
+from frame_ring import FrameRing
+from frame_timing import PipelineStats
+from granulometry import FrameAnalysis, GranulometryAnalyzer
+from latest_frame import LatestFrame, StampedFrame
+from metrics import MetricsExporter, SharedMetrics
+from preview import Preview
+from size_distribution import SizeDistribution
+from sensor_region import SensorGeometry, SensorRegion, apply_region, plan_region
+from simulated_camera import SimulatedSystem
+from writers import create_writer
 
 
 class Camera:
     def __init__(
         
-            self: 'Camera'
+            self: 'Camera',
+            simulated: bool = False
     ):
+        # simulated = True - вместо камеры синтетические кадры или запись,
+        # см. simulated_camera.SimulatedDevice; параметры устройства -
+        # в simulation_options (fps, replay, reference_exposure, ...)
+        self.simulated = simulated
+        self.simulation_options = {}
+        self._system = None
         self.frame_count = 0
-        self.frames: List[Any] = []
+        # сколько последних кадров хранить помимо самого свежего; слот
+        # в общей памяти создаётся в start_camera
+        self.frame_history = 0
+        self.frames: Optional[LatestFrame] = None
+        self._last_sequence = -1
+        # какие кадры сохранять, решается до копирования из буфера камеры:
+        # fixed - каждый every_nth, target_rate - кадров в секунду,
+        # adaptive - по очереди кадров, ждущих записи (decimation.py);
+        # нагрузка от гранулометрии на неё не влияет
         self.every_nth = 5
+        self.decimator = SourceDecimator(FIXED, every_nth=self.every_nth)
+        # формат сохранения кадров, см. writers.WRITERS
+        self.writer_kind = 'archive'
+        self.writer_options = {}
+        self.images_directory = 'images'
+        # гранулометрия каждого кадра в процессе сохранения;
+        # pixel_size - мм на пиксель, размеры частиц в мм
+        self.analyze_frames = True
+        self.analyzer = GranulometryAnalyzer(min_area=10, pixel_size=1.0)
+        # максимум отсчёта выбранного формата (4095 для Mono12): кадры
+        # глубже 8 бит приводятся к 0..255 одним масштабом для всех кадров;
+        # формат выбирается в процессе захвата, анализ идёт в процессе
+        # сохранения
+        self._full_scale = Value('q', 255, lock=False)
+        # распределение размеров за последние 10 с, 1 мин и 1 ч; снимок
+        # для панели оператора пишется в distribution_path раз в
+        # distribution_interval секунд
+        self.distribution = SizeDistribution(
+            windows=(10.0, 60.0, 3600.0), mode='sketch', weight='count')
+        self.distribution_path = 'distribution.json'
+        self.distribution_interval = 1.0
+        self._distribution_written = 0.0
         self.exposure_time = 20000.0
         self.threshold = 127
-        # self.queue_frame
+        # яркость для подстройки экспозиции считается по прореженному кадру
+        self.meter = BrightnessMeter(mode='strided', step=8)
+        # gain_max > 0 разрешает добавлять усиление, когда экспозиции не хватает
+        self.gain_max = 0.0
+        self.exposure = ExposureController(
+            target=self.threshold, tolerance=5, gain_max=self.gain_max)
+        # передаётся только измеряемая область ленты: roi (x, y, ширина,
+        # высота) в пикселях сенсора, None - весь сенсор; target_resolution
+        # (ширина, высота) - минимум для анализа, остальное снимает биннинг
+        self.sensor = SensorGeometry(1936, 1464)
+        self.roi = None
+        self.target_resolution = None
+        self.binning_mode = 'Average'
+        # 'max' - jumbo-кадры, сетевая карта должна их поддерживать
+        self.packet_size = 'max'
+        self.region: Optional[SensorRegion] = None
+        # None - формат выбирается по тому, что нужно дальше: для яркости
+        # Mono8 (втрое меньше BGR8 по сети, в копиях и в кольцевом буфере),
+        # bit_depth > 8 - Mono10/12/16, needs_color - BGR8
+        self.pixel_format = None
+        # формат, выбранный в start_camera по списку форматов камеры, - по
+        # нему же рассчитан кольцевой буфер
+        self._negotiated_format: Optional[str] = None
+        self.needs_color = False
+        self.bit_depth = 8
+        self.num_channels = 1
+        # яркость для подстройки экспозиции в шкале 0..255 при любом формате
+        self.brightness_scale = 1.0
+        self.adapter = BufferAdapter()
+        # число кадров в кольцевом буфере в общей памяти
+        self.ring_slots = 8
+        self.ring_timeout = 0.5
+        # что делать с новым кадром, если все слоты заняты:
+        # block, drop_newest, drop_oldest или adaptive (см. backpressure.py);
+        # drop_timeout - сколько ждать свободного слота, прежде чем отбросить
+        # кадр: 0 - не ждать, цикл захвата не должен простаивать
+        self.drop_policy = DROP_NEWEST
+        self.drop_timeout = 0.0
+        # при остановке дописать на диск кадры, оставшиеся в буфере
+        self.drain_on_exit = True
+        # окно предпросмотра работает в отдельном процессе и не тормозит
+        # захват; для работы без монитора preview_enabled = False
+        self.preview_enabled = True
+        self.preview_fps = 15.0
+        self.preview_scale = 4
+        # метки времени каждого кадра (frame_timing.py): задержки по этапам
+        # и пропускная способность раз в stats_interval секунд в лог и в
+        # stats_path
+        self.timing = True
+        self.stats_path = 'pipeline_stats.json'
+        self.stats_interval = 10.0
+        # счётчики для мониторинга в формате Prometheus (metrics.py):
+        # metrics_port - HTTP на 127.0.0.1:port/metrics, metrics_path - файл
+        # для textfile collector, None - не публиковать
+        self.metrics = SharedMetrics()
+        self.metrics_port = None
+        self.metrics_path = None
+        self.metrics_interval = 5.0
+        # сигнал остановки захвата (Esc в окне предпросмотра)
+        self.stop_event = Event()
 
     def get_current_frame(
-            self: 'Camera'
-    ):
-        current_time = datetime.now() + timedelta(seconds=0.1)
-        while True:
-            while len(self.frames) == 0:
-                time.sleep(0.01)
-            frame = self.frames.pop(0)
-            if current_time < datetime.now():
-                while len(self.frames) == 0:
-                    time.sleep(0.01)
-                frame = self.frames.pop(0)
-                return frame
+            self: 'Camera',
+            timeout: Optional[float] = 0.1
+    ) -> Optional[StampedFrame]:
+        '''
+        Wait up to timeout for a frame newer than the one returned last time,
+            from another thread while start_camera runs. Returns None on
+            timeout or before the camera is started; the result's age tells
+            how old it is.
+        '''
+        if self.frames is None:
+            return None
+        current = self.frames.get(timeout=timeout, after=self._last_sequence)
+        if current is not None:
+            self._last_sequence = current.sequence
+        return current
+
+    def get_system(self: 'Camera'):
+        '''
+        arena_api system or a SimulatedSystem, created in the process that
+            opens the device
+        '''
+        if self._system is None:
+            if self.simulated:
+                self._system = SimulatedSystem(**self.simulation_options)
+            elif arena_system is None:
+                raise Exception('arena_api is not installed, use '
+                                'Camera(simulated=True) to run without a camera')
+            else:
+                self._system = arena_system
+        return self._system
     
+    def negotiate_format(self: 'Camera') -> str:
+        '''
+        Pixel format the camera will deliver: pixel_format, or the one
+            negotiated from the formats the camera offers. Opens the device
+            briefly in the calling process, so the ring can be sized before
+            the acquisition process starts.
+        '''
+        if self.pixel_format is not None:
+            return self.pixel_format
+        devices = self.create_devices_with_tries()
+        try:
+            offered = devices[0].nodemap.get_node('PixelFormat').enumentry_names
+        finally:
+            self.get_system().destroy_device()
+            # устройство снова откроет процесс захвата
+            self._system = None
+        return negotiate_pixel_format(
+            offered, color=self.needs_color, bit_depth=self.bit_depth)
+
+    def ring_format(self: 'Camera') -> str:
+        '''
+        Pixel format of the frames in the ring, after negotiate_format();
+            a colour camera read for luminance only is converted to Mono8 on
+            the copy into the ring
+        '''
+        if self.pixel_format is not None:
+            return self.pixel_format
+        if self._negotiated_format in COLOR_FORMATS and not self.needs_color:
+            return 'Mono8'
+        return self._negotiated_format
+
     def process_frame(self: 'Camera', image):
+        # Mono форматы уже в градациях серого, кадр не копируется
+        if image.ndim == 2:
+            return image
         processed_frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         return processed_frame
 
+    def handle_analysis(
+            self: 'Camera',
+            sequence: int,
+            timestamp: float,
+            analysis: FrameAnalysis
+    ):
+        '''
+        Called in the saver process for every analyzed frame
+        '''
+        self.distribution.add(analysis.particles['equivalent_diameter'], timestamp)
+        if timestamp - self._distribution_written >= self.distribution_interval:
+            self.distribution.write_json(self.distribution_path, timestamp)
+            self._distribution_written = timestamp
+
     def set_exposure_time(
             self: 'Camera',
             threshold,
             brightness, 
             nodes
-    ):  
-        if threshold - brightness > 5:
-            nodes['ExposureTime'].value += 200
-            print("ExposureTime:", nodes['ExposureTime'].value)
-            print("Average brightness:", brightness)
-
-        elif threshold - brightness < -5:
-            nodes['ExposureTime'].value -= 200
-            print("ExposureTime:", nodes['ExposureTime'].value)
-            print("Average brightness:", brightness)
-        
-        else:
-            pass 
+    ) -> bool:
+        '''
+        One step of the exposure loop: the controller jumps close to the
+            target using the measured brightness ratio, returns True if a
+            node was written
+        '''
+        self.exposure.target = threshold
+        return self.exposure.update(brightness, nodes)
 
-        
     def create_devices_with_tries(self:  'Camera'):
         '''
         This function waits for the user to connect a device before raising
@@ -70,7 +245,7 @@ class Camera:
         tries_max = 6
         sleep_time_secs = 10
         while tries < tries_max:  # Wait for device for 60 seconds
-            devices = system.create_device()
+            devices = self.get_system().create_device()
             if not devices:
                 print(
                     f'Try {tries+1} of {tries_max}: waiting for {sleep_time_secs} '
@@ -92,26 +267,40 @@ class Camera:
         nodemap = device.nodemap
         nodes = nodemap.get_node(['Width', 'Height', 'PixelFormat'])
 
-        nodes['Width'].value = 1936
-        nodes['Height'].value = 1464
-        nodes['PixelFormat'].value = 'BGR8'
+        # ROI и биннинг, кольцевой буфер уже рассчитан на self.region
+        applied = apply_region(nodemap, self.region, self.binning_mode, self.packet_size)
+        if (applied.width, applied.height) != (self.region.width, self.region.height):
+            raise Exception(f'Camera region {applied} differs from the planned '
+                            f'{self.region}, check Camera.sensor')
+        print(f'Region: {applied}')
+        pixel_format = self.pixel_format or self._negotiated_format
+        nodes['PixelFormat'].value = pixel_format
+        print(f'Pixel format: {pixel_format}')
+        self.brightness_scale = 255.0 / full_scale(pixel_format)
+        self._full_scale.value = full_scale(pixel_format)
+        self.num_channels = PIXEL_FORMATS[pixel_format].channels
         # в разрешении 1280х720 - максимальное время экспозиции ~25к
         # изображение/стрим в разрешении 1936х1464 сильно лагает
 
-        num_channels = 3
+        num_channels = self.num_channels
 
         # Stream nodemap
         tl_stream_nodemap = device.tl_stream_nodemap
 
         tl_stream_nodemap["StreamBufferHandlingMode"].value = "NewestOnly"
-        tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
+        # заданный вручную размер пакета не должен перезаписываться
+        tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = \
+            not isinstance(self.packet_size, int)
         tl_stream_nodemap['StreamPacketResendEnable'].value = True
 
         return num_channels, nodemap
     
     def store_initial(self, nodemap):
 
-        nodes = nodemap.get_node(['ExposureAuto', 'ExposureTime'])
+        names = ['ExposureAuto', 'ExposureTime']
+        if self.gain_max > 0:
+            names += ['GainAuto', 'Gain']
+        nodes = nodemap.get_node(names)
 
         exposure_auto_initial = nodes['ExposureAuto'].value
         exposure_time_initial = nodes['ExposureTime'].value
@@ -122,6 +311,8 @@ class Camera:
         
         print("Disable automatic exposure")
         nodes['ExposureAuto'].value = 'Off'
+        if 'GainAuto' in nodes:
+            nodes['GainAuto'].value = 'Off'
         
         print("Get exposure time node")
         if nodes['ExposureTime'] is None:
@@ -142,7 +333,12 @@ class Camera:
             
         print(f"Set expsoure time to {nodes['ExposureTime'].value}")
     
-    def get_images(self, queue):
+    def get_images(
+            self,
+            ring: FrameRing,
+            gate: FrameGate,
+            preview: Optional[Preview] = None
+    ):
 
         devices = self.create_devices_with_tries()
         device = devices[0]
@@ -150,52 +346,151 @@ class Camera:
         nodes = self.store_initial(nodemap)
         self.configure_exposure_acquire_images(nodes)   
         with device.start_stream():
-            while True:
-                        
+            while not self.stop_event.is_set():
                 buffer = device.get_buffer()
-                        
-                item = BufferFactory.copy(buffer)
+                received = time.perf_counter() if self.timing else np.nan
+                self.metrics.add('frames_received_total')
+                self.metrics.set('last_frame_timestamp_seconds', time.time())
+                # в неполном буфере (потеряны пакеты) часть кадра - мусор:
+                # он не сохраняется и не влияет на экспозицию
+                if buffer.is_incomplete:
+                    self.metrics.add('frames_incomplete_total')
+                    device.requeue_buffer(buffer)
+                    continue
+                # вид на память буфера без копирования, действителен до requeue;
+                # упакованные форматы (Mono10p/12p) распаковываются здесь один
+                # раз, copy_into дальше копирует уже распакованный кадр
+                npndarray = self.adapter.view(buffer)
+                brightness = self.meter.measure(npndarray) * self.brightness_scale
+                # время экспозиции, пока она подстраивается, выводится
+                # только в окне предпросмотра, в анализ и запись не попадает
+                if preview is not None:
+                    preview.offer(npndarray, text=None if self.exposure.converged
+                                  else str(nodes['ExposureTime'].value))
+                # кадр, который не будет сохранён, не копируется вовсе, если
+                # только он не нужен для гранулометрии
+                save = self.decimator.keep(
+                    npndarray, ring,
+                    written=int(self.metrics.get('frames_written_total')))
+                # единственная копия кадра - сразу в свободный слот кольцевого
+                # буфера; если все слоты заняты - решает drop_policy
+                index = gate.acquire() if save or self.analyze_frames else None
+                if index is not None:
+                    # drop_oldest отдаёт слот ещё не прочитанного кадра (его
+                    # номер не сброшен); если тот кадр ждал записи, он уже
+                    # не будет записан
+                    if ring.sequence(index) >= 0 and ring.flags(index) & SAVE:
+                        self.decimator.queued(-1)
+                    frame = self.adapter.copy_into(
+                        buffer, ring.frame(index), frame=npndarray)
+                    copied = time.perf_counter() if self.timing else np.nan
+                    ring.commit(index, exposure=self.exposure.exposure_time,
+                                flags=SAVE if save else 0,
+                                device_timestamp=getattr(buffer, 'timestamp_ns', 0),
+                                received=received, copied=copied)
+                    if save:
+                        self.decimator.queued()
+                # копия для get_current_frame делается, только если её ждут;
+                # кадр уже в формате кольцевого буфера
+                if self.frames.wanted():
+                    if index is not None:
+                        self.frames.put(frame)
+                    else:
+                        self.adapter.copy_into(
+                            buffer, self.frames.acquire(), frame=npndarray)
+                        self.frames.commit()
                 device.requeue_buffer(buffer)
-                        
-                buffer_bytes_per_pixel = int(len(item.data)/(item.width * item.height))
-                        
-                array = (ctypes.c_ubyte * num_channels * item.width * item.height).from_address(ctypes.addressof(item.pbytes))
-                        
-                npndarray = np.ndarray(buffer=array, dtype=np.uint8, shape=(item.height, item.width, buffer_bytes_per_pixel))
-                brightness = np.average(npndarray)
-                cv2.imshow('Processed Frame', npndarray)
-                while abs(brightness - self.threshold) > 5:
-                    cv2.putText(npndarray, str(nodes['ExposureTime'].value), (7, 70), cv2.FONT_HERSHEY_SIMPLEX, 2, (100, 255, 0), 3, cv2.LINE_AA)
-                    self.set_exposure_time(self.threshold, brightness, nodes)
-                    break
-                        # добавляем кадр в очередь
-                queue.put(npndarray.copy())
-                BufferFactory.destroy(item)
-                    
-                key = cv2.waitKey(1)
-                if key == 27:
-                    print('process1_ended')
-                    break
+                self.set_exposure_time(self.threshold, brightness, nodes)
+                self.metrics.set('exposure_time_us', self.exposure.exposure_time)
+                self.metrics.set('gain_db', self.exposure.gain)
+                self.metrics.set('brightness', brightness)
+                self.metrics.set('save_every_nth', self.decimator.every_nth)
+            print(f'Decimation: {self.decimator.counts}, '
+                  f'every_nth {self.decimator.every_nth}')
+            print('process1_ended')
             device.stop_stream()
-            cv2.destroyAllWindows()
-        system.destroy_device()
-
-    def save_image_buffers(self, queue,):        
-	    while True:
-		    if not queue.empty():
-                        self.frame_count += 1
-                        image = queue.get()
-                        processed_frame = self.process_frame(image)
-                        # записывается каждый n-ый кадр (здесь every_nth = 5) 
-                        if self.frame_count % self.every_nth == 0:
-                            cv2.imwrite(f'images/{int(time.time() * 1000)}.png', processed_frame)
+        self.get_system().destroy_device()
+
+    def save_image_buffers(
+            self,
+            ring: FrameRing,
+            gate: Optional[FrameGate] = None
+    ):
+        writer = create_writer(
+            self.writer_kind, self.images_directory, **self.writer_options)
+        stats = PipelineStats(self.stats_interval, self.stats_path, name='saver') \
+            if self.timing else None
+        # блокирующее ожидание кадра, выход по сигналу STOP из start_camera
+        for index in ring.frames(timeout=self.ring_timeout):
+            dequeued = time.perf_counter()
+            self.frame_count += 1
+            self.metrics.add('frames_processed_total')
+            sequence = ring.sequence(index)
+            timestamp = ring.timestamp(index)
+            exposure = ring.exposure(index)
+            save = ring.flags(index) & SAVE
+            # кадр читается прямо из общей памяти, без копирования; для Mono
+            # форматов processed_frame - это сам слот, поэтому он
+            # освобождается только после анализа и записи
+            processed_frame = self.process_frame(ring.frame(index))
+            if self.analyze_frames:
+                self.analyzer.full_scale = self._full_scale.value
+                analysis = self.analyzer.analyze(processed_frame)
+                self.handle_analysis(sequence, timestamp, analysis)
+                self.metrics.add('particles_total', len(analysis.particles))
+            processed = time.perf_counter()
+            written = None
+            # какие кадры записывать, решил decimator при захвате
+            if save:
+                writer.write(processed_frame, str(int(timestamp * 1000)),
+                             frame_id=sequence, timestamp=timestamp,
+                             exposure=exposure)
+                written = time.perf_counter()
+                self.metrics.add('frames_written_total')
+            if stats is not None:
+                stats.frame(ring, index, dequeued, processed, written)
+            ring.release(index)
+            if stats is not None:
+                stats.report(extra=gate.counts if gate is not None else None)
+        writer.close()
+        if stats is not None:
+            stats.report(force=True, extra=gate.counts if gate is not None else None)
+        if self.analyze_frames:
+            self.distribution.write_json(self.distribution_path)
+            print(f'{self.distribution.particles} particles in {self.frame_count} '
+                  f'frames, last minute: {self.distribution.quantiles(60.0)}')
 
     def start_camera(self):
-        queue = Queue()
+        self.region = plan_region(self.sensor, self.roi, self.target_resolution)
+        # кольцевой буфер под формат, который камера действительно отдаст:
+        # без Mono8 это может быть Mono10/12/16 и при bit_depth = 8
+        self._negotiated_format = self.negotiate_format()
+        ring = FrameRing(
+            self.ring_slots,
+            *self.adapter.frame_spec(self.ring_format(), self.region.width,
+                                     self.region.height)
+        )
+        gate = FrameGate(ring, self.drop_policy, timeout=self.drop_timeout)
+        self.frames = LatestFrame(ring.shape, ring.dtype, history=self.frame_history)
+        self._last_sequence = -1
+        exporter = None
+        if self.metrics_port is not None or self.metrics_path is not None:
+            exporter = MetricsExporter(
+                self.metrics, gate, ring, port=self.metrics_port,
+                path=self.metrics_path, interval=self.metrics_interval)
+            exporter.start()
+        preview = None
+        if self.preview_enabled:
+            preview = Preview(
+                ring.shape, ring.dtype,
+                fps=self.preview_fps, scale=self.preview_scale,
+                stop_event=self.stop_event
+            )
+            preview.start()
         
         putting_process = Process(
 		    target=self.get_images,
-	 	    args=(queue, )
+	 	    args=(ring, gate, preview)
         )
         
         putting_process.start()
@@ -203,23 +498,30 @@ class Camera:
 
         getting_process = Process(
             target=self.save_image_buffers,
-            args=(queue, )
+            args=(ring, gate)
         )
 
         getting_process.start()
         
         putting_process.join()
-        time.sleep(0.1)
-        if not putting_process.is_alive():
-            print('Putting process stopped, terminating getting p.')
-            getting_process.terminate()
-            print('process2_ended')
+        print('Putting process stopped, stopping getting p.')
+        ring.stop(consumers=1, drain=self.drain_on_exit)
+        getting_process.join()
+        print('process2_ended')
+        print(f'Frames: {gate.counts()}')
+        if exporter is not None:
+            exporter.stop()
+        ring.close()
+        self.frames.close()
+        self.frames = None
+        if preview is not None:
+            preview.stop()
 
 
 if __name__ == '__main__':
     print('\nWARNING:\nTHIS EXAMPLE MIGHT CHANGE THE DEVICE(S) SETTINGS!')
     print('\nExample started\n')
-    lucid = Camera()
+    lucid = Camera(simulated='--simulated' in sys.argv)
     lucid.start_camera()
     print('\nExample finished successfully')  
 
@@ -12,13 +12,23 @@
 # -----------------------------------------------------------------------------
 
 import ctypes
+import functools
 import sys
+from pathlib import Path
 
+import numpy as np
 from arena_api.__future__.save import Writer
 from arena_api.buffer import BufferFactory
 from arena_api.enums import PixelFormat
 from arena_api.system import system
 
+# the granulometr modules are one directory up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from buffer_adapter import BufferAdapter
+from depth_colormap import BGR, RGB, DepthColormap
+from point_cloud import CoordinateScale
+from point_cloud_writer import PointCloudWriter
+
 '''
 Helios Heat Map: Introduction
     This example demonstrates the transformation of 3-dimensional data to produce
@@ -40,6 +50,8 @@ COLOR_BORDER_BLUE = 1500
 # check if Helios2 camera used for the example
 isHelios2 = False
 
+adapter = BufferAdapter()
+
 
 def create_devices_with_tries():
 	'''
@@ -135,156 +147,46 @@ def get_rgb_colors_of_point_at_distance(z):
 	return int(red), int(green), int(blue)
 
 
-def get_a_BGR8_distance_heatmap_ctype_array(buffer_3d, scale_z):
-
-	# 3D buffer info -------------------------------------------------
-
-	# "Coord3D_ABCY16s" and "Coord3D_ABCY16" pixelformats have 4
-	# channels pre pixel. Each channel is 16 bits and they represent:
-	#   - x position
-	#   - y postion
-	#   - z postion
-	#   - intensity
-	# the value can be dynamically calculated this way:
-	#   int(buffer_3d.bits_per_pixel/16) # 16 is the size of each channel
-	Coord3D_ABCY16_channels_per_pixel = buffer_3d_step_size = 4
-
-	# Buffer.pdata is a (uint8, ctypes.c_ubyte) pointer. "Coord3D_ABCY16"
-	# pixelformat has 4 channels, and each channel is 16 bits.
-	# It is easier to deal with Buffer.pdata if it is casted to 16bits
-	# so each channel value is read/accessed easily.
-	# "Coord3D_ABCY16" might be suffixed with "s" to indicate that the data
-	# should be interpereted as signed.
-	pdata_16bit = ctypes.cast(buffer_3d.pdata, ctypes.POINTER(ctypes.c_int16))
-
-	number_of_pixels = buffer_3d.width * buffer_3d.height
-
-	# out array info -------------------------------------------------
-
-	BGR8_channels_per_pixel = array_bgr8_step_size = 3  # Blue, Green, Red
-	BGR8_channel_size_bits = 8
-	BGR8_pixel_size_bytes = BGR8_channel_size_bits * BGR8_channels_per_pixel
-	array_BGR8_size_in_bytes = BGR8_pixel_size_bytes * number_of_pixels
-
-	# array to return
-	# c_byte and not c_ubyte because it is signed data
-	CustomArrayType = (ctypes.c_byte * array_BGR8_size_in_bytes)
-	array_BGR8_for_jpg = CustomArrayType()
-
-	# iterate --------------------------------------------------------
-
-	# iterate over two arrays with different internals
-	# buffer_3d  : [x][y][z][a] | [x][y][z][a] | ... (each [] is 16 bit)
-	# buffer_rgp : [b][g][r]    | [b][g][r]    | ... (each [] is 8 bit)
-	buffer_3d_pixel_index = 0
-	array_bgr8_pixel_index = 0
-	for _ in range(number_of_pixels):
-
-		# Isolate the z channel.
-		# In one pixel:
-		#   The first channel is the x coordinate,
-		#   the second channel is the y coordinate,
-		#   the third channel is the z coordinate, and
-		#   the fourth channel is intensity.
-		# The z coordinate is what used to determine the coloring
-		z = pdata_16bit[buffer_3d_pixel_index + 2]
-
-		# Convert z to millimeters
-		#   The z data converts at a specified ratio to mm, so by
-		#   multiplying it by the Scan3dCoordinateScale for CoordinateC,  we
-		#   are able to convert it to mm and can then compare it to the
-		#   maximum distance of 1500mm.
-		z = int(z * scale_z)
-
-		# color respons to the z distance
-		red, green, blue = get_rgb_colors_of_point_at_distance(z)
+@functools.lru_cache(maxsize=None)
+def get_colormap(scale_z, signed, order):
 
-		# fill into the current pixel in BGR order not RGB
-		array_BGR8_for_jpg[array_bgr8_pixel_index] = blue
-		array_BGR8_for_jpg[array_bgr8_pixel_index + 1] = green
-		array_BGR8_for_jpg[array_bgr8_pixel_index + 2] = red
+	# the lookup table covers every raw 16-bit Z value, it is built once per
+	# scale and pixel format and then reused for every frame
+	return DepthColormap(scale_z, signed=signed, max_distance=COLOR_BORDER_BLUE,
+						order=order)
 
-		# next pixel index corresping index
-		buffer_3d_pixel_index += buffer_3d_step_size
-		array_bgr8_pixel_index += array_bgr8_step_size
 
-	return array_BGR8_for_jpg
+def get_z_view(buffer_3d):
 
-
-def get_a_RGB_colring_ctype_array(buffer_3d, scale_z):
-
-	# 3D buffer info -------------------------------------------------
-
-	# "Coord3D_ABCY16s" and "Coord3D_ABCY16" pixelformats have 4
-	# channels pre pixel. Each channel is 16 bits and they represent:
-	#   - x position
-	#   - y postion
-	#   - z postion
-	#   - intensity
-	# the value can be dinamically calculated this way:
-	#   int(buffer_3d.bits_per_pixel/16) # 16 is the size of each channel
-	Coord3D_ABCY16_channels_per_pixel = buffer_3d_step_size = 4
-
-	# Buffer.pdata is a (uint8, ctypes.c_ubyte) pointer. "Coord3D_ABCY16"
-	# pixelformat has 4 channels, and each channel is 16 bits.
-	# It is easier to deal with Buffer.pdata if it is casted to 16bits
-	# so each channel value is read/accessed easily.
+	# Zero-copy (height, width, 4) view of the "Coord3D_ABCY16" buffer:
+	#   x, y, z and intensity channels of 16 bits each.
 	# "Coord3D_ABCY16" might be suffixed with "s" to indicate that the data
-	# should be interpereted as signed.
-	pdata_16bit = ctypes.cast(buffer_3d.pdata, ctypes.POINTER(ctypes.c_int16))
-
-	number_of_pixels = buffer_3d.width * buffer_3d.height
-
-	# out array info -------------------------------------------------
-
-	RGB8_channels_per_pixel = array_rgb8_step_size = 3  # RED, Green, Blue
-	RGB8_channel_size_bits = 8
-	RGB8_pixel_size_bytes = RGB8_channel_size_bits * RGB8_channels_per_pixel
-	array_RGB8_size_in_bytes = RGB8_pixel_size_bytes * number_of_pixels
-
-	# array to return
-	# c_byte and not c_ubyte because it is signed data
-	CustomArrayType = (ctypes.c_byte * array_RGB8_size_in_bytes)
-	array_RGB8_for_ply_coloring = CustomArrayType()
+	# should be interpereted as signed; the adapter picks the dtype from the
+	# pixel format. The view is valid until the buffer is requeued.
+	points = adapter.view(buffer_3d)
+	signed = points.dtype == np.int16
+	return points, signed
 
-	# iterate --------------------------------------------------------
 
-	# iterate over two arrays with different internals
-	# buffer_3d  : [x][y][z][a] | [x][y][z][a] | ... (each [] is 16 bit)
-	# buffer_rgp : [r][g][b]    | [r][g][b]    | ... (each [] is 8 bit)
-	buffer_3d_pixel_index = 0
-	array_rgb8_pixel_index = 0
-	for _ in range(number_of_pixels):
-
-		# Isolate the z channel.
-		# In one pixel:
-		#   The first channel is the x coordinate,
-		#   the second channel is the y coordinate,
-		#   the third channel is the z coordinate, and
-		#   the fourth channel is intensity.
-		# The z coordinate is what used to determine the coloring
-		z = pdata_16bit[buffer_3d_pixel_index + 2]
-
-		# Convert z to millimeters
-		#   The z data converts at a specified ratio to mm, so by
-		#   multiplying it by the Scan3dCoordinateScale for CoordinateC,  we
-		#   are able to convert it to mm and can then compare it to the
-		#   maximum distance of 1500mm.
-		z = int(z * scale_z)
+def get_a_BGR8_distance_heatmap_ctype_array(buffer_3d, scale_z):
 
-		# color respons to the z distance
-		red, green, blue = get_rgb_colors_of_point_at_distance(z)
+	# BGR8 heat map as a contiguous (height, width, 3) uint8 NumPy array.
+	# The colour of every pixel is looked up by its raw z value, the z
+	# channel is never converted to mm pixel by pixel; see
+	# get_rgb_colors_of_point_at_distance() for the colours.
+	# The array belongs to the colormap and is overwritten by its next
+	# call; copy it to keep a heat map across frames.
+	points, signed = get_z_view(buffer_3d)
+	return get_colormap(scale_z, signed, BGR).apply(points)
 
-		# fill into the current pixel in RGB order not BGR
-		array_RGB8_for_ply_coloring[array_rgb8_pixel_index] = red
-		array_RGB8_for_ply_coloring[array_rgb8_pixel_index + 1] = green
-		array_RGB8_for_ply_coloring[array_rgb8_pixel_index + 2] = blue
 
-		# next pixel index corresping index
-		buffer_3d_pixel_index += buffer_3d_step_size
-		array_rgb8_pixel_index += array_rgb8_step_size
+def get_a_RGB_colring_ctype_array(buffer_3d, scale_z):
 
-	return array_RGB8_for_ply_coloring
+	# the same heat map in RGB order, to color the ply points; a separate
+	# colormap, so it does not overwrite the BGR array, but the next RGB
+	# call does
+	points, signed = get_z_view(buffer_3d)
+	return get_colormap(scale_z, signed, RGB).apply(points)
 
 
 def example_entry_point():
@@ -340,6 +242,9 @@ def example_entry_point():
 	nodemap["Scan3dCoordinateSelector"].value = "CoordinateC"
 	scale_z = nodemap["Scan3dCoordinateScale"].value
 
+	# scales and offsets of x, y and z for the point cloud
+	coordinate_scale = CoordinateScale.from_nodemap(nodemap, signed=False)
+
 	# Grab buffers ------------------------------------------------------------
 
 	# Starting the stream allocates buffers and begins filling them with data.
@@ -358,8 +263,8 @@ def example_entry_point():
 		array_BGR8_for_jpg = get_a_BGR8_distance_heatmap_ctype_array(buffer_3d,
 																	scale_z)
 		uint8_ptr = ctypes.POINTER(ctypes.c_ubyte)
-		ptr_array_BGR8_for_jpg = uint8_ptr(array_BGR8_for_jpg)
-		array_BGR8_for_jpg_size_in_bytes = len(array_BGR8_for_jpg) * 8
+		ptr_array_BGR8_for_jpg = array_BGR8_for_jpg.ctypes.data_as(uint8_ptr)
+		array_BGR8_for_jpg_size_in_bytes = array_BGR8_for_jpg.nbytes
 		heat_buffer = BufferFactory.create(ptr_array_BGR8_for_jpg,
 										array_BGR8_for_jpg_size_in_bytes,
 										buffer_3d.width,
@@ -388,35 +293,26 @@ def example_entry_point():
 		print('\t\tCreating RGB8 array from buffer')
 		array_RGB_colors = get_a_RGB_colring_ctype_array(buffer_3d, scale_z)
 
-		uint8_ptr = ctypes.POINTER(ctypes.c_ubyte)
-		ptr_array_RGB_colors = uint8_ptr(array_RGB_colors)
-
-		writer_ply = Writer()
-		# save function
-		# buffer :
-		#   buffer to save.
-		# pattern :
-		#   default name for the image is 'image_<count>.jpg' where count
-		#   is a pre-defined tag that gets updated every time a buffer image
-		#   is saved. More custom tags can be added using
-		#   Writer.register_tag() function
-		# kwargs (optional args) ignored if not an .ply image:
-		#   - 'filter_points' default is True.
-		#       Filters NaN points (A = B = C = -32,678)
-		#   - 'is_signed' default is False.
-		#       If pixel format is signed for example PixelFormat.Coord3D_A16s
-		#       then this arg must be passed to the save function else
-		#       the results would not be correct
-		#   - 'scale' default is 0.25.
-		#   - 'offset_a', 'offset_b' and 'offset_c' default to 0.0
-		writer_ply.save(buffer_3d, 'heatmap.ply',
-						color=ptr_array_RGB_colors,
-						filter_points=True)
+		# The points are copied out of the buffer in millimeters, with the
+		# invalid ones (z = 65535) filtered out, and written as a binary
+		# little endian PLY by a background thread; the buffer can be
+		# requeued as soon as write() returns.
+		#   - 'kind' is 'ply' or 'npz' (several frames per file)
+		#   - 'step' keeps every step-th pixel in both directions
+		#   - 'max_in_flight' frames may wait for the thread, write()
+		#     blocks beyond that, or drops the frame with block=False
+		writer_ply = PointCloudWriter('.', coordinate_scale, kind='ply')
+		writer_ply.write(get_z_view(buffer_3d)[0], 'heatmap',
+						colors=array_RGB_colors)
 
 		# Requeue the chunk data buffers
 		device.requeue_buffer(buffer_3d)
 		print(f'\tImage buffer requeued')
 
+		# waits until the file is written
+		writer_ply.close()
+		print(f'\tPoint cloud saved {writer_ply.path("heatmap")}')
+
 	# When the scope of the context manager ends, then 'Device.stop_stream()'
 	# is called automatically
 	print('Stream stopped')
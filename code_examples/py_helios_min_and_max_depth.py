@@ -13,10 +13,16 @@
 
 import ctypes
 import sys
+from pathlib import Path
 
+import numpy as np
 from arena_api.enums import PixelFormat
 from arena_api.system import system
 
+# the granulometr modules are one directory up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from point_cloud import CoordinateScale, PointCloudStats
+
 '''
 Helios, Min and Max Depth: Introduction
     This example demonstrates the examination of 3D data. It requires a 
@@ -102,95 +108,55 @@ class PointData:
 		self.intensity = intensity
 
 
-def find_min_and_max_z_for_signed(pdata_16bit, total_number_of_channels,
-								channels_per_pixel, scale_x, scale_y, scale_z):
+def find_min_and_max_z(pdata_16bit, total_number_of_channels,
+						channels_per_pixel, scale):
+
+	# View the channels as a (number of pixels, 4) array without copying:
+	#   the first column is the x coordinate,
+	#   the second column is the y coordinate,
+	#   the third column is the z coordinate, and
+	#   the fourth column is intensity.
+	# All points are converted and compared at once instead of channel by
+	# channel; invalid points (65535 unsigned, -32768 signed) and points
+	# at z <= 0 are masked out.
+	points = np.ctypeslib.as_array(pdata_16bit, shape=(total_number_of_channels,))
+	points = points.reshape(-1, 1, channels_per_pixel)
+	stats = PointCloudStats(scale, percentiles=()).compute(points)
 
-	# min_depth z value is set to SIGNED_16BIT_MAX to guarantee closer points
-	# exist as this is the largest value possible
+	# min_depth z value is set to SIGNED_16BIT_MAX when no point is valid
 	min_depth = PointData(x=0, y=0, z=SIGNED_16BIT_MAX, intensity=0)
 	max_depth = PointData(x=0, y=0, z=0, intensity=0)
-
-	for i in range(0, total_number_of_channels, channels_per_pixel):
-
-		# Extract channels from point/pixel
-		#   The first channel is the x coordinate,
-		#   the second channel is the y coordinate,
-		#   the third channel is the z coordinate, and
-		#   the fourth channel is intensity.
-		# We offset by 1 for each channel because pdata_16bit is 16 bit
-		#  integer
-		x = pdata_16bit[i]
-		y = pdata_16bit[i + 1]
-		z = pdata_16bit[i + 2]
-		intensity = pdata_16bit[i + 3]
-
-		x = int(x * scale_x)
-		y = int(y * scale_y)
-		z = int(z * scale_z)
-
-		if 0 < z < min_depth.z:
-			min_depth.x = x
-			min_depth.y = y
-			min_depth.z = z
-			min_depth.intensity = intensity
-
-		elif z > max_depth.z:
-			max_depth.x = x
-			max_depth.y = y
-			max_depth.z = z
-			max_depth.intensity = intensity
+	for depth, point in ((min_depth, stats.minimum), (max_depth, stats.maximum)):
+		# millimeters are not truncated to whole numbers any more
+		if point is not None:
+			depth.x = point.x
+			depth.y = point.y
+			depth.z = point.z
+			depth.intensity = point.intensity
 
 	return min_depth, max_depth
 
 
+def find_min_and_max_z_for_signed(pdata_16bit, total_number_of_channels,
+								channels_per_pixel, scale_x, scale_y, scale_z):
+
+	# signed coordinates need no offset
+	scale = CoordinateScale(scale_x, scale_y, scale_z, signed=True)
+	return find_min_and_max_z(pdata_16bit, total_number_of_channels,
+							channels_per_pixel, scale)
+
+
 def find_min_and_max_z_for_unsigned(pdata_16bit, total_number_of_channels,
 									channels_per_pixel, scale_x, scale_y, scale_z,
 									offset_x, offset_y):
-	# min_depth z value is set to SIGNED_16BIT_MAX to guarantee closer points
-	# exist as this is the largest value possible
-	min_depth = PointData(x=0, y=0, z=SIGNED_16BIT_MAX, intensity=0)
-	max_depth = PointData(x=0, y=0, z=0, intensity=0)
-
-	for i in range(0, total_number_of_channels, channels_per_pixel):
-
-		# Extract channels from point/pixel
-		#   The first channel is the x coordinate,
-		#   the second channel is the y coordinate,
-		#   the third channel is the z coordinate, and
-		#   the fourth channel is intensity.
-		# We offset by 1 for each channel because pdata_16bit is 16 bit
-		#  integer
-		x = pdata_16bit[i]
-		y = pdata_16bit[i + 1]
-		z = pdata_16bit[i + 2]
-		intensity = pdata_16bit[i + 3]
-
-		# if z is less than max value, as invalid values get
-		# filtered to UNSIGNED_16BIT_MAX
-		if z < UNSIGNED_16BIT_MAX:
-			# Convert x, y and z to millimeters
-			#   Using each coordinates' appropriate scales,
-			#   convert x, y and z values to mm. For the x and y
-			#   coordinates in an unsigned pixel format, we must then
-			#   add the offset to our converted values in order to
-			#   get the correct position in millimeters.
-			x = int((x * scale_x) + offset_x)
-			y = int((y * scale_y) + offset_y)
-			z = int(z * scale_y)
-
-			if 0 < z < min_depth.z:
-				min_depth.x = x
-				min_depth.y = y
-				min_depth.z = z
-				min_depth.intensity = intensity
-
-			elif z > max_depth.z:
-				max_depth.x = x
-				max_depth.y = y
-				max_depth.z = z
-				max_depth.intensity = intensity
 
-	return min_depth, max_depth
+	# For the x and y coordinates in an unsigned pixel format, we must
+	# add the offset to our converted values in order to get the correct
+	# position in millimeters.
+	scale = CoordinateScale(scale_x, scale_y, scale_z, offset_x, offset_y,
+							signed=False)
+	return find_min_and_max_z(pdata_16bit, total_number_of_channels,
+							channels_per_pixel, scale)
 
 
 def example_entry_point():
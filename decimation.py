@@ -0,0 +1,162 @@
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+from frame_ring import FrameRing
+
+'''
+Decimation: Introduction
+    Which frames are worth saving is decided in the acquisition process,
+    on the zero-copy view of the Arena buffer, before anything is copied.
+    SourceDecimator.keep() answers that per frame:
+
+        fixed        - every every_nth-th frame
+        target_rate  - target_rate frames per second, evenly spaced
+        adaptive     - every_nth follows the writer: it doubles when more
+                       than high_water x ring slots of saved frames are
+                       waiting to be written and steps down by one while
+                       fewer than low_water x slots are, checked every
+                       update_interval seconds; the measured write
+                       throughput is kept in write_rate
+
+    The backlog is the writer's, not the ring's: frames committed with the
+    SAVE flag (queued()) minus the frames written so far, which the saver
+    publishes (`written`, e.g. the frames_written_total metric). When the
+    granulometry analyses every frame, analysis alone can keep the ring
+    full, and saving fewer frames would not relieve it; it does not move
+    every_nth either.
+
+    With content_aware a frame is also kept when the scene changed since
+    the last kept frame: mean absolute difference of a strided thumbnail
+    (the same subsampling as BrightnessMeter) above change_threshold grey
+    levels, so a sudden change between two regular frames is not missed.
+
+    Camera copies a frame into the ring only if it is kept or the
+    granulometry needs every frame; kept frames carry the SAVE flag.
+'''
+
+FIXED = 'fixed'
+TARGET_RATE = 'target_rate'
+ADAPTIVE = 'adaptive'
+
+MODES = (FIXED, TARGET_RATE, ADAPTIVE)
+
+# FrameRing flag of frames the saver should write
+SAVE = 1
+
+
+class SourceDecimator:
+    '''
+    Per-frame keep/skip decision at the source
+    '''
+
+    def __init__(
+            self: 'SourceDecimator',
+            mode: str = FIXED,
+            every_nth: int = 5,
+            target_rate: Optional[float] = None,
+            max_every_nth: int = 64,
+            high_water: float = 0.75,
+            low_water: float = 0.25,
+            update_interval: float = 1.0,
+            content_aware: bool = False,
+            change_threshold: float = 8.0,
+            step: int = 16
+    ):
+        if mode not in MODES:
+            raise ValueError(f'Unknown decimation mode {mode}, expected one of {MODES}')
+        if mode == TARGET_RATE and not target_rate:
+            raise ValueError('target_rate mode needs target_rate > 0')
+        self.mode = mode
+        self.every_nth = max(1, every_nth)
+        self.target_rate = target_rate
+        self.max_every_nth = max_every_nth
+        self.high_water = high_water
+        self.low_water = low_water
+        self.update_interval = update_interval
+        self.content_aware = content_aware
+        self.change_threshold = change_threshold
+        self.step = step
+
+        self.write_rate = 0.0
+        self.counts: Dict[str, int] = {
+            'offered': 0, 'kept': 0, 'kept_changed': 0, 'queued': 0}
+        self._phase = -1
+        self._next_due: Optional[float] = None
+        self._last_update: Optional[float] = None
+        self._last_written = 0
+        self._reference: Optional[np.ndarray] = None
+
+    def keep(
+            self: 'SourceDecimator',
+            frame: np.ndarray,
+            ring: Optional[FrameRing] = None,
+            written: Optional[int] = None,
+            now: Optional[float] = None
+    ) -> bool:
+        '''
+        True if the frame should be saved. Adaptive mode needs the ring and
+            the number of frames the writer has written so far.
+        '''
+        now = time.monotonic() if now is None else now
+        self.counts['offered'] += 1
+        if self.mode == ADAPTIVE and ring is not None and written is not None:
+            self._adapt(ring, written, now)
+
+        if self.mode == TARGET_RATE:
+            period = 1.0 / self.target_rate
+            if self._next_due is None:
+                self._next_due = now
+            keep = now >= self._next_due
+            if keep:
+                # the schedule does not drift, but a stall is not caught up
+                self._next_due = max(self._next_due + period, now)
+        else:
+            self._phase = (self._phase + 1) % self.every_nth
+            keep = self._phase == 0
+
+        if self.content_aware:
+            thumbnail = frame[::self.step, ::self.step]
+            if not keep and self._reference is not None and np.mean(
+                    np.abs(thumbnail.astype(np.int32) - self._reference)) \
+                    > self.change_threshold:
+                keep = True
+                self.counts['kept_changed'] += 1
+            if keep:
+                self._reference = thumbnail.astype(np.int32)
+
+        if keep:
+            self.counts['kept'] += 1
+        return keep
+
+    def queued(self: 'SourceDecimator', frames: int = 1):
+        '''
+        Count kept frames committed to the ring; -1 for a kept frame that
+            drop_oldest overwrote before it was written
+        '''
+        self.counts['queued'] += frames
+
+    def backlog(self: 'SourceDecimator', written: int) -> int:
+        '''
+        Saved frames in the ring that the writer has not written yet
+        '''
+        return max(0, self.counts['queued'] - written)
+
+    def _adapt(self: 'SourceDecimator', ring: FrameRing, written: int, now: float):
+        if self._last_update is None:
+            self._last_update = now
+            self._last_written = written
+            return
+        elapsed = now - self._last_update
+        if elapsed < self.update_interval:
+            return
+        self.write_rate = (written - self._last_written) / elapsed
+        self._last_update = now
+        self._last_written = written
+
+        occupancy = self.backlog(written) / ring.slots
+        if occupancy > self.high_water:
+            self.every_nth = min(self.every_nth * 2, self.max_every_nth)
+        elif occupancy < self.low_water and self.every_nth > 1:
+            self.every_nth -= 1
@@ -0,0 +1,108 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+'''
+Depth colormap: Introduction
+    Heat map of a Helios depth frame. The examples colour every pixel with
+    a Python call per point, seconds per frame. Here the colour of every
+    possible raw Z value is worked out once: scale, offset and signedness
+    of the Coord3D format are folded into a lookup table of 65536 colours,
+    indexed directly by the 16-bit C channel. Colouring a frame is then one
+    gather over the zero-copy view of the buffer, written into an output
+    array that is reused from frame to frame.
+
+        colormap = DepthColormap(scale_z, signed=False, max_distance=1500)
+        points = adapter.view(buffer)       # (h, w, 4) Coord3D_ABCY16
+        heatmap = colormap.apply(points)    # (h, w, 3) BGR8, reused array
+
+    The colours are those of the Lucid example: red at 0 mm through yellow,
+    green and cyan to blue at max_distance, black beyond it, below 0 and
+    for invalid points (-32768 in the signed formats).
+'''
+
+BGR = 'BGR'
+RGB = 'RGB'
+
+# invalid point marker of the signed Coord3D formats
+INVALID_SIGNED = -32768
+
+
+def distance_colors(z_mm: np.ndarray, max_distance: float = 1500.0) -> np.ndarray:
+    '''
+    (..., 3) uint8 RGB colours of distances in mm: red, yellow, green, cyan
+        and blue at 0, 1/4, 1/2, 3/4 and 1 of max_distance
+    '''
+    z = np.asarray(z_mm, dtype=np.float64)
+    quarter = max_distance / 4.0
+    inside = (z >= 0) & (z <= max_distance)
+    # quarter the distance is in, and the position inside it, 0..1;
+    # max_distance itself is the end of the last quarter
+    segment = np.minimum(np.floor(z / quarter), 3)
+    ramp_up = 255.0 * ((z - segment * quarter) / quarter)
+    ramp_down = 255.0 - ramp_up
+
+    quarters = [inside & (segment == i) for i in range(4)]
+    red = np.select(quarters[:2], [255.0, ramp_down], 0.0)
+    green = np.select(quarters, [ramp_up, 255.0, 255.0, ramp_down], 0.0)
+    blue = np.select(quarters[2:], [ramp_up, 255.0], 0.0)
+    # truncation like int() in the original example
+    return np.stack([red, green, blue], axis=-1).astype(np.uint8)
+
+
+class DepthColormap:
+    '''
+    Lookup-table heat map of the Z channel of Coord3D frames
+    '''
+
+    def __init__(
+            self: 'DepthColormap',
+            scale_z: float,
+            offset_z: float = 0.0,
+            signed: bool = False,
+            max_distance: float = 1500.0,
+            order: str = BGR
+    ):
+        if order not in (BGR, RGB):
+            raise ValueError(f'Unknown channel order {order}, expected {BGR} or {RGB}')
+        self.scale_z = scale_z
+        self.offset_z = offset_z
+        self.signed = signed
+        self.max_distance = max_distance
+        self.order = order
+
+        # every raw 16-bit pattern, read the way the pixel format says
+        raw = np.arange(1 << 16, dtype=np.uint32).astype(np.uint16)
+        values = raw.view(np.int16) if signed else raw
+        # whole millimetres, as the original example compares them
+        z_mm = np.trunc(values.astype(np.float64) * scale_z + offset_z)
+        lut = distance_colors(z_mm, max_distance)
+        if signed:
+            lut[np.uint16(INVALID_SIGNED & 0xFFFF)] = 0
+        if order == BGR:
+            lut = lut[:, ::-1]
+        self.lut = np.ascontiguousarray(lut)
+        self._outputs: Dict[Tuple[int, ...], np.ndarray] = {}
+
+    def apply(
+            self: 'DepthColormap',
+            frame: np.ndarray,
+            out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        '''
+        Colour a (h, w, 4) ABCY or (h, w) C frame into out, or into an
+            internal array that the next call overwrites
+        '''
+        z = frame[..., 2] if frame.ndim == 3 else frame
+        if z.dtype.itemsize != 2:
+            raise ValueError(f'Expected 16-bit depth data, got {z.dtype}')
+        shape = z.shape + (3,)
+        if out is None:
+            out = self._outputs.get(shape)
+            if out is None:
+                out = self._outputs[shape] = np.empty(shape, dtype=np.uint8)
+        # one gather per pixel; the view keeps the strides of the buffer.
+        # Every 16-bit value is in the table, and mode='clip' spares take()
+        # the temporary copy of out it makes with the default 'raise'
+        np.take(self.lut, z.view(np.uint16), axis=0, out=out, mode='clip')
+        return out
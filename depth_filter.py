@@ -0,0 +1,272 @@
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from point_cloud import CoordinateScale
+
+'''
+Depth filter: Introduction
+    Host-side temporal filtering of Helios depth, so that on-camera
+    accumulation (Scan3dImageAccumulation) can be lowered for a higher frame
+    rate without noisier depth. Works on z in mm per pixel:
+
+        ema     - exponential moving average, ema += alpha * (z - ema); a
+                  pixel whose z jumps by more than reset_distance mm is
+                  taken as is, moving material does not leave a trail
+        median  - median of the valid values of the last `history` frames,
+                  robust against flying pixels
+
+    Holes (invalid pixels) are filled in two steps: a pixel keeps its last
+    filtered value for up to hold_frames frames, then what is still missing
+    gets the mean of the valid pixels within fill_radius (a box filter over
+    depth and validity), if there are any.
+
+    All state lives in arrays allocated once per resolution: the history
+    ring of history x height x width values, the work planes and the masks.
+    Every step writes into them (out=, where=), so a frame allocates no
+    frame-sized arrays. The temporal state holds only measured or held
+    values; the spatially filled pixels are in the output (depth) only and
+    do not feed the next frame.
+
+        depth_filter = TemporalDepthFilter(scale, mode='median', history=5)
+        filtered = depth_filter.apply(adapter.view(buffer))  # (h, w, 4), reused
+        depth_filter.depth                                   # z in mm, nan = hole
+
+    apply() returns a Coord3D frame of the same dtype with the filtered z,
+    so DepthColormap, PointCloudStats and Heightmap take it unchanged. x
+    and y are put back on the ray of the pixel: x / z and y / z are kept
+    from the last frame the pixel was valid in (and spread from the
+    neighbours, like z, for pixels never seen), and scaled by the filtered
+    z. So a held or filled pixel gets a real position instead of the
+    invalid x and y of the raw frame.
+'''
+
+EMA = 'ema'
+MEDIAN = 'median'
+
+MODES = (EMA, MEDIAN)
+
+
+class TemporalDepthFilter:
+    '''
+    EMA or median-of-N depth filter with hole filling on preallocated rings
+    '''
+
+    def __init__(
+            self: 'TemporalDepthFilter',
+            scale: CoordinateScale,
+            mode: str = EMA,
+            alpha: float = 0.3,
+            reset_distance: float = 50.0,
+            history: int = 5,
+            hold_frames: int = 3,
+            fill_radius: int = 2
+    ):
+        if mode not in MODES:
+            raise ValueError(f'Unknown filter mode {mode}, expected one of {MODES}')
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError(f'alpha must be in (0, 1], got {alpha}')
+        self.scale = scale
+        self.mode = mode
+        self.alpha = alpha
+        self.reset_distance = reset_distance
+        self.history = max(1, history)
+        self.hold_frames = hold_frames
+        self.fill_radius = fill_radius
+        self.frames = 0
+        self._shape: Optional[Tuple[int, ...]] = None
+
+    def _allocate(self: 'TemporalDepthFilter', points: np.ndarray):
+        shape = points.shape[:-1]
+        self._shape = shape
+        # the filtered z of the pixels: measured or held values only, the
+        # spatial fill goes to depth and never into the next frame
+        self._state = np.full(shape, np.nan, dtype=np.float32)
+        self.depth = np.full(shape, np.nan, dtype=np.float32)
+        self._z = np.empty(shape, dtype=np.float32)
+        self._work = np.empty(shape, dtype=np.float32)
+        self._mask = np.empty(shape, dtype=np.float32)
+        self._age = np.zeros(shape, dtype=np.int32)
+        self._valid = np.empty(shape, dtype=bool)
+        self._invalid = np.empty(shape, dtype=bool)
+        self._empty = np.empty(shape, dtype=bool)
+        self._selected = np.empty(shape, dtype=bool)
+        self._known = np.empty(shape, dtype=bool)
+        # x / z and y / z of every pixel, nan until it was seen; one plane
+        # per axis, interleaved pairs are several times slower to work on
+        self._ray = np.full((2,) + shape, np.nan, dtype=np.float32)
+        self._xy = np.empty((2,) + shape, dtype=np.float32)
+        self._out = np.empty(points.shape, dtype=points.dtype)
+        if self.mode == MEDIAN:
+            self._ring = np.full((self.history,) + shape, np.inf, dtype=np.float32)
+            self._planes = np.empty_like(self._ring)
+            self._next = 0
+            # valid values per pixel, and flat indices into _planes
+            self._count = np.empty(shape, dtype=np.intp)
+            self._index = np.empty(shape, dtype=np.intp)
+            self._pixels = np.arange(int(np.prod(shape)), dtype=np.intp).reshape(shape)
+        self.frames = 0
+
+    def reset(self: 'TemporalDepthFilter'):
+        '''
+        Forget the history, e.g. after the camera moved
+        '''
+        self._shape = None
+
+    def _ema(self: 'TemporalDepthFilter'):
+        state, z, work, jump = self._state, self._z, self._work, self._selected
+        # where the filter has no value yet or the scene changed, take z
+        np.subtract(z, state, out=work)
+        np.abs(work, out=self._mask)
+        np.less_equal(self._mask, self.reset_distance, out=jump)
+        np.logical_not(jump, out=jump)
+        # holes of this frame leave the average alone
+        np.copyto(work, 0.0, where=self._invalid)
+        work *= self.alpha
+        state += work
+        np.logical_and(self._valid, jump, out=jump)
+        np.copyto(state, z, where=jump)
+
+    def _median_value(self: 'TemporalDepthFilter', rank: np.ndarray, out: np.ndarray):
+        # planes[rank[p], p] of every pixel p; the indices are in range, 'clip'
+        # only saves np.take the buffered copy of out that 'raise' makes
+        np.multiply(rank, self._pixels.size, out=self._index)
+        self._index += self._pixels
+        np.take(self._planes.reshape(-1), self._index.reshape(-1),
+                out=out.reshape(-1), mode='clip')
+
+    def _median(self: 'TemporalDepthFilter'):
+        ring, planes, work = self._ring, self._planes, self._work
+        # holes as +inf sort last: a pixel's first `count` values are valid
+        np.copyto(ring[self._next], np.inf)
+        np.copyto(ring[self._next], self._z, where=self._valid)
+        self._next = (self._next + 1) % self.history
+        # odd-even transposition sort of the whole frames, plane against
+        # plane: history ** 2 / 2 vectorized min/max instead of a sort per
+        # pixel
+        np.copyto(planes, ring)
+        for step in range(self.history):
+            for i in range(step % 2, self.history - 1, 2):
+                np.minimum(planes[i], planes[i + 1], out=work)
+                np.maximum(planes[i], planes[i + 1], out=planes[i + 1])
+                np.copyto(planes[i], work)
+        count, rank = self._count, self._index
+        count.fill(0)
+        for plane in ring:
+            np.isfinite(plane, out=self._selected)
+            count += self._selected
+        # (v[(count - 1) // 2] + v[count // 2]) / 2
+        np.subtract(count, 1, out=rank)
+        np.maximum(rank, 0, out=rank)
+        rank //= 2
+        self._median_value(rank, work)
+        np.floor_divide(count, 2, out=rank)
+        self._median_value(rank, self._state)
+        self._state += work
+        self._state *= 0.5
+        np.equal(count, 0, out=self._selected)
+        np.copyto(self._state, np.nan, where=self._selected)
+
+    def _fill(self: 'TemporalDepthFilter'):
+        # temporal hold: a hole keeps the last value for hold_frames frames
+        np.copyto(self._age, 0, where=self._valid)
+        np.add(self._age, 1, out=self._age, where=self._invalid)
+        np.greater(self._age, self.hold_frames, out=self._selected)
+        np.copyto(self._state, np.nan, where=self._selected)
+        np.copyto(self.depth, self._state)
+        if self.fill_radius <= 0:
+            return
+        # spatial fill: mean of the valid neighbours of what is still empty
+        empty, fillable, known = self._empty, self._selected, self._known
+        np.isnan(self.depth, out=empty)
+        if not empty.any():
+            return
+        size = (2 * self.fill_radius + 1,) * 2
+        np.logical_not(empty, out=fillable)
+        np.copyto(self._mask, fillable)
+        np.copyto(self._work, self.depth)
+        np.copyto(self._work, 0.0, where=empty)
+        cv2.boxFilter(self._work, -1, size, dst=self._work, normalize=False)
+        cv2.boxFilter(self._mask, -1, size, dst=self._mask, normalize=False)
+        np.greater(self._mask, 0, out=fillable)
+        fillable &= empty
+        np.divide(self._work, self._mask, out=self.depth, where=fillable)
+        # pixels never seen valid get the mean ray of their neighbours
+        np.isnan(self._ray[0], out=known)
+        unknown = fillable
+        unknown &= known
+        if unknown.any():
+            np.logical_not(known, out=known)
+            np.copyto(self._mask, known)
+            cv2.boxFilter(self._mask, -1, size, dst=self._mask, normalize=False)
+            np.greater(self._mask, 0, out=empty)
+            unknown &= empty
+            for ray, work in zip(self._ray, self._xy):
+                np.copyto(work, 0.0)
+                np.copyto(work, ray, where=known)
+                cv2.boxFilter(work, -1, size, dst=work, normalize=False)
+                np.divide(work, self._mask, out=ray, where=unknown)
+
+    def apply(
+            self: 'TemporalDepthFilter',
+            points: np.ndarray
+    ) -> np.ndarray:
+        '''
+        Filter one (height, width, 4) Coord3D frame; returns a frame with
+            the filtered z that the next call overwrites
+        '''
+        if points.shape[:-1] != self._shape or points.dtype != self._out.dtype:
+            self._allocate(points)
+        scale = self.scale
+        np.multiply(points[..., 2], scale.scale_z, out=self._z, casting='unsafe')
+        self._z += scale.offset_z
+        # CoordinateScale.valid without its temporaries
+        valid = self._valid
+        np.not_equal(points[..., 2], scale.invalid, out=valid)
+        np.greater(self._z, 0, out=self._invalid)
+        valid &= self._invalid
+        np.logical_not(valid, out=self._invalid)
+        # rays of the pixels seen in this frame
+        axes = ((scale.scale_x, scale.offset_x), (scale.scale_y, scale.offset_y))
+        for axis, (axis_scale, offset) in enumerate(axes):
+            xy = self._xy[axis]
+            np.multiply(points[..., axis], axis_scale, out=xy, casting='unsafe')
+            if offset:
+                xy += offset
+            np.divide(xy, self._z, out=self._ray[axis], where=valid)
+
+        if self.mode == EMA:
+            self._ema()
+        else:
+            self._median()
+        self._fill()
+        self.frames += 1
+
+        out = self._out
+        np.copyto(out, points)
+        holes = np.isnan(self.depth, out=self._empty)
+        info = np.iinfo(out.dtype)
+        # back to raw units of the pixel format
+        np.subtract(self.depth, scale.offset_z, out=self._work)
+        self._work /= scale.scale_z
+        np.rint(self._work, out=self._work)
+        np.clip(self._work, info.min, info.max, out=self._work)
+        np.copyto(self._work, scale.invalid, where=holes)
+        np.copyto(out[..., 2], self._work, casting='unsafe')
+
+        # x and y on the ray of the pixel at the filtered depth; holes keep
+        # the x and y of the raw frame
+        placed = np.isnan(self._ray[0], out=self._selected)
+        placed |= holes
+        np.logical_not(placed, out=placed)
+        for axis, (axis_scale, offset) in enumerate(axes):
+            xy = self._xy[axis]
+            np.multiply(self._ray[axis], self.depth, out=xy)
+            if offset:
+                xy -= offset
+            xy /= axis_scale
+            np.rint(xy, out=xy)
+            np.clip(xy, info.min, info.max, out=xy)
+            np.copyto(out[..., axis], xy, where=placed, casting='unsafe')
+        return out
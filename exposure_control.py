@@ -0,0 +1,171 @@
+import math
+import time
+from typing import Optional
+
+'''
+Exposure control: Introduction
+    Image brightness is close to proportional to exposure time x gain until
+    the sensor saturates, so the exposure needed to reach the target can be
+    estimated from a single measurement instead of stepping +-200 us per
+    frame. ExposureController works in the log domain:
+
+        exposure *= (target / brightness) ** damping
+
+    with the step ratio clamped, the result clamped to the node limits and
+    the rest of the correction moved to Gain when exposure runs out (only if
+    gain_max > 0). A tolerance band with hysteresis stops it from hunting
+    around the target, node writes are rate limited and the frames still in
+    flight with the old exposure are skipped before measuring again.
+'''
+
+
+class ExposureController:
+    '''
+    Closed-loop exposure (and optionally gain) controller
+    '''
+
+    def __init__(
+            self: 'ExposureController',
+            target: float = 127.0,
+            tolerance: float = 5.0,
+            hysteresis: float = 2.0,
+            damping: float = 0.9,
+            max_step_ratio: float = 4.0,
+            min_write_interval: float = 0.03,
+            settle_frames: int = 1,
+            gain_max: float = 0.0,
+            verbose: bool = True
+    ):
+        self.target = target
+        # once converged the error has to grow to tolerance * hysteresis
+        # before the controller starts adjusting again
+        self.tolerance = tolerance
+        self.hysteresis = hysteresis
+        self.damping = damping
+        self.max_step_ratio = max_step_ratio
+        self.min_write_interval = min_write_interval
+        self.settle_frames = settle_frames
+        self.gain_max = gain_max
+        self.verbose = verbose
+
+        self.converged = False
+        self.convergence_time: Optional[float] = None
+        self.convergence_frames = 0
+        self.writes = 0
+
+        self._exposure: Optional[float] = None
+        self._gain = 0.0
+        self._last_write = 0.0
+        self._skip = 0
+        # set by the first update(), so the time before the first frame
+        # (device discovery, process start-up) is not counted
+        self._adjust_start: Optional[float] = None
+        self._adjust_frames = 0
+
+    @property
+    def exposure_time(self: 'ExposureController') -> float:
+        '''
+        Last ExposureTime read or written, nan before the first update
+        '''
+        return float('nan') if self._exposure is None else self._exposure
+
+    @property
+    def gain(self: 'ExposureController') -> float:
+        '''
+        Last Gain read or written, 0 while gain is not used
+        '''
+        return self._gain
+
+    def reset(self: 'ExposureController'):
+        '''
+        Forget the cached node values and start a new convergence, e.g.
+            after the nodes were changed from outside
+        '''
+        self._exposure = None
+        self._skip = 0
+        self._start_adjusting()
+
+    def _start_adjusting(self: 'ExposureController'):
+        self.converged = False
+        self._adjust_start = time.monotonic()
+        self._adjust_frames = 0
+
+    def update(
+            self: 'ExposureController',
+            brightness: float,
+            nodes
+    ) -> bool:
+        '''
+        Feed the brightness of the latest frame. Returns True if ExposureTime
+            or Gain was written.
+        '''
+        if self._exposure is None:
+            self._exposure = float(nodes['ExposureTime'].value)
+            gain_node = nodes.get('Gain') if self.gain_max > 0 else None
+            self._gain = float(gain_node.value) if gain_node is not None else 0.0
+            self._adjust_start = time.monotonic()
+
+        self._adjust_frames += 1
+        if self._skip > 0:
+            # frames exposed before the last write are still arriving
+            self._skip -= 1
+            return False
+
+        error = abs(self.target - brightness)
+        if self.converged:
+            if error <= self.tolerance * self.hysteresis:
+                return False
+            self._start_adjusting()
+        elif error <= self.tolerance:
+            self.converged = True
+            self.convergence_time = time.monotonic() - self._adjust_start
+            self.convergence_frames = self._adjust_frames
+            if self.verbose:
+                print(f'Exposure converged in {self.convergence_time:.3f} s '
+                      f'({self.convergence_frames} frames), '
+                      f'ExposureTime: {self._exposure:.0f}, '
+                      f'brightness: {brightness:.1f}')
+            return False
+
+        now = time.monotonic()
+        if now - self._last_write < self.min_write_interval:
+            return False
+
+        ratio = (self.target / max(brightness, 1.0)) ** self.damping
+        ratio = min(max(ratio, 1.0 / self.max_step_ratio), self.max_step_ratio)
+        written = self._apply(ratio, nodes)
+        if written:
+            self._last_write = now
+            self._skip = self.settle_frames
+            self.writes += 1
+        return written
+
+    def _apply(self: 'ExposureController', ratio: float, nodes) -> bool:
+        exposure_node = nodes['ExposureTime']
+        exposure_min, exposure_max = exposure_node.min, exposure_node.max
+        gain_node = nodes.get('Gain') if self.gain_max > 0 else None
+
+        exposure = self._exposure * ratio
+        gain = self._gain
+        if gain_node is not None:
+            # gain is only used once exposure is at its maximum, and is
+            # taken away first when the scene gets brighter
+            gain_db = gain + 20.0 * math.log10(ratio)
+            if ratio > 1.0 and exposure > exposure_max:
+                gain = min(self.gain_max, gain + 20.0 * math.log10(exposure / exposure_max))
+            elif ratio < 1.0 and gain > 0.0:
+                gain = max(0.0, gain_db)
+                exposure = self._exposure if gain_db > 0.0 else \
+                    self._exposure * 10 ** (gain_db / 20.0)
+        exposure = min(max(exposure, exposure_min), exposure_max)
+
+        written = False
+        if abs(exposure - self._exposure) >= 1.0:
+            exposure_node.value = exposure
+            self._exposure = exposure
+            written = True
+        if gain_node is not None and abs(gain - self._gain) >= 0.01:
+            gain_node.value = min(max(gain, gain_node.min), gain_node.max)
+            self._gain = gain
+            written = True
+        return written
@@ -0,0 +1,212 @@
+import json
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+'''
+Frame archive: Introduction
+    One PNG per frame means millions of small files per shift. The archive
+    appends fixed-size frame records to one large file instead, written
+    sequentially through a big I/O buffer, and rotated by size or age.
+
+    <name>.frames   header block (magic + JSON: dtype, shape, record size)
+                    followed by records of
+                        frame_id (int64) | timestamp (float64) |
+                        exposure (float64) | padding | frame bytes
+    <name>.idx      sidecar index, one INDEX_DTYPE entry per record, so a
+                    time range can be found without touching the frames
+
+    Because every record has the same size the file can be memory-mapped
+    and any frame read by number:
+
+        archive = FrameArchive('images/1690000000000.frames')
+        frame = archive.frames[1234]
+'''
+
+MAGIC = b'GRANFRM1'
+HEADER_SIZE = 4096
+# frame data starts at a multiple of this inside each record
+RECORD_ALIGNMENT = 64
+
+INDEX_DTYPE = np.dtype([
+    ('frame_id', '<i8'),
+    ('timestamp', '<f8'),
+    ('exposure', '<f8'),
+    ('record', '<i8'),
+])
+
+
+def record_dtype(dtype, shape: Tuple[int, ...]) -> np.dtype:
+    '''
+    Structured dtype of one archive record
+    '''
+    frame_dtype = np.dtype((np.dtype(dtype), tuple(shape)))
+    frame_offset = RECORD_ALIGNMENT
+    itemsize = frame_offset + frame_dtype.itemsize
+    itemsize += -itemsize % RECORD_ALIGNMENT
+    return np.dtype({
+        'names': ['frame_id', 'timestamp', 'exposure', 'frame'],
+        'formats': ['<i8', '<f8', '<f8', frame_dtype],
+        'offsets': [0, 8, 16, frame_offset],
+        'itemsize': itemsize,
+    })
+
+
+class FrameArchiveWriter:
+    '''
+    Appends frames to rotating .frames/.idx file pairs in directory
+    '''
+
+    def __init__(
+            self: 'FrameArchiveWriter',
+            directory: str = 'images',
+            max_bytes: int = 4 * 1024 ** 3,
+            max_seconds: float = 3600.0,
+            buffer_size: int = 16 * 1024 ** 2
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.buffer_size = buffer_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.path: Optional[str] = None
+        self._data = None
+        self._index = None
+        self._record_dtype: Optional[np.dtype] = None
+        self._record_header = np.zeros(1, dtype=INDEX_DTYPE)
+        self._padding = b''
+        self._records = 0
+        self._opened_at = 0.0
+
+    def _open(self: 'FrameArchiveWriter', frame: np.ndarray, name: str):
+        self._record_dtype = record_dtype(frame.dtype, frame.shape)
+        frame_offset = self._record_dtype.fields['frame'][1]
+        self._padding = bytes(self._record_dtype.itemsize - frame_offset - frame.nbytes)
+
+        self.path = os.path.join(self.directory, f'{name}.frames')
+        header = json.dumps({
+            'version': 1,
+            'dtype': frame.dtype.str,
+            'shape': list(frame.shape),
+            'record_size': self._record_dtype.itemsize,
+            'frame_offset': frame_offset,
+        }).encode()
+        self._data = open(self.path, 'wb', buffering=self.buffer_size)
+        self._data.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC), b' '))
+        self._index = open(os.path.splitext(self.path)[0] + '.idx', 'wb',
+                           buffering=64 * 1024)
+        self._records = 0
+        self._opened_at = time.monotonic()
+
+    def _must_rotate(self: 'FrameArchiveWriter', frame: np.ndarray) -> bool:
+        if self._data is None:
+            return False
+        if frame.dtype != self._record_dtype.fields['frame'][0].base \
+                or frame.shape != self._record_dtype.fields['frame'][0].shape:
+            return True
+        size = HEADER_SIZE + (self._records + 1) * self._record_dtype.itemsize
+        return size > self.max_bytes \
+            or time.monotonic() - self._opened_at > self.max_seconds
+
+    def append(
+            self: 'FrameArchiveWriter',
+            frame: np.ndarray,
+            name: str,
+            frame_id: int = -1,
+            timestamp: Optional[float] = None,
+            exposure: float = float('nan')
+    ) -> str:
+        '''
+        Append one frame; name is used for the file if a new one is started
+        '''
+        if self._must_rotate(frame):
+            self.close()
+        if self._data is None:
+            self._open(frame, name)
+
+        header = self._record_header
+        header['frame_id'] = frame_id
+        header['timestamp'] = time.time() if timestamp is None else timestamp
+        header['exposure'] = exposure
+        header['record'] = self._records
+
+        # frame_id | timestamp | exposure, then padding up to frame_offset
+        self._data.write(header.tobytes()[:24].ljust(
+            self._record_dtype.fields['frame'][1], b'\0'))
+        self._data.write(np.ascontiguousarray(frame).data)
+        if self._padding:
+            self._data.write(self._padding)
+        self._index.write(header.tobytes())
+        self._records += 1
+        return self.path
+
+    def close(self: 'FrameArchiveWriter'):
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+
+class FrameArchive:
+    '''
+    Read-only, memory-mapped access to one .frames file and its index
+    '''
+
+    def __init__(self: 'FrameArchive', path: str):
+        self.path = path
+        with open(path, 'rb') as data:
+            magic = data.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a frame archive')
+            self.header = json.loads(data.read(HEADER_SIZE - len(MAGIC)))
+
+        self.dtype = np.dtype(self.header['dtype'])
+        self.shape = tuple(self.header['shape'])
+        self.record_dtype = record_dtype(self.dtype, self.shape)
+        # a record cut short by a crash is ignored
+        count = (os.path.getsize(path) - HEADER_SIZE) // self.record_dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=self.record_dtype, mode='r',
+                                     offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=self.record_dtype)
+        self.frames = self.records['frame']
+
+        index_path = os.path.splitext(path)[0] + '.idx'
+        if os.path.exists(index_path):
+            index = np.fromfile(index_path, dtype=INDEX_DTYPE)
+            self.index = index[index['record'] < count]
+        else:
+            # rebuild it from the record headers
+            self.index = np.zeros(count, dtype=INDEX_DTYPE)
+            for field in ('frame_id', 'timestamp', 'exposure'):
+                self.index[field] = self.records[field]
+            self.index['record'] = np.arange(count)
+
+    def __len__(self: 'FrameArchive') -> int:
+        return len(self.frames)
+
+    def __getitem__(self: 'FrameArchive', record: int) -> np.ndarray:
+        return self.frames[record]
+
+    def between(
+            self: 'FrameArchive',
+            start: float,
+            end: float
+    ) -> np.ndarray:
+        '''
+        Record numbers with start <= timestamp < end
+        '''
+        mask = (self.index['timestamp'] >= start) & (self.index['timestamp'] < end)
+        return self.index['record'][mask]
+
+
+def list_archives(directory: str = 'images') -> List[str]:
+    '''
+    Archive files in directory, oldest first
+    '''
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith('.frames'))
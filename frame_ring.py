@@ -0,0 +1,321 @@
+import queue as queue_module
+from multiprocessing import Event, Queue, Value
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator, List, Optional, Tuple
+
+import time
+import numpy as np
+
+'''
+Frame ring: Introduction
+    Passing full frames through multiprocessing.Queue pickles every frame
+    (~8.5 MB for 1936x1464 BGR8) and copies it twice. FrameRing keeps a fixed
+    number of preallocated frame slots in shared memory instead. Only slot
+    indices travel through the queues: the acquisition process writes the
+    frame straight into a free slot and the saver processes read it back as
+    a NumPy view without any copy.
+
+    producer:                               consumer:
+        index = ring.acquire()                  for index in ring.frames():
+        np.copyto(ring.frame(index), image)         image = ring.frame(index)
+        ring.commit(index)                          ...
+                                                    ring.release(index)
+    parent, once the producer has finished:
+        ring.stop(consumers=2)
+
+    Consumers block on the filled queue, so an idle saver costs nothing.
+    Shutdown is a poison pill: stop() puts one STOP index per consumer
+    behind the frames already committed, so every consumer drains what is
+    left in the ring and then leaves its loop on its own.
+'''
+
+# sentinel put into the filled queue to tell one consumer to exit
+STOP = -1
+
+# per-slot header: sequence number of the frame, the host time it was
+# committed at, the exposure time it was taken with and flags the producer
+# passes on to the consumers (their meaning is up to the application);
+# then the timing stamps of frame_timing.py: the camera clock in ns and
+# time.perf_counter() when the buffer arrived, was copied and committed
+SLOT_HEADER_DTYPE = np.dtype([
+    ('sequence', np.int64),
+    ('timestamp', np.float64),
+    ('exposure', np.float64),
+    ('flags', np.int64),
+    ('device_timestamp', np.int64),
+    ('received', np.float64),
+    ('copied', np.float64),
+    ('queued', np.float64),
+])
+
+
+class FrameRing:
+    '''
+    Fixed-size ring of shared-memory frame slots with a free and a filled
+        index queue. The object can be passed to a Process as an argument,
+        the child attaches to the same shared memory block.
+    '''
+
+    def __init__(
+            self: 'FrameRing',
+            slots: int,
+            shape: Tuple[int, ...],
+            dtype=np.uint8
+    ):
+        if slots < 1:
+            raise ValueError(f'FrameRing needs at least one slot, got {slots}')
+
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        # first int64 of the block is the producer sequence counter,
+        # then one header per slot, then the frames themselves
+        self._headers_offset = np.dtype(np.int64).itemsize
+        self._frames_offset = self._headers_offset + SLOT_HEADER_DTYPE.itemsize * slots
+        self._shm = SharedMemory(
+            create=True, size=self._frames_offset + self.frame_nbytes * slots)
+        self._owner = True
+
+        self._free: Queue = Queue()
+        self._filled: Queue = Queue()
+        # set by stop(drain=False): consumers drop the remaining frames
+        self._abort = Event()
+        # frames released by all consumers together, see in_flight()
+        self._released = Value('q', 0)
+        # sequences overwritten by reclaim(), only kept once somebody asked
+        # for them with track_reclaimed()
+        self._reclaimed: Queue = Queue()
+        self._track_reclaimed = Event()
+        for index in range(slots):
+            self._free.put(index)
+
+        self._map()
+        self._counter[0] = 0
+        self._headers['sequence'] = -1
+        self._headers['timestamp'] = 0.0
+        self._headers['exposure'] = np.nan
+        self._headers['flags'] = 0
+        self._headers['device_timestamp'] = 0
+        self._headers[['received', 'copied', 'queued']] = np.nan
+
+    def _map(self: 'FrameRing'):
+        buf = self._shm.buf
+        self._counter = np.ndarray((1,), dtype=np.int64, buffer=buf)
+        self._headers = np.ndarray(
+            (self.slots,), dtype=SLOT_HEADER_DTYPE, buffer=buf,
+            offset=self._headers_offset)
+        self._frames = np.ndarray(
+            (self.slots,) + self.shape, dtype=self.dtype, buffer=buf,
+            offset=self._frames_offset)
+
+    def __getstate__(self: 'FrameRing'):
+        state = self.__dict__.copy()
+        # views into the block are rebuilt in the child after attaching
+        for key in ('_counter', '_headers', '_frames'):
+            del state[key]
+        state['_shm'] = self._shm.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self: 'FrameRing', state):
+        self.__dict__.update(state)
+        self._shm = SharedMemory(name=state['_shm'])
+        self._map()
+
+    # producer side ----------------------------------------------------------
+
+    def acquire(
+            self: 'FrameRing',
+            timeout: Optional[float] = None
+    ) -> Optional[int]:
+        '''
+        Take a free slot for writing. Returns None if no slot became free
+            within timeout (all slots are still held by consumers).
+        '''
+        try:
+            return self._free.get(timeout=timeout)
+        except queue_module.Empty:
+            return None
+
+    def commit(
+            self: 'FrameRing',
+            index: int,
+            timestamp: Optional[float] = None,
+            exposure: float = np.nan,
+            flags: int = 0,
+            device_timestamp: int = 0,
+            received: float = np.nan,
+            copied: float = np.nan
+    ) -> int:
+        '''
+        Stamp the written slot with the next sequence number and hand it
+            over to the consumers
+        '''
+        sequence = int(self._counter[0])
+        self._counter[0] = sequence + 1
+        header = self._headers[index]
+        header['sequence'] = sequence
+        header['timestamp'] = time.time() if timestamp is None else timestamp
+        header['exposure'] = exposure
+        header['flags'] = flags
+        header['device_timestamp'] = device_timestamp
+        header['received'] = received
+        header['copied'] = copied
+        header['queued'] = time.perf_counter()
+        self._filled.put(index)
+        return sequence
+
+    def reclaim(self: 'FrameRing') -> Optional[int]:
+        '''
+        Take back the oldest committed frame no consumer has picked up yet,
+            to overwrite it with a newer one. Returns None if there is none.
+            Producer side only, before stop().
+        '''
+        try:
+            index = self._filled.get_nowait()
+        except queue_module.Empty:
+            return None
+        # the overwritten frame counts as released
+        with self._released.get_lock():
+            self._released.value += 1
+        if self._track_reclaimed.is_set():
+            self._reclaimed.put(self.sequence(index))
+        return index
+
+    # consumer side ----------------------------------------------------------
+
+    def get(
+            self: 'FrameRing',
+            timeout: Optional[float] = None
+    ) -> int:
+        '''
+        Block until a filled slot is available and return its index.
+            Raises queue.Empty on timeout.
+        '''
+        return self._filled.get(timeout=timeout)
+
+    def frames(
+            self: 'FrameRing',
+            timeout: float = 0.5
+    ) -> Iterator[int]:
+        '''
+        Yield indices of filled slots until a STOP sentinel arrives. The
+            caller must release() every yielded index. Gets block with a
+            timeout so an aborted ring is noticed even when nothing arrives.
+        '''
+        while True:
+            try:
+                index = self._filled.get(timeout=timeout)
+            except queue_module.Empty:
+                if self._abort.is_set():
+                    return
+                continue
+            if index == STOP:
+                return
+            if self._abort.is_set():
+                self.release(index)
+                continue
+            yield index
+
+    def stop(
+            self: 'FrameRing',
+            consumers: int = 1,
+            drain: bool = True
+    ):
+        '''
+        Ask consumers to exit. With drain the frames already committed are
+            still handled first, otherwise they are dropped.
+        '''
+        if not drain:
+            self._abort.set()
+        for _ in range(consumers):
+            self._filled.put(STOP)
+
+    def track_reclaimed(self: 'FrameRing'):
+        '''
+        From now on record the sequence numbers of reclaimed frames, for
+            consumers that wait for sequences in order
+        '''
+        self._track_reclaimed.set()
+
+    def reclaimed(self: 'FrameRing') -> List[int]:
+        '''
+        Sequence numbers reclaimed since the last call; they will never
+            reach a consumer. Needs track_reclaimed().
+        '''
+        sequences = []
+        while True:
+            try:
+                sequences.append(self._reclaimed.get_nowait())
+            except queue_module.Empty:
+                return sequences
+
+    def aborted(self: 'FrameRing') -> bool:
+        '''
+        True after stop(drain=False): consumers reading with get() should
+            release the frames they receive without handling them
+        '''
+        return self._abort.is_set()
+
+    def release(self: 'FrameRing', index: int):
+        '''
+        Return a consumed slot to the free list
+        '''
+        self._headers[index]['sequence'] = -1
+        with self._released.get_lock():
+            self._released.value += 1
+        self._free.put(index)
+
+    # common -----------------------------------------------------------------
+
+    def frame(self: 'FrameRing', index: int) -> np.ndarray:
+        '''
+        Zero-copy view of the slot. Valid until the slot is released.
+        '''
+        return self._frames[index]
+
+    def sequence(self: 'FrameRing', index: int) -> int:
+        return int(self._headers[index]['sequence'])
+
+    def timestamp(self: 'FrameRing', index: int) -> float:
+        return float(self._headers[index]['timestamp'])
+
+    def exposure(self: 'FrameRing', index: int) -> float:
+        return float(self._headers[index]['exposure'])
+
+    def flags(self: 'FrameRing', index: int) -> int:
+        return int(self._headers[index]['flags'])
+
+    def stamps(self: 'FrameRing', index: int) -> Tuple[int, float, float, float]:
+        '''
+        device_timestamp, received, copied and queued of the slot
+        '''
+        header = self._headers[index]
+        return (int(header['device_timestamp']), float(header['received']),
+                float(header['copied']), float(header['queued']))
+
+    def committed(self: 'FrameRing') -> int:
+        return int(self._counter[0])
+
+    def released(self: 'FrameRing') -> int:
+        return self._released.value
+
+    def in_flight(self: 'FrameRing') -> int:
+        '''
+        Frames committed and not yet released: waiting in the ring or being
+            handled by a consumer
+        '''
+        return self.committed() - self.released()
+
+    def close(self: 'FrameRing'):
+        '''
+        Detach from the shared memory; the process that created the ring
+            also unlinks it
+        '''
+        # numpy views hold exports of the buffer, drop them before closing
+        self._counter = self._headers = self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,237 @@
+import json
+import math
+import os
+import time
+from bisect import bisect_right
+from typing import Callable, Dict, Optional
+
+from frame_ring import FrameRing
+
+'''
+Frame timing: Introduction
+    Where the time of a frame goes between the camera and the disk. Every
+    frame carries its stamps through the FrameRing slot header:
+
+        device_timestamp - camera clock of the exposure (buffer.timestamp_ns)
+        received         - get_buffer() returned
+        copied           - frame copied into the ring slot
+        queued           - ring.commit(), stamped by the ring itself
+
+    and the consumer adds dequeued, processed and written. Host stamps are
+    time.perf_counter(): monotonic, sub-microsecond and system-wide on
+    Windows (QueryPerformanceCounter) and Linux (CLOCK_MONOTONIC), so stamps
+    from different processes can be subtracted. The camera clock is not
+    synchronized with the host; the device timestamp of the last frame is
+    kept in the snapshot to line the stats up with camera-side logs.
+
+    PipelineStats turns the stamps into per-stage latency histograms
+
+        copy     received  -> copied
+        queue    queued    -> dequeued      waiting in the ring
+        process  dequeued  -> processed     conversion and analysis
+        write    processed -> written       saved frames only
+        total    received  -> done          the whole frame
+
+    and throughput counters. Every log_interval seconds report() prints one
+    line and replaces `path` with a JSON snapshot. A sample costs one bisect
+    into fixed log buckets (10 per decade from 10 us to 100 s), so the
+    histograms never grow and recording stays in the microseconds.
+
+        stats = PipelineStats(log_interval=10.0, path='pipeline_stats.json')
+        for index in ring.frames():
+            dequeued = time.perf_counter()
+            ...
+            stats.frame(ring, index, dequeued, processed, written)
+            ring.release(index)
+            stats.report()
+'''
+
+STAGES = ('copy', 'queue', 'process', 'write', 'total')
+
+# 10 buckets per decade, 1e-5 .. 1e2 s
+LATENCY_EDGES = tuple(10.0 ** (exponent / 10.0) for exponent in range(-50, 21))
+
+
+class LatencyHistogram:
+    '''
+    Count of durations in fixed logarithmic buckets, with under- and
+        overflow buckets at both ends
+    '''
+
+    def __init__(self: 'LatencyHistogram'):
+        self.counts = [0] * (len(LATENCY_EDGES) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self: 'LatencyHistogram', seconds: float):
+        self.counts[bisect_right(LATENCY_EDGES, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self: 'LatencyHistogram', fraction: float) -> float:
+        '''
+        Upper edge of the bucket that holds the quantile, nan while empty
+        '''
+        if not self.count:
+            return math.nan
+        target = fraction * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                return min(LATENCY_EDGES[min(bucket, len(LATENCY_EDGES) - 1)], self.max)
+        return self.max
+
+    def summary(self: 'LatencyHistogram') -> Dict[str, float]:
+        '''
+        Count, mean, p50, p90, p99 and max, in milliseconds
+        '''
+        return {
+            'count': self.count,
+            'mean_ms': self.sum / self.count * 1000.0 if self.count else math.nan,
+            'p50_ms': self.quantile(0.5) * 1000.0,
+            'p90_ms': self.quantile(0.9) * 1000.0,
+            'p99_ms': self.quantile(0.99) * 1000.0,
+            'max_ms': self.max * 1000.0,
+        }
+
+
+class RateMeter:
+    '''
+    Events per second over the last `interval` seconds, for an FPS display
+        that does not jump with every frame
+    '''
+
+    def __init__(self: 'RateMeter', interval: float = 1.0):
+        self.interval = interval
+        self.rate = 0.0
+        self.total = 0
+        self._events = 0
+        self._start: Optional[float] = None
+
+    def tick(self: 'RateMeter', events: int = 1, now: Optional[float] = None) -> float:
+        now = time.perf_counter() if now is None else now
+        if self._start is None:
+            self._start = now
+        self._events += events
+        self.total += events
+        elapsed = now - self._start
+        if elapsed >= self.interval:
+            self.rate = self._events / elapsed
+            self._events = 0
+            self._start = now
+        return self.rate
+
+
+class PipelineStats:
+    '''
+    Per-stage latency histograms and throughput counters of one consumer,
+        with a periodic log line and JSON snapshot
+    '''
+
+    def __init__(
+            self: 'PipelineStats',
+            log_interval: float = 10.0,
+            path: Optional[str] = 'pipeline_stats.json',
+            name: str = 'pipeline'
+    ):
+        self.log_interval = log_interval
+        self.path = path
+        self.name = name
+        self.histograms: Dict[str, LatencyHistogram] = {
+            stage: LatencyHistogram() for stage in STAGES}
+        self.counters: Dict[str, int] = {'frames': 0, 'written': 0}
+        self._started = time.perf_counter()
+        self._last_report = self._started
+        self._last_counters = dict(self.counters)
+        self.last_device_timestamp = 0
+
+    def add(self: 'PipelineStats', stage: str, seconds: float):
+        self.histograms[stage].add(seconds)
+
+    def count(self: 'PipelineStats', counter: str, value: int = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def frame(
+            self: 'PipelineStats',
+            ring: FrameRing,
+            index: int,
+            dequeued: float,
+            processed: float,
+            written: Optional[float] = None
+    ):
+        '''
+        Record the stamps of one frame; call before the slot is released
+        '''
+        device_timestamp, received, copied, queued = ring.stamps(index)
+        done = processed if written is None else written
+        self.counters['frames'] += 1
+        # a producer without timing leaves the host stamps at nan
+        if not math.isnan(received):
+            self.histograms['copy'].add(copied - received)
+            self.histograms['total'].add(done - received)
+        self.histograms['queue'].add(dequeued - queued)
+        self.histograms['process'].add(processed - dequeued)
+        if written is not None:
+            self.counters['written'] += 1
+            self.histograms['write'].add(written - processed)
+        self.last_device_timestamp = device_timestamp
+
+    def snapshot(
+            self: 'PipelineStats',
+            now: Optional[float] = None,
+            extra: Optional[Callable[[], Dict[str, int]]] = None
+    ) -> dict:
+        '''
+        Counters, rates since the last report and stage summaries as a
+            JSON-serializable dict; the counters returned by extra (e.g.
+            FrameGate.counts) are added as they are
+        '''
+        now = time.perf_counter() if now is None else now
+        elapsed = max(now - self._last_report, 1e-9)
+        return {
+            'name': self.name,
+            'timestamp': time.time(),
+            'uptime': now - self._started,
+            'last_device_timestamp': self.last_device_timestamp,
+            'counters': {**self.counters, **(extra() if extra is not None else {})},
+            'rates': {
+                counter: (value - self._last_counters.get(counter, 0)) / elapsed
+                for counter, value in self.counters.items()},
+            'stages': {stage: histogram.summary()
+                       for stage, histogram in self.histograms.items()},
+            'edges_s': list(LATENCY_EDGES),
+            'histograms': {stage: histogram.counts
+                           for stage, histogram in self.histograms.items()},
+        }
+
+    def report(
+            self: 'PipelineStats',
+            now: Optional[float] = None,
+            force: bool = False,
+            extra: Optional[Callable[[], Dict[str, int]]] = None
+    ) -> Optional[dict]:
+        '''
+        Every log_interval seconds (or with force) print one line and write
+            the snapshot to path. Returns the snapshot if one was made.
+        '''
+        now = time.perf_counter() if now is None else now
+        if not force and now - self._last_report < self.log_interval:
+            return None
+        snapshot = self.snapshot(now, extra)
+        stages = snapshot['stages']
+        print(f'[{self.name}] {snapshot["rates"]["frames"]:.1f} fps, '
+              f'{snapshot["rates"]["written"]:.1f} written/s | p50/p99 ms ' +
+              ' '.join(f'{stage} {stages[stage]["p50_ms"]:.2f}/{stages[stage]["p99_ms"]:.2f}'
+                       for stage in STAGES if stages[stage]['count']))
+        if self.path is not None:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as stats_file:
+                json.dump(snapshot, stats_file)
+            os.replace(tmp_path, self.path)
+        self._last_report = now
+        self._last_counters = dict(self.counters)
+        return snapshot
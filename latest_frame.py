@@ -0,0 +1,188 @@
+import time
+from multiprocessing import Condition, Value
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+'''
+Latest frame: Introduction
+    Readers that only care about the freshest frame (preview, exposure
+    check, snapshots) should not poll a growing list. LatestFrame keeps the
+    newest frame in shared memory, guarded by a condition variable: the
+    acquisition process publishes a frame and wakes every waiting reader at
+    once, in whatever process it waits, older frames are simply
+    overwritten. An optional bounded history keeps the last few frames for
+    readers that need a short look back.
+
+    producer (acquisition process):         reader (e.g. the parent):
+        if latest.wanted():                     current = latest.get(
+            out = latest.acquire()                  timeout=0.1, after=seen)
+            np.copyto(out, image)               if current is not None:
+            latest.commit()                         seen = current.sequence
+
+    There are history + 2 slots: the newest frame, the history behind it
+    and one more that the producer writes the next frame into without
+    holding the lock. Readers get copies, so the slots can be reused.
+'''
+
+
+class StampedFrame(NamedTuple):
+    frame: np.ndarray
+    sequence: int
+    timestamp: float
+
+    @property
+    def age(self) -> float:
+        '''
+        Seconds since the frame was published
+        '''
+        return time.time() - self.timestamp
+
+
+class LatestFrame:
+    '''
+    Shared-memory "latest frame" slot with optional bounded history. The
+        object can be passed to a Process as an argument, the child
+        attaches to the same shared memory block.
+    '''
+
+    def __init__(
+            self: 'LatestFrame',
+            shape: Tuple[int, ...],
+            dtype=np.uint8,
+            history: int = 0
+    ):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.history_length = max(0, history)
+        self.slots = self.history_length + 2
+
+        # publish time of every slot, then the frames
+        self._frames_offset = np.dtype(np.float64).itemsize * self.slots
+        frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._shm = SharedMemory(
+            create=True, size=self._frames_offset + frame_nbytes * self.slots)
+        self._owner = True
+
+        self._cond = Condition()
+        # sequence of the newest published frame, -1 before the first one;
+        # both only change under _cond
+        self._sequence = Value('q', -1, lock=False)
+        self._waiting = Value('i', 0, lock=False)
+        self._map()
+
+    def _map(self: 'LatestFrame'):
+        buf = self._shm.buf
+        self._timestamps = np.ndarray((self.slots,), dtype=np.float64, buffer=buf)
+        self._frames = np.ndarray(
+            (self.slots,) + self.shape, dtype=self.dtype, buffer=buf,
+            offset=self._frames_offset)
+
+    def __getstate__(self: 'LatestFrame'):
+        state = self.__dict__.copy()
+        # views into the block are rebuilt in the child after attaching
+        del state['_timestamps'], state['_frames']
+        state['_shm'] = self._shm.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self: 'LatestFrame', state):
+        self.__dict__.update(state)
+        self._shm = SharedMemory(name=state['_shm'])
+        self._map()
+
+    # producer side ----------------------------------------------------------
+
+    def wanted(self: 'LatestFrame') -> bool:
+        '''
+        True if somebody is waiting for a frame or history is kept, so the
+            producer can skip copying frames nobody will read
+        '''
+        return self._waiting.value > 0 or self.history_length > 0
+
+    def acquire(self: 'LatestFrame') -> np.ndarray:
+        '''
+        Slot to write the next frame into; no reader looks at it until
+            commit()
+        '''
+        return self._frames[(self._sequence.value + 1) % self.slots]
+
+    def commit(self: 'LatestFrame', timestamp: Optional[float] = None) -> int:
+        '''
+        Publish the frame written into acquire() and wake all readers
+        '''
+        with self._cond:
+            sequence = self._sequence.value + 1
+            self._timestamps[sequence % self.slots] = \
+                time.time() if timestamp is None else timestamp
+            self._sequence.value = sequence
+            self._cond.notify_all()
+            return sequence
+
+    def put(
+            self: 'LatestFrame',
+            frame: np.ndarray,
+            timestamp: Optional[float] = None
+    ) -> int:
+        '''
+        Copy frame into the slot and publish it
+        '''
+        np.copyto(self.acquire(), frame)
+        return self.commit(timestamp)
+
+    # reader side ------------------------------------------------------------
+
+    def _copy(self: 'LatestFrame', sequence: int) -> StampedFrame:
+        slot = sequence % self.slots
+        return StampedFrame(
+            self._frames[slot].copy(), sequence, float(self._timestamps[slot]))
+
+    def get(
+            self: 'LatestFrame',
+            timeout: Optional[float] = None,
+            after: int = -1
+    ) -> Optional[StampedFrame]:
+        '''
+        Return a copy of the latest frame with a sequence number greater
+            than after, waiting up to timeout for it to arrive. Returns None
+            on timeout.
+        '''
+        with self._cond:
+            self._waiting.value += 1
+            try:
+                if not self._cond.wait_for(
+                        lambda: self._sequence.value > after, timeout):
+                    return None
+            finally:
+                self._waiting.value -= 1
+            return self._copy(self._sequence.value)
+
+    def age(self: 'LatestFrame') -> Optional[float]:
+        '''
+        Age of the latest frame in seconds, None if there is none yet
+        '''
+        with self._cond:
+            sequence = self._sequence.value
+            if sequence < 0:
+                return None
+            return time.time() - float(self._timestamps[sequence % self.slots])
+
+    def history(self: 'LatestFrame') -> List[StampedFrame]:
+        '''
+        Copies of the last frames, oldest first, the latest included
+        '''
+        with self._cond:
+            last = self._sequence.value
+            first = max(0, last - self.history_length)
+            return [self._copy(sequence) for sequence in range(first, last + 1)]
+
+    def close(self: 'LatestFrame'):
+        '''
+        Detach from the shared memory; the process that created the slot
+            also unlinks it
+        '''
+        self._timestamps = self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
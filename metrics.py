@@ -0,0 +1,225 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Array
+from typing import Dict, Optional, Tuple
+
+from backpressure import FrameGate
+from frame_ring import FrameRing
+
+'''
+Metrics: Introduction
+    FPS, queue depth, dropped and incomplete buffers, exposure and save rate
+    of the running granulometer in the Prometheus text exposition format,
+    so throughput drops can be alerted on from outside.
+
+    The acquisition and saver processes write plain numbers into one
+    SharedMetrics block in shared memory (each metric has a single writing
+    process, so no lock is taken). The parent process renders them together
+    with the FrameGate counters and the ring depth, either
+
+        port - over HTTP on 127.0.0.1:port/metrics for Prometheus to scrape
+        path - into a file every interval seconds, e.g. for the textfile
+               collector of node_exporter; replaced atomically
+
+        metrics = SharedMetrics()               # before the processes start
+        metrics.add('frames_received_total')    # acquisition process
+        exporter = MetricsExporter(metrics, gate, ring, port=9108)
+        exporter.start()
+        ...
+        exporter.stop()
+
+    Rates (acquisition FPS, frames written per second) are computed by the
+    exporter from the counters between two renderings, so they fall to 0
+    when frames stop coming instead of keeping their last value.
+'''
+
+PREFIX = 'granulometr'
+
+# name, type, help
+METRICS: Tuple[Tuple[str, str, str], ...] = (
+    ('frames_received_total', 'counter', 'Buffers delivered by the camera'),
+    ('frames_incomplete_total', 'counter', 'Incomplete buffers, not used'),
+    ('frames_processed_total', 'counter', 'Frames taken from the ring by the saver'),
+    ('frames_written_total', 'counter', 'Frames written to disk'),
+    ('particles_total', 'counter', 'Particles measured'),
+    ('exposure_time_us', 'gauge', 'Current ExposureTime'),
+    ('gain_db', 'gauge', 'Current Gain'),
+    ('brightness', 'gauge', 'Mean brightness of the last frame, 0..255'),
+    ('save_every_nth', 'gauge', 'Current decimation of saved frames'),
+    ('last_frame_timestamp_seconds', 'gauge', 'Host time of the last received frame'),
+)
+
+# rate gauges computed by the exporter: name, counter, help
+RATES = (
+    ('acquisition_fps', 'frames_received_total', 'Frames per second from the camera'),
+    ('save_rate', 'frames_written_total', 'Frames written per second'),
+)
+
+# FrameGate counters exported with a reason label
+DROP_REASONS = ('dropped_newest', 'dropped_oldest', 'decimated')
+
+
+class SharedMetrics:
+    '''
+    Named counters and gauges in shared memory, written by the worker
+        processes and read by the exporter. Pass it to a Process like any
+        other argument.
+    '''
+
+    def __init__(
+            self: 'SharedMetrics',
+            definitions: Tuple[Tuple[str, str, str], ...] = METRICS
+    ):
+        self.definitions = definitions
+        self._index = {name: i for i, (name, _, _) in enumerate(definitions)}
+        self._values = Array('d', len(definitions), lock=False)
+
+    def add(self: 'SharedMetrics', name: str, value: float = 1.0):
+        self._values[self._index[name]] += value
+
+    def set(self: 'SharedMetrics', name: str, value: float):
+        self._values[self._index[name]] = value
+
+    def get(self: 'SharedMetrics', name: str) -> float:
+        return self._values[self._index[name]]
+
+    def values(self: 'SharedMetrics') -> Dict[str, float]:
+        return dict(zip(self._index, self._values[:]))
+
+
+def _line(name: str, value: float, labels: str = '') -> str:
+    return f'{PREFIX}_{name}{labels} {float(value)!r}\n'
+
+
+def _header(name: str, kind: str, help_text: str) -> str:
+    return (f'# HELP {PREFIX}_{name} {help_text}\n'
+            f'# TYPE {PREFIX}_{name} {kind}\n')
+
+
+class MetricsExporter:
+    '''
+    Text exposition of SharedMetrics over HTTP and/or into a file, served
+        from a background thread of the parent process
+    '''
+
+    def __init__(
+            self: 'MetricsExporter',
+            metrics: SharedMetrics,
+            gate: Optional[FrameGate] = None,
+            ring: Optional[FrameRing] = None,
+            port: Optional[int] = None,
+            path: Optional[str] = None,
+            interval: float = 5.0,
+            host: str = '127.0.0.1'
+    ):
+        self.metrics = metrics
+        self.gate = gate
+        self.ring = ring
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.host = host
+        self._lock = threading.Lock()
+        self._previous: Optional[Tuple[float, Dict[str, float]]] = None
+        self._rates = {name: 0.0 for name, _, _ in RATES}
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._threads = []
+        self._stop = threading.Event()
+
+    def render(self: 'MetricsExporter') -> str:
+        '''
+        Current metrics in the Prometheus text format
+        '''
+        now = time.monotonic()
+        values = self.metrics.values()
+        with self._lock:
+            # rates need a little time between renderings to be meaningful
+            if self._previous is None or now - self._previous[0] >= 1.0:
+                if self._previous is not None:
+                    elapsed = now - self._previous[0]
+                    for name, counter, _ in RATES:
+                        self._rates[name] = max(
+                            0.0, values[counter] - self._previous[1][counter]) / elapsed
+                self._previous = (now, values)
+            rates = dict(self._rates)
+
+        text = []
+        for name, kind, help_text in self.metrics.definitions:
+            text.append(_header(name, kind, help_text))
+            text.append(_line(name, values[name]))
+        for name, _, help_text in RATES:
+            text.append(_header(name, 'gauge', help_text))
+            text.append(_line(name, rates[name]))
+        if self.ring is not None:
+            text.append(_header('ring_depth', 'gauge', 'Frames waiting in or being handled from the ring'))
+            text.append(_line('ring_depth', self.ring.in_flight()))
+            text.append(_header('ring_slots', 'gauge', 'Size of the ring'))
+            text.append(_line('ring_slots', self.ring.slots))
+        if self.gate is not None:
+            counts = self.gate.counts()
+            text.append(_header('frames_admitted_total', 'counter', 'Frames given a ring slot'))
+            text.append(_line('frames_admitted_total', counts['admitted']))
+            text.append(_header('frames_dropped_total', 'counter', 'Frames that did not reach the saver'))
+            for reason in DROP_REASONS:
+                text.append(_line('frames_dropped_total', counts[reason], f'{{reason="{reason}"}}'))
+            text.append(_header('ring_blocked_seconds_total', 'counter', 'Time the producer waited for a slot'))
+            text.append(_line('ring_blocked_seconds_total', counts['blocked_us'] / 1e6))
+        return ''.join(text)
+
+    def write(self: 'MetricsExporter'):
+        '''
+        Replace path with the current metrics
+        '''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(tmp_path, self.path)
+
+    def start(self: 'MetricsExporter'):
+        if self.port is not None:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = exporter.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    # a scrape every few seconds is not worth a log line
+                    pass
+
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            # port=0 picks a free port
+            self.port = self._server.server_address[1]
+            self._threads.append(threading.Thread(
+                target=self._server.serve_forever, daemon=True))
+        if self.path is not None:
+            self._threads.append(threading.Thread(target=self._write_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _write_loop(self: 'MetricsExporter'):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def stop(self: 'MetricsExporter'):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.path is not None:
+            # the final counters stay readable after the run
+            self.write()
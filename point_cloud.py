@@ -0,0 +1,175 @@
+import math
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+'''
+Point cloud: Introduction
+    Helios frames in the Coord3D_ABCY16(s) formats hold four 16-bit channels
+    per pixel: x, y, z and intensity. adapter.view(buffer) gives them as a
+    zero-copy (height, width, 4) array; CoordinateScale turns raw values
+    into millimetres (raw * scale + offset, per coordinate, as read from
+    the Scan3dCoordinate* nodes) and tells which points are invalid:
+
+        unsigned - z == 65535, the value invalid points are filtered to
+        signed   - z == -32768 (x, y and z all are)
+
+    Points at z <= 0 mm carry no depth either and are left out as well.
+
+    PointCloudStats answers the per-frame questions of bed-height
+    monitoring in one vectorized pass: nearest and farthest valid point
+    with their pixel and x, y, intensity, and z percentiles. Work arrays are
+    allocated once per resolution.
+
+        scale = CoordinateScale.from_nodemap(device.nodemap, signed=False)
+        stats = PointCloudStats(scale, percentiles=(5, 50, 95))
+        result = stats.compute(adapter.view(buffer))
+        result.minimum.z, result.percentiles['P50']
+'''
+
+INVALID_UNSIGNED = 65535
+INVALID_SIGNED = -32768
+
+
+class CoordinateScale(NamedTuple):
+    scale_x: float = 0.25
+    scale_y: float = 0.25
+    scale_z: float = 0.25
+    offset_x: float = 0.0
+    offset_y: float = 0.0
+    offset_z: float = 0.0
+    signed: bool = False
+
+    @classmethod
+    def from_nodemap(cls, nodemap, signed: bool = False) -> 'CoordinateScale':
+        '''
+        Scales and offsets of coordinates A, B and C; changes
+            Scan3dCoordinateSelector
+        '''
+        values = {}
+        for axis, coordinate in (('x', 'CoordinateA'), ('y', 'CoordinateB'),
+                                 ('z', 'CoordinateC')):
+            nodemap['Scan3dCoordinateSelector'].value = coordinate
+            values[f'scale_{axis}'] = nodemap['Scan3dCoordinateScale'].value
+            values[f'offset_{axis}'] = nodemap['Scan3dCoordinateOffset'].value
+        return cls(signed=signed, **values)
+
+    @property
+    def invalid(self: 'CoordinateScale') -> int:
+        return INVALID_SIGNED if self.signed else INVALID_UNSIGNED
+
+    def valid(
+            self: 'CoordinateScale',
+            points: np.ndarray,
+            out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        '''
+        Boolean mask of the points with a depth, shape points.shape[:-1]
+        '''
+        z = points[..., 2]
+        out = np.not_equal(z, self.invalid, out=out)
+        if self.offset_z:
+            out &= z * self.scale_z + self.offset_z > 0
+        else:
+            out &= z > 0
+        return out
+
+    def to_mm(
+            self: 'CoordinateScale',
+            points: np.ndarray,
+            out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        '''
+        (..., 3) float32 x, y, z in millimetres; invalid points are not
+            masked
+        '''
+        if out is None:
+            out = np.empty(points.shape[:-1] + (3,), dtype=np.float32)
+        np.multiply(points[..., :3], (self.scale_x, self.scale_y, self.scale_z),
+                    out=out, casting='unsafe')
+        out += (self.offset_x, self.offset_y, self.offset_z)
+        return out
+
+
+class DepthPoint(NamedTuple):
+    row: int
+    column: int
+    x: float
+    y: float
+    z: float
+    intensity: int
+
+
+class DepthStats(NamedTuple):
+    valid: int                                  # points with a depth
+    minimum: Optional[DepthPoint]               # None without valid points
+    maximum: Optional[DepthPoint]
+    percentiles: Dict[str, float]               # 'P50': z in mm, nan if empty
+
+
+class PointCloudStats:
+    '''
+    Min, max and percentiles of z over the valid points of a frame
+    '''
+
+    def __init__(
+            self: 'PointCloudStats',
+            scale: CoordinateScale,
+            percentiles: Sequence[float] = (5, 50, 95)
+    ):
+        self.scale = scale
+        self.percentiles = tuple(percentiles)
+        self._shape: Optional[Tuple[int, ...]] = None
+
+    def _allocate(self: 'PointCloudStats', shape: Tuple[int, ...]):
+        self._shape = shape
+        self._valid = np.empty(shape, dtype=bool)
+        self._z = np.empty(shape, dtype=np.float32)
+        self._masked = np.empty(shape, dtype=np.float32)
+
+    def _point(
+            self: 'PointCloudStats',
+            points: np.ndarray,
+            flat_index: int
+    ) -> DepthPoint:
+        row, column = np.unravel_index(flat_index, self._shape)
+        x, y, z, intensity = points[row, column]
+        scale = self.scale
+        return DepthPoint(
+            int(row), int(column),
+            float(x * scale.scale_x + scale.offset_x),
+            float(y * scale.scale_y + scale.offset_y),
+            float(self._z[row, column]),
+            int(intensity))
+
+    def compute(self: 'PointCloudStats', points: np.ndarray) -> DepthStats:
+        '''
+        Statistics of one (height, width, 4) Coord3D_ABCY16(s) frame
+        '''
+        if points.shape[:-1] != self._shape:
+            self._allocate(points.shape[:-1])
+        scale = self.scale
+        # z only: x and y are needed at the two extremes, not everywhere
+        np.multiply(points[..., 2], scale.scale_z, out=self._z, casting='unsafe')
+        if scale.offset_z:
+            self._z += scale.offset_z
+        valid = scale.valid(points, out=self._valid)
+        count = int(np.count_nonzero(valid))
+        if not count:
+            return DepthStats(0, None, None,
+                              {f'P{p:g}': math.nan for p in self.percentiles})
+
+        # invalid points are pushed out of the way of argmin/argmax
+        np.copyto(self._masked, np.inf)
+        np.copyto(self._masked, self._z, where=valid)
+        minimum = int(np.argmin(self._masked))
+        np.copyto(self._masked, -np.inf, where=~valid)
+        maximum = int(np.argmax(self._masked))
+
+        values = np.percentile(self._z[valid], self.percentiles) \
+            if self.percentiles else ()
+        return DepthStats(
+            count,
+            self._point(points, minimum),
+            self._point(points, maximum),
+            {f'P{p:g}': float(value) for p, value in zip(self.percentiles, values)})
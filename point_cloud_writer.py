@@ -0,0 +1,229 @@
+import os
+import queue as queue_module
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from point_cloud import CoordinateScale
+from writers import FrameWriter
+
+'''
+Point cloud writer: Introduction
+    Recording Helios sequences without throttling acquisition. Writer.save()
+    of the Arena save library writes one PLY per buffer in the calling
+    thread; PointCloudWriter takes the points straight from the zero-copy
+    view of the buffer and leaves the file work to a background thread:
+
+        ply  - binary little endian PLY, one file per frame: float x, y, z
+               in mm, ushort intensity (ABCY formats) and uchar red, green,
+               blue if colours are given
+        npz  - frames_per_file frames per .npz (compressed by default), the
+               arrays of every frame under '<name>/xyz', '<name>/intensity',
+               '<name>/rgb', plus '<name>/timestamp'
+
+    write() is the only step in the caller's thread: it decimates (every
+    `step`-th pixel in both directions), converts to mm with
+    CoordinateScale, keeps only the valid points if valid_only, and copies
+    that into a compact array - after it returns the buffer can be
+    requeued. At most max_in_flight frames wait for the thread; when they
+    do, write() blocks, or with block=False drops the frame and counts it
+    in `dropped`. An error in the thread is raised by the next write() or
+    by close().
+
+        writer = PointCloudWriter('clouds', scale, kind='ply', step=2)
+        writer.write(adapter.view(buffer), f'{sequence:06d}', colors=rgb)
+        device.requeue_buffer(buffer)
+        ...
+        writer.close()
+'''
+
+PLY = 'ply'
+NPZ = 'npz'
+
+KINDS = (PLY, NPZ)
+
+
+class PointCloudWriter(FrameWriter):
+    '''
+    Batched binary PLY/NPZ point cloud writer with a background thread
+    '''
+
+    def __init__(
+            self: 'PointCloudWriter',
+            directory: str = 'clouds',
+            scale: CoordinateScale = CoordinateScale(),
+            kind: str = PLY,
+            step: int = 1,
+            valid_only: bool = True,
+            frames_per_file: int = 16,
+            compress: bool = True,
+            max_in_flight: int = 8
+    ):
+        if kind not in KINDS:
+            raise ValueError(f'Unknown point cloud format {kind}, expected one of {KINDS}')
+        super().__init__(directory)
+        self.extension = f'.{kind}'
+        self.scale = scale
+        self.kind = kind
+        self.step = max(1, step)
+        self.valid_only = valid_only
+        self.frames_per_file = max(1, frames_per_file)
+        self.compress = compress
+        self.dropped = 0
+        self._queue: queue_module.Queue = queue_module.Queue(maxsize=max(1, max_in_flight))
+        self._error: Optional[BaseException] = None
+        self._batch: List[tuple] = []
+        self._accepted = 0
+        self._first = ''
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _points(
+            self: 'PointCloudWriter',
+            points: np.ndarray,
+            colors: Optional[np.ndarray]
+    ) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        '''
+        Compact copies of xyz in mm, intensity and colours of the points to
+            keep
+        '''
+        if self.step > 1:
+            points = points[::self.step, ::self.step]
+            if colors is not None:
+                colors = colors[::self.step, ::self.step]
+        xyz = self.scale.to_mm(points)
+        intensity = points[..., 3].astype(np.uint16) if points.shape[-1] > 3 else None
+        if self.valid_only:
+            valid = self.scale.valid(points)
+            xyz = xyz[valid]
+            intensity = intensity[valid] if intensity is not None else None
+            colors = colors[valid] if colors is not None else None
+        else:
+            xyz = xyz.reshape(-1, 3)
+            intensity = intensity.reshape(-1) if intensity is not None else None
+            colors = colors.reshape(-1, 3).copy() if colors is not None else None
+        return xyz, intensity, colors
+
+    def write(
+            self: 'PointCloudWriter',
+            frame: np.ndarray,
+            name: str,
+            colors: Optional[np.ndarray] = None,
+            block: bool = True,
+            timestamp: Optional[float] = None,
+            **metadata
+    ) -> str:
+        '''
+        Queue one (height, width, 3 or 4) Coord3D frame, with optional
+            (height, width, 3) uint8 RGB colours. Returns the file the frame
+            goes to, or '' if it was dropped.
+        '''
+        self._raise()
+        # an npz file is named after the first frame of its batch
+        first = name if self._accepted % self.frames_per_file == 0 else self._first
+        item = (name, time.time() if timestamp is None else timestamp,
+                *self._points(frame, colors))
+        try:
+            self._queue.put(item, block=block)
+        except queue_module.Full:
+            self.dropped += 1
+            return ''
+        self._accepted += 1
+        self._first = first
+        return self.path(name if self.kind == PLY else first)
+
+    def _raise(self: 'PointCloudWriter'):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise IOError('Writing point clouds failed') from error
+
+    def _run(self: 'PointCloudWriter'):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    if self._batch:
+                        self._write_npz()
+                    return
+                if self._error is not None:
+                    # drain without writing until the caller sees the error
+                    continue
+                if self.kind == PLY:
+                    self._write_ply(*item)
+                else:
+                    self._batch.append(item)
+                    if len(self._batch) == self.frames_per_file:
+                        self._write_npz()
+            except BaseException as error:
+                self._error = error
+                self._batch = []
+            finally:
+                self._queue.task_done()
+
+    def _write_ply(
+            self: 'PointCloudWriter',
+            name: str,
+            timestamp: float,
+            xyz: np.ndarray,
+            intensity: Optional[np.ndarray],
+            colors: Optional[np.ndarray]
+    ):
+        fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+        header = ['ply', 'format binary_little_endian 1.0',
+                  f'comment name {name}', f'comment timestamp {timestamp!r}',
+                  f'element vertex {len(xyz)}',
+                  'property float x', 'property float y', 'property float z']
+        if intensity is not None:
+            fields.append(('intensity', '<u2'))
+            header.append('property ushort intensity')
+        if colors is not None:
+            fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+            header += ['property uchar red', 'property uchar green', 'property uchar blue']
+        header.append('end_header')
+
+        # one packed record per vertex, written with a single call
+        vertices = np.empty(len(xyz), dtype=np.dtype(fields))
+        vertices['x'], vertices['y'], vertices['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+        if intensity is not None:
+            vertices['intensity'] = intensity
+        if colors is not None:
+            vertices['red'], vertices['green'], vertices['blue'] = \
+                colors[:, 0], colors[:, 1], colors[:, 2]
+        path = self.path(name)
+        with open(path, 'wb') as ply_file:
+            ply_file.write(('\n'.join(header) + '\n').encode('ascii'))
+            vertices.tofile(ply_file)
+        self.frames_written += 1
+        self.bytes_written += os.path.getsize(path)
+
+    def _write_npz(self: 'PointCloudWriter'):
+        batch, self._batch = self._batch, []
+        arrays = {}
+        for name, timestamp, xyz, intensity, colors in batch:
+            arrays[f'{name}/xyz'] = xyz
+            arrays[f'{name}/timestamp'] = np.float64(timestamp)
+            if intensity is not None:
+                arrays[f'{name}/intensity'] = intensity
+            if colors is not None:
+                arrays[f'{name}/rgb'] = colors
+        path = self.path(batch[0][0])
+        (np.savez_compressed if self.compress else np.savez)(path, **arrays)
+        self.frames_written += len(batch)
+        self.bytes_written += os.path.getsize(path)
+
+    def in_flight(self: 'PointCloudWriter') -> int:
+        '''
+        Frames queued and not yet written
+        '''
+        return self._queue.unfinished_tasks
+
+    def close(self: 'PointCloudWriter'):
+        '''
+        Write what is queued and the last partial batch, stop the thread
+        '''
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
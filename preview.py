@@ -0,0 +1,123 @@
+import time
+from multiprocessing import Event, Process
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from frame_ring import FrameRing
+
+'''
+Preview: Introduction
+    cv2.imshow and cv2.waitKey inside the acquisition loop tie the rate at
+    which buffers are pulled and requeued to the GUI. Preview moves display
+    into its own process: the acquisition loop only offers frames, which are
+    rate limited to preview_fps, downscaled by striding and copied into a
+    small FrameRing. If the preview has not shown the previous frames yet
+    the new one is dropped, so acquisition never waits for the window.
+    The preview has the format of the main ring; the colour view of a
+    camera without Mono formats is converted to grey on the way in, as
+    BufferAdapter.copy_into does for the ring.
+    Status text (e.g. the exposure time while it settles) is drawn on the
+    small copy only, never on the frames that are analysed or saved.
+    Pressing Esc in the preview window sets stop_event.
+'''
+
+ESC_KEY = 27
+
+# colour views by channel count; RGB8 taken as BGR8 is good enough to look at
+_TO_GRAY = {3: cv2.COLOR_BGR2GRAY, 4: cv2.COLOR_BGRA2GRAY}
+
+
+def show_preview(
+        ring: FrameRing,
+        stop_event,
+        window: str
+):
+    '''
+    Preview process: show frames from the ring until it is stopped
+    '''
+    for index in ring.frames(timeout=0.1):
+        cv2.imshow(window, ring.frame(index))
+        ring.release(index)
+        if cv2.waitKey(1) == ESC_KEY:
+            stop_event.set()
+    cv2.destroyAllWindows()
+
+
+class Preview:
+    '''
+    Downscaled, rate-limited preview shown by a separate process
+    '''
+
+    def __init__(
+            self: 'Preview',
+            shape: Tuple[int, ...],
+            dtype=np.uint8,
+            fps: float = 15.0,
+            scale: int = 4,
+            window: str = 'Processed Frame',
+            stop_event=None
+    ):
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.scale = scale
+        self.window = window
+        self.stop_event = Event() if stop_event is None else stop_event
+        self.shown = 0
+        self.dropped = 0
+
+        # shape of frame[::scale, ::scale]
+        small_shape = tuple((n + scale - 1) // scale for n in shape[:2]) \
+            + tuple(shape[2:])
+        self._ring = FrameRing(2, small_shape, dtype)
+        self._process: Optional[Process] = None
+        self._last_offer = 0.0
+
+    def __getstate__(self: 'Preview'):
+        state = self.__dict__.copy()
+        state['_process'] = None
+        return state
+
+    def start(self: 'Preview'):
+        self._process = Process(
+            target=show_preview,
+            args=(self._ring, self.stop_event, self.window)
+        )
+        self._process.start()
+
+    def offer(
+            self: 'Preview',
+            frame: np.ndarray,
+            text: Optional[str] = None
+    ):
+        '''
+        Called from the acquisition loop for every frame; never blocks.
+            text is drawn on the preview copy.
+        '''
+        now = time.monotonic()
+        if now - self._last_offer < self.interval:
+            return
+        self._last_offer = now
+        index = self._ring.acquire(timeout=0)
+        if index is None:
+            self.dropped += 1
+            return
+        small = self._ring.frame(index)
+        strided = frame[::self.scale, ::self.scale]
+        if strided.ndim == 3 and small.ndim == 2:
+            cv2.cvtColor(strided, _TO_GRAY[strided.shape[2]], dst=small)
+        else:
+            np.copyto(small, strided)
+        # putText draws on 8-bit images only
+        if text and small.dtype == np.uint8:
+            color = (100, 255, 0) if small.ndim == 3 else (255, 255, 255)
+            cv2.putText(small, text, (5, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6,
+                        color, 1, cv2.LINE_AA)
+        self._ring.commit(index)
+        self.shown += 1
+
+    def stop(self: 'Preview'):
+        self._ring.stop(consumers=1, drain=False)
+        if self._process is not None:
+            self._process.join()
+        self._ring.close()
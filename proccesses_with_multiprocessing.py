@@ -1,18 +1,46 @@
+import os
 import time
-import ctypes
-import numpy as np
 from arena_api.system import system
-from arena_api.buffer import *
-from multiprocessing import Queue, Process
+from multiprocessing import Process
 import cv2
+import threading
 import traceback
+
+from analysis_pool import AnalysisPool
+from backpressure import DROP_NEWEST, FrameGate
+from buffer_adapter import BufferAdapter
+from frame_ring import FrameRing
+from granulometry import GranulometryAnalyzer
+from size_distribution import SizeDistribution
+from writers import create_writer
 '''
 Acquiring and Saving Images on Seperate Threads: Introduction
 	Saving images can sometimes create a bottleneck in the image acquisition
 	pipeline. By sperating saving onto a separate thread, this bottle neck can be
 	avoided. This example is programmed as a simple producer-consumer problem.
+	Frames are handed over through a FrameRing in shared memory, so only slot
+	indices are pickled between the processes. An AnalysisPool of NUM_WORKERS
+	processes converts, sizes and saves the frames, and the results come
+	back to this process in frame order.
 '''
 
+WIDTH = 1280
+HEIGHT = 720
+# only luminance is analysed, Mono8 is a third of BGR8 on the link and in
+# the ring
+PIXEL_FORMAT = 'Mono8'
+NUM_CHANNELS = 1
+RING_SLOTS = 8
+# see backpressure.POLICIES; every admitted frame is analysed, what the
+# workers cannot keep up with is dropped at once, acquisition never waits
+DROP_POLICY = DROP_NEWEST
+DROP_TIMEOUT = 0.0
+NUM_WORKERS = os.cpu_count() or 1
+# frames taken by workers but not yet handed on in order
+MAX_IN_FLIGHT = 2 * NUM_WORKERS
+WRITER_KIND = 'png'
+WRITER_OPTIONS = {}
+
 
 def create_device_with_tries():
 	'''
@@ -51,11 +79,11 @@ def setup(device):
     nodemap = device.nodemap
     nodes = nodemap.get_node(['Width', 'Height', 'PixelFormat'])
 
-    nodes['Width'].value = 1280
-    nodes['Height'].value = 720
-    nodes['PixelFormat'].value = 'BGR8'
+    nodes['Width'].value = WIDTH
+    nodes['Height'].value = HEIGHT
+    nodes['PixelFormat'].value = PIXEL_FORMAT
 
-    num_channels = 3
+    num_channels = NUM_CHANNELS
 
     # Stream nodemap
     tl_stream_nodemap = device.tl_stream_nodemap
@@ -67,30 +95,27 @@ def setup(device):
     return num_channels
 
 def process_frame(image):
+	if image.ndim == 2:
+		return image
 	processed_frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 	return processed_frame
 
-def get_multiple_images(queue):
+def get_multiple_images(ring, gate):
 	devices = create_device_with_tries()  
 	device = devices[0]
-	num_channels = setup(device)
+	setup(device)
+	adapter = BufferAdapter()
 	try:
 		with device.start_stream():
 			while True:
 				buffer = device.get_buffer()
 
-				item = BufferFactory.copy(buffer)
+				# the only copy of the frame goes straight into a ring slot
+				index = gate.acquire()
+				if index is not None:
+					adapter.copy_into(buffer, ring.frame(index))
+					ring.commit(index)
 				device.requeue_buffer(buffer)
-
-				buffer_bytes_per_pixel = int(len(item.data)/(item.width * item.height))
-				
-				array = (ctypes.c_ubyte * num_channels * item.width * item.height).from_address(ctypes.addressof(item.pbytes))
-				
-				npndarray = np.ndarray(buffer=array, dtype=np.uint8, shape=(item.height, item.width, buffer_bytes_per_pixel))
-				# npndarray = process_frame(npndarray)
-				# cv2.imshow('Lucid', npndarray)
-				queue.put(npndarray.copy())
-				BufferFactory.destroy(item)
 				
 				# добавляем кадр в очередь
 				# 
@@ -106,34 +131,65 @@ def get_multiple_images(queue):
 
 
 
-def save_image_buffers(queue, i):
-	
-	while True:
-		if not queue.empty():
-			image = queue.get()
-			processed_frame = process_frame(image)
-			cv2.imwrite(f'images/{i}_{int(time.time() * 1000)}.png', processed_frame)
-		# 	cv2.imshow('Processed Frame', processed_frame)
-		# if cv2.waitKey(1) & 0xFF == ord('q'):
-		# 	break
+class AnalyzeAndSave:
+	'''
+	Worker function of the pool: grayscale, particle sizing, saving. The
+		writer is created in the worker process on first use.
+	'''
+
+	def __init__(self):
+		self.analyzer = GranulometryAnalyzer()
+		self.writer = None
+
+	def __call__(self, frame, sequence, timestamp):
+		if self.writer is None:
+			self.writer = create_writer(WRITER_KIND, 'images', **WRITER_OPTIONS)
+		processed_frame = process_frame(frame)
+		self.writer.write(processed_frame, f'{sequence:08d}',
+						  frame_id=sequence, timestamp=timestamp)
+		return self.analyzer.analyze(processed_frame)
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
 
 
 def example_entry_point():
-	queue = Queue()
-	# get_multiple_images(queue)
+	ring = FrameRing(RING_SLOTS,
+				  *BufferAdapter().frame_spec(PIXEL_FORMAT, WIDTH, HEIGHT))
+	# get_multiple_images(ring)
 	
+	gate = FrameGate(ring, DROP_POLICY, timeout=DROP_TIMEOUT)
 	putting_process = Process(
 		target=get_multiple_images,
-	 	args=(queue, )
+	 	args=(ring, gate)
 	)
 	putting_process.start()
 
-	for i in range(2):
-		putting_process = Process(
-			target=save_image_buffers,
-			args=(queue, i,)
-		)
-		putting_process.start()
+	pool = AnalysisPool(ring, AnalyzeAndSave(), workers=NUM_WORKERS,
+						max_in_flight=MAX_IN_FLIGHT)
+	pool.start()
+
+	# workers drain the ring and exit once the producer is done
+	def stop_when_acquisition_ends():
+		putting_process.join()
+		ring.stop(consumers=pool.workers)
+	threading.Thread(target=stop_when_acquisition_ends, daemon=True).start()
+
+	distribution = SizeDistribution()
+	for sequence, timestamp, analysis in pool.results():
+		distribution.add(analysis.particles['equivalent_diameter'], timestamp)
+	pool.join()
+	ring.close()
+
+	print(f'{distribution.particles} particles, last minute: '
+		  f'{distribution.quantiles(60.0)}')
+	print(f'reorder buffer peak {pool.reorder_peak}, skipped {pool.skipped}')
+	print(f'frames: {gate.counts()}')
+	for worker, stats in pool.stats().items():
+		print(f'worker {worker}: {stats["frames"]} frames, '
+			  f'utilization {stats["utilization"]:.0%}, '
+			  f'blocked {stats["blocked"]:.2f} s')
 
 	# ERROR: ctypes objects containing pointers cannot be pickled
 	# while True:
@@ -12,13 +12,13 @@
 # -----------------------------------------------------------------------------
 
 from arena_api.system import system
-from arena_api.buffer import *
 
-import ctypes
-import numpy as np
 import cv2
 import time
 
+from buffer_adapter import BufferAdapter
+from frame_timing import RateMeter
+
 '''
 Live Stream: Introduction
     This example introduces the basics of running a live stream 
@@ -87,59 +87,47 @@ def example_entry_point():
     """
     demonstrates live stream
     (1) Start device stream
-    (2) Get a buffer and create a copy
-    (3) Requeue the buffer
-    (4) Calculate bytes per pixel for reshaping
-    (5) Create array from buffer cpointer data
-    (6) Create a NumPy array with the image shape
-    (7) Display the NumPy array using OpenCV
-    (8) When Esc is pressed, stop stream and destroy OpenCV windows
+    (2) Get a buffer
+    (3) Map the buffer data to a NumPy array without copying
+    (4) Display the NumPy array using OpenCV
+    (5) Requeue the buffer
+    (6) When Esc is pressed, stop stream and destroy OpenCV windows
     """
 
     devices = create_devices_with_tries()
     device = devices[0]
 
     # Setup
-    num_channels = setup(device)
+    setup(device)
+    adapter = BufferAdapter()
 
-    curr_frame_time = 0
-    prev_frame_time = 0
+    # FPS averaged over one second, and how long the previous frame took
+    # from get_buffer() until it was shown
+    rate = RateMeter(interval=1.0)
+    latency = 0.0
 
     with device.start_stream():
         """
         Infinitely fetch and display buffer data until esc is pressed
         """
         while True:
-            # Used to display FPS on stream
-            curr_frame_time = time.time()
-
             buffer = device.get_buffer()
+            received = time.perf_counter()
             """
-            Copy buffer and requeue to avoid running out of buffers
-            """
-            item = BufferFactory.copy(buffer)
-            device.requeue_buffer(buffer)
-
-            buffer_bytes_per_pixel = int(len(item.data)/(item.width * item.height))
-            """
-            Buffer data as cpointers can be accessed using buffer.pbytes
-            """
-            array = (ctypes.c_ubyte * num_channels * item.width * item.height).from_address(ctypes.addressof(item.pbytes))
-            """
-            Create a reshaped NumPy array to display using OpenCV
+            Map buffer data to a NumPy array with the image shape. The array
+            is a view of the buffer memory, it is only valid until requeue
             """
-            npndarray = np.ndarray(buffer=array, dtype=np.uint8, shape=(item.height, item.width, buffer_bytes_per_pixel))
+            npndarray = adapter.view(buffer)
             
-            fps = str(1/(curr_frame_time - prev_frame_time))
-            cv2.putText(npndarray, fps, (7, 70), cv2.FONT_HERSHEY_SIMPLEX, 3, (100, 255, 0), 3, cv2.LINE_AA)
+            fps = rate.tick(now=received)
+            cv2.putText(npndarray, f'{fps:.1f} fps {latency:.1f} ms', (7, 70), cv2.FONT_HERSHEY_SIMPLEX, 3, (100, 255, 0), 3, cv2.LINE_AA)
 
             cv2.imshow('Lucid', npndarray)
+            latency = (time.perf_counter() - received) * 1000.0
             """
-            Destroy the copied item to prevent memory leaks
+            Requeue the buffer once the frame has been displayed
             """
-            BufferFactory.destroy(item)
-
-            prev_frame_time = curr_frame_time
+            device.requeue_buffer(buffer)
 
             """
             Break if esc key is pressed
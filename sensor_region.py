@@ -0,0 +1,196 @@
+import math
+from typing import NamedTuple, Optional, Tuple
+
+'''
+Sensor region: Introduction
+    Only the part of the belt that is measured has to cross the link. The
+    camera crops (OffsetX/OffsetY/Width/Height) and bins on the sensor, so
+    a smaller region or a coarser resolution means fewer bytes per frame
+    and more frames per second.
+
+        roi                 - measured region (x, y, width, height) in full
+                              sensor pixels, None for the whole sensor
+        target_resolution   - (width, height) the analysis needs at least;
+                              the largest binning that still gives it is used
+
+    plan_region() turns those into node values, aligned to the node
+    increments so that the region still covers the whole ROI. It works on a
+    SensorGeometry, which lets the parent process size the FrameRing before
+    the camera is opened; apply_region() then writes the nodes in the order
+    the camera accepts them and checks every value against the node's real
+    min, max and increment. Offsets and sizes are in binned pixels, as the
+    Width/Height nodes are once binning is on.
+
+    packet_size sets DeviceStreamChannelPacketSize: 'max' for jumbo frames
+    (the NIC has to allow them), a number of bytes, or None to leave it.
+'''
+
+
+class SensorGeometry(NamedTuple):
+    width: int = 1936
+    height: int = 1464
+    width_min: int = 64
+    height_min: int = 64
+    width_inc: int = 8
+    height_inc: int = 8
+    offset_x_inc: int = 8
+    offset_y_inc: int = 8
+    max_binning: int = 4
+
+    @classmethod
+    def from_nodemap(cls, nodemap) -> 'SensorGeometry':
+        '''
+        Geometry reported by the camera; binning must be 1 while reading it
+        '''
+        nodes = nodemap.get_node([
+            'SensorWidth', 'SensorHeight', 'Width', 'Height', 'OffsetX',
+            'OffsetY', 'BinningHorizontal', 'BinningVertical'])
+        binning = nodes['BinningHorizontal']
+        return cls(
+            width=nodes['SensorWidth'].value,
+            height=nodes['SensorHeight'].value,
+            width_min=nodes['Width'].min,
+            height_min=nodes['Height'].min,
+            width_inc=nodes['Width'].inc,
+            height_inc=nodes['Height'].inc,
+            offset_x_inc=nodes['OffsetX'].inc,
+            offset_y_inc=nodes['OffsetY'].inc,
+            max_binning=min(binning.max, nodes['BinningVertical'].max)
+            if binning is not None else 1,
+        )
+
+
+class SensorRegion(NamedTuple):
+    offset_x: int
+    offset_y: int
+    width: int
+    height: int
+    binning: int = 1
+
+
+def _axis(
+        start: int,
+        size: int,
+        binning: int,
+        full: int,
+        size_min: int,
+        size_inc: int,
+        offset_inc: int
+) -> Tuple[int, int]:
+    '''
+    Offset and size on one axis, in binned pixels, covering
+        [start, start + size) of the sensor
+    '''
+    limit = full // binning
+    limit -= (limit - size_min) % size_inc
+    first = start // binning
+    last = math.ceil((start + size) / binning)
+    offset = first - first % offset_inc
+    length = max(size_min, last - offset)
+    length += -(length - size_min) % size_inc
+    if length > limit:
+        raise ValueError(f'{size} pixels at binning {binning} do not fit the '
+                         f'sensor ({limit} binned pixels)')
+    if offset + length > limit:
+        # shift back so the region stays on the sensor and still covers ROI
+        offset = limit - length
+        offset -= offset % offset_inc
+    return offset, length
+
+
+def plan_region(
+        geometry: SensorGeometry = SensorGeometry(),
+        roi: Optional[Tuple[int, int, int, int]] = None,
+        target_resolution: Optional[Tuple[int, int]] = None
+) -> SensorRegion:
+    '''
+    Node values for the smallest transfer that covers roi at no less than
+        target_resolution
+    '''
+    x, y, width, height = roi if roi is not None else (0, 0, geometry.width, geometry.height)
+    if width <= 0 or height <= 0 or x < 0 or y < 0 \
+            or x + width > geometry.width or y + height > geometry.height:
+        raise ValueError(f'ROI {roi} is outside the {geometry.width}x'
+                         f'{geometry.height} sensor')
+
+    binning = 1
+    if target_resolution is not None:
+        target_width, target_height = target_resolution
+        if target_width > width or target_height > height:
+            raise ValueError(f'Target resolution {target_resolution} is larger '
+                             f'than the ROI {width}x{height}')
+        binning = max(b for b in range(1, geometry.max_binning + 1)
+                      if width // b >= target_width and height // b >= target_height)
+
+    offset_x, region_width = _axis(x, width, binning, geometry.width, geometry.width_min,
+                                   geometry.width_inc, geometry.offset_x_inc)
+    offset_y, region_height = _axis(y, height, binning, geometry.height, geometry.height_min,
+                                    geometry.height_inc, geometry.offset_y_inc)
+    return SensorRegion(offset_x, offset_y, region_width, region_height, binning)
+
+
+def _set(node, name: str, value):
+    '''
+    Write a node after checking it against its limits and increment, with
+        a message that names the node
+    '''
+    if node is None:
+        raise ValueError(f'Node {name} not found')
+    if not node.is_writable:
+        raise ValueError(f'Node {name} is not writable')
+    if isinstance(value, int):
+        if not node.min <= value <= node.max:
+            raise ValueError(f'{name} = {value} is outside [{node.min}, {node.max}]')
+        inc = getattr(node, 'inc', 1) or 1
+        if (value - node.min) % inc:
+            raise ValueError(f'{name} = {value} is not {node.min} + k * {inc}')
+    node.value = value
+
+
+def apply_region(
+        nodemap,
+        region: SensorRegion,
+        binning_mode: str = 'Average',
+        packet_size='max'
+) -> SensorRegion:
+    '''
+    Configure binning, ROI and packet size and return the region the camera
+        reports back
+    '''
+    nodes = nodemap.get_node([
+        'BinningSelector', 'BinningHorizontalMode', 'BinningVerticalMode',
+        'BinningHorizontal', 'BinningVertical', 'OffsetX', 'OffsetY', 'Width',
+        'Height', 'DeviceStreamChannelPacketSize'])
+
+    if nodes['BinningHorizontal'] is not None:
+        if nodes['BinningSelector'] is not None and nodes['BinningSelector'].is_writable:
+            nodes['BinningSelector'].value = 'Digital'
+        # Average keeps the brightness, Sum multiplies it by the bin size
+        for name in ('BinningHorizontalMode', 'BinningVerticalMode'):
+            if nodes[name] is not None and nodes[name].is_writable:
+                nodes[name].value = binning_mode
+        _set(nodes['BinningHorizontal'], 'BinningHorizontal', region.binning)
+        _set(nodes['BinningVertical'], 'BinningVertical', region.binning)
+    elif region.binning != 1:
+        raise ValueError('The camera has no binning nodes')
+
+    # offsets first to 0, so that any Width/Height up to the maximum fits
+    _set(nodes['OffsetX'], 'OffsetX', 0)
+    _set(nodes['OffsetY'], 'OffsetY', 0)
+    _set(nodes['Width'], 'Width', region.width)
+    _set(nodes['Height'], 'Height', region.height)
+    _set(nodes['OffsetX'], 'OffsetX', region.offset_x)
+    _set(nodes['OffsetY'], 'OffsetY', region.offset_y)
+
+    packet = nodes['DeviceStreamChannelPacketSize']
+    if packet_size is not None and packet is not None and packet.is_writable:
+        if packet_size == 'max':
+            value = packet.max
+        else:
+            value = min(max(int(packet_size), packet.min), packet.max)
+            value -= (value - packet.min) % (getattr(packet, 'inc', 1) or 1)
+        _set(packet, 'DeviceStreamChannelPacketSize', value)
+
+    binning = nodes['BinningHorizontal'].value if nodes['BinningHorizontal'] is not None else 1
+    return SensorRegion(nodes['OffsetX'].value, nodes['OffsetY'].value,
+                        nodes['Width'].value, nodes['Height'].value, binning)
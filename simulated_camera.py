@@ -0,0 +1,501 @@
+import ctypes
+import time
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from buffer_adapter import PIXEL_FORMATS, BufferAdapter
+
+'''
+Simulated camera: Introduction
+    Synthetic frames for running and profiling the pipeline without a Lucid
+    camera. SyntheticFrameSource renders a small pool of granular scenes
+    (bright grains of random size on a darker belt) in the requested pixel
+    format once, and then hands them out as buffer-like objects with the
+    attributes BufferAdapter reads (pdata, width, height, pixel_format), at
+    a target frame rate or as fast as the consumer asks for them.
+    ReplayFrameSource does the same with recorded frames.
+
+    SimulatedSystem / SimulatedDevice stand in for arena_api.system and a
+    Lucid device, with the nodes the pipeline uses (Width, Height,
+    PixelFormat, ExposureAuto, ExposureTime, Gain, ...) and the stream
+    nodemap. ExposureTime and Gain scale the frame brightness, so the
+    exposure loop converges against it like against a real camera:
+
+        camera = Camera(simulated=True)
+        camera.simulation_options = {'replay': 'images/1690000000000.frames'}
+        camera.start_camera()
+'''
+
+
+def generate_granular_scene(
+        width: int,
+        height: int,
+        grains: int = 400,
+        min_diameter: float = 4.0,
+        max_diameter: float = 60.0,
+        seed: Optional[int] = None
+) -> np.ndarray:
+    '''
+    Reflectance map in 0..1 (float32, height x width): grains with a
+        log-uniform size distribution on a textured belt
+    '''
+    rng = np.random.default_rng(seed)
+    scene = np.full((height, width), 0.15, dtype=np.float32)
+    scene += rng.normal(0.0, 0.02, size=(height, width)).astype(np.float32)
+
+    diameters = np.exp(rng.uniform(np.log(min_diameter), np.log(max_diameter), grains))
+    centers_x = rng.uniform(0, width, grains)
+    centers_y = rng.uniform(0, height, grains)
+    angles = rng.uniform(0, 180, grains)
+    aspects = rng.uniform(0.6, 1.0, grains)
+    shades = rng.uniform(0.45, 0.9, grains)
+    for x, y, d, angle, aspect, shade in zip(
+            centers_x, centers_y, diameters, angles, aspects, shades):
+        axes = (max(1, int(d / 2)), max(1, int(d * aspect / 2)))
+        cv2.ellipse(scene, (int(x), int(y)), axes, float(angle), 0, 360,
+                    float(shade), thickness=-1)
+    return np.clip(scene, 0.0, 1.0)
+
+
+def render_frame(
+        scene: np.ndarray,
+        pixel_format: str,
+        gain: float = 1.0
+) -> np.ndarray:
+    '''
+    Raw payload bytes (uint8, 1-D) of the scene in pixel_format; gain scales
+        brightness like exposure time does, the sensor saturates at full scale
+    '''
+    info = PIXEL_FORMATS[pixel_format]
+    height, width = scene.shape
+    if info.unpack is not None:
+        # packed formats only matter for throughput, content is not unpacked
+        # back into an image here
+        nbytes = width * height * info.bits_per_pixel // 8
+        level = np.clip(scene.mean() * gain, 0.0, 1.0)
+        return np.full(nbytes, int(level * 255), dtype=np.uint8)
+
+    full_scale = np.iinfo(info.dtype).max
+    if pixel_format in ('Mono10', 'Mono12'):
+        full_scale = (1 << int(pixel_format[4:])) - 1
+    values = np.clip(scene * (gain * full_scale), 0, full_scale).astype(info.dtype)
+    if info.channels > 1:
+        values = np.repeat(values[:, :, None], info.channels, axis=2)
+    return np.ascontiguousarray(values).view(np.uint8).ravel()
+
+
+class SyntheticBuffer:
+    '''
+    Stand-in for an Arena buffer over a NumPy payload
+    '''
+
+    def __init__(
+            self: 'SyntheticBuffer',
+            payload: np.ndarray,
+            width: int,
+            height: int,
+            pixel_format: str,
+            frame_id: int = 0
+    ):
+        self._payload = payload
+        self.pdata = payload.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.bits_per_pixel = PIXEL_FORMATS[pixel_format].bits_per_pixel
+        self.frame_id = frame_id
+        self.timestamp_ns = time.time_ns()
+        self.is_incomplete = False
+
+
+class SyntheticFrameSource:
+    '''
+    Paced source of SyntheticBuffer frames cycling over a pre-rendered pool
+    '''
+
+    def __init__(
+            self: 'SyntheticFrameSource',
+            width: int = 1936,
+            height: int = 1464,
+            pixel_format: str = 'BGR8',
+            fps: float = 0.0,
+            pool: int = 8,
+            gain: float = 1.0,
+            seed: int = 0
+    ):
+        if pixel_format not in PIXEL_FORMATS:
+            raise ValueError(f'Pixel format {pixel_format} is not supported')
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.fps = fps
+        self.frames_generated = 0
+        self._scenes: List[np.ndarray] = [
+            generate_granular_scene(width, height, seed=seed + i) for i in range(pool)]
+        self._gain = gain
+        self._payloads: List[np.ndarray] = []
+        self._next_deadline: Optional[float] = None
+
+    @property
+    def gain(self: 'SyntheticFrameSource') -> float:
+        return self._gain
+
+    @gain.setter
+    def gain(self: 'SyntheticFrameSource', value: float):
+        if value != self._gain:
+            self._gain = value
+            # re-rendered lazily, only when the brightness actually changes
+            self._payloads = []
+
+    def frame_spec(self: 'SyntheticFrameSource'):
+        return BufferAdapter().frame_spec(self.pixel_format, self.width, self.height)
+
+    def get_buffer(self: 'SyntheticFrameSource') -> SyntheticBuffer:
+        '''
+        Next frame; waits for the next frame period when fps is set
+        '''
+        if self.fps > 0:
+            now = time.perf_counter()
+            if self._next_deadline is None:
+                self._next_deadline = now
+            elif now < self._next_deadline:
+                time.sleep(self._next_deadline - now)
+            self._next_deadline = max(self._next_deadline, now - 1.0 / self.fps) \
+                + 1.0 / self.fps
+        if not self._payloads:
+            self._payloads = [render_frame(scene, self.pixel_format, self._gain)
+                              for scene in self._scenes]
+        payload = self._payloads[self.frames_generated % len(self._payloads)]
+        buffer = SyntheticBuffer(payload, self.width, self.height,
+                                 self.pixel_format, self.frames_generated)
+        self.frames_generated += 1
+        return buffer
+
+
+class ReplayFrameSource:
+    '''
+    Replays recorded frames (a .frames archive, a .npy stack or a list of
+        image files) in a loop, in the same interface as SyntheticFrameSource.
+        With region (offset_x, offset_y, width, height, binning) the frames
+        are cropped and binned like the sensor would do.
+    '''
+
+    def __init__(
+            self: 'ReplayFrameSource',
+            recording,
+            pixel_format: str = 'BGR8',
+            fps: float = 0.0,
+            gain: float = 1.0,
+            region: Optional[tuple] = None
+    ):
+        self._frames, self.recorded_exposure = load_recording(recording)
+        if len(self._frames) == 0:
+            raise ValueError(f'Recording {recording} has no frames')
+        self.height, self.width = self._frames[0].shape[:2]
+        self.region = region
+        if region is not None:
+            offset_x, offset_y, width, height, binning = region
+            if (offset_x + width) * binning > self.width \
+                    or (offset_y + height) * binning > self.height:
+                raise ValueError(f'Region {region} is outside the recorded '
+                                 f'{self.width}x{self.height} frames')
+            self.width, self.height = width, height
+        self.pixel_format = pixel_format
+        self.fps = fps
+        self.gain = gain
+        self.frames_generated = 0
+        self._next_deadline: Optional[float] = None
+
+    def frame_spec(self: 'ReplayFrameSource'):
+        return BufferAdapter().frame_spec(self.pixel_format, self.width, self.height)
+
+    def get_buffer(self: 'ReplayFrameSource') -> SyntheticBuffer:
+        if self.fps > 0:
+            now = time.perf_counter()
+            if self._next_deadline is None:
+                self._next_deadline = now
+            elif now < self._next_deadline:
+                time.sleep(self._next_deadline - now)
+            self._next_deadline = max(self._next_deadline, now - 1.0 / self.fps) \
+                + 1.0 / self.fps
+        frame = np.asarray(self._frames[self.frames_generated % len(self._frames)])
+        if self.region is not None:
+            offset_x, offset_y, width, height, binning = self.region
+            frame = frame[offset_y * binning:(offset_y + height) * binning,
+                          offset_x * binning:(offset_x + width) * binning]
+            if binning > 1:
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        info = PIXEL_FORMATS[self.pixel_format]
+        if info.channels == 1 and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        elif info.channels == 3 and frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if self.gain != 1.0:
+            full_scale = np.iinfo(frame.dtype).max
+            frame = np.clip(frame * self.gain, 0, full_scale).astype(frame.dtype)
+        payload = np.ascontiguousarray(frame.astype(info.dtype, copy=False)).view(np.uint8).ravel()
+        buffer = SyntheticBuffer(payload, self.width, self.height,
+                                 self.pixel_format, self.frames_generated)
+        self.frames_generated += 1
+        return buffer
+
+
+def load_recording(recording):
+    '''
+    Frames and the exposure they were recorded with (nan if unknown)
+    '''
+    if isinstance(recording, (list, tuple)):
+        return [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in recording], float('nan')
+    if recording.endswith('.frames'):
+        # imported here: frame_archive is only needed for replays
+        from frame_archive import FrameArchive
+        archive = FrameArchive(recording)
+        exposures = archive.index['exposure']
+        exposure = float(np.nanmedian(exposures)) \
+            if len(exposures) and not np.isnan(exposures).all() else float('nan')
+        return archive.frames, exposure
+    if recording.endswith('.npy'):
+        return np.load(recording, mmap_mode='r'), float('nan')
+    raise ValueError(f'Unknown recording type: {recording}')
+
+
+class SimulatedNode:
+    '''
+    GenICam-like node: value with optional limits, increment and enum
+        entries; writes outside of them raise ValueError like Arena does
+    '''
+
+    def __init__(
+            self: 'SimulatedNode',
+            name: str,
+            value,
+            min=None,
+            max=None,
+            inc=None,
+            entries: Optional[List[str]] = None,
+            writable: bool = True
+    ):
+        self.name = name
+        self.min = min
+        self.max = max
+        self.inc = inc
+        self.enumentry_names = entries
+        self.is_readable = True
+        self.is_writable = writable
+        self._value = value
+        self._listeners = []
+
+    @property
+    def value(self: 'SimulatedNode'):
+        return self._value
+
+    @value.setter
+    def value(self: 'SimulatedNode', value):
+        if not self.is_writable:
+            raise ValueError(f'Node {self.name} is not writable')
+        # PixelFormat may be set with an arena_api enum member
+        value = getattr(value, 'name', value)
+        if self.enumentry_names is not None and value not in self.enumentry_names:
+            raise ValueError(f'{value} is not an entry of {self.name}')
+        if self.min is not None and value < self.min \
+                or self.max is not None and value > self.max:
+            raise ValueError(f'{self.name} = {value} is outside '
+                             f'[{self.min}, {self.max}]')
+        if self.inc is not None and (value - (self.min or 0)) % self.inc:
+            raise ValueError(f'{self.name} = {value} is not a multiple of '
+                             f'the increment {self.inc}')
+        self._value = value
+        for listener in self._listeners:
+            listener(self)
+
+    def add_listener(self: 'SimulatedNode', listener):
+        self._listeners.append(listener)
+
+
+class SimulatedNodeMap:
+    def __init__(self: 'SimulatedNodeMap', nodes: List[SimulatedNode]):
+        self._nodes = {node.name: node for node in nodes}
+
+    def __getitem__(self: 'SimulatedNodeMap', name: str) -> SimulatedNode:
+        return self._nodes[name]
+
+    def __contains__(self: 'SimulatedNodeMap', name: str) -> bool:
+        return name in self._nodes
+
+    def get_node(self: 'SimulatedNodeMap', names):
+        if isinstance(names, str):
+            return self._nodes.get(names)
+        return {name: self._nodes.get(name) for name in names}
+
+
+class SimulatedDevice:
+    '''
+    Drop-in for an arena_api Device: nodemap, tl_stream_nodemap,
+        start_stream/stop_stream, get_buffer/requeue_buffer. Frames are
+        synthetic granular scenes or a replayed recording, ExposureTime and
+        Gain change their brightness.
+    '''
+
+    def __init__(
+            self: 'SimulatedDevice',
+            sensor_width: int = 1936,
+            sensor_height: int = 1464,
+            fps: float = 30.0,
+            replay=None,
+            reference_exposure: float = 8000.0,
+            pool: int = 4,
+            seed: int = 0
+    ):
+        self.replay = replay
+        self.reference_exposure = reference_exposure
+        self.pool = pool
+        self.seed = seed
+        self.nodemap = SimulatedNodeMap([
+            SimulatedNode('DeviceModelName', 'Simulated TRI028S', writable=False),
+            SimulatedNode('SensorWidth', sensor_width, writable=False),
+            SimulatedNode('SensorHeight', sensor_height, writable=False),
+            SimulatedNode('WidthMax', sensor_width, writable=False),
+            SimulatedNode('HeightMax', sensor_height, writable=False),
+            SimulatedNode('Width', sensor_width, 64, sensor_width, 8),
+            SimulatedNode('Height', sensor_height, 64, sensor_height, 8),
+            SimulatedNode('OffsetX', 0, 0, sensor_width - 64, 8),
+            SimulatedNode('OffsetY', 0, 0, sensor_height - 64, 8),
+            SimulatedNode('PixelFormat', 'BGR8', entries=sorted(PIXEL_FORMATS)),
+            SimulatedNode('BinningSelector', 'Digital', entries=['Digital', 'Sensor']),
+            SimulatedNode('BinningHorizontal', 1, 1, 4, 1),
+            SimulatedNode('BinningVertical', 1, 1, 4, 1),
+            SimulatedNode('BinningHorizontalMode', 'Sum', entries=['Sum', 'Average']),
+            SimulatedNode('BinningVerticalMode', 'Sum', entries=['Sum', 'Average']),
+            SimulatedNode('ExposureAuto', 'Continuous',
+                          entries=['Off', 'Once', 'Continuous']),
+            SimulatedNode('ExposureTime', 20000.0, 20.0, 1000000.0),
+            SimulatedNode('GainAuto', 'Continuous', entries=['Off', 'Once', 'Continuous']),
+            SimulatedNode('Gain', 0.0, 0.0, 48.0),
+            SimulatedNode('AcquisitionFrameRateEnable', True),
+            SimulatedNode('AcquisitionFrameRate', fps, 1.0, 200.0),
+            SimulatedNode('DeviceStreamChannelPacketSize', 1500, 576, 9000, 4),
+        ])
+        self.tl_stream_nodemap = SimulatedNodeMap([
+            SimulatedNode('StreamBufferHandlingMode', 'OldestFirst',
+                          entries=['OldestFirst', 'OldestFirstOverwrite', 'NewestOnly']),
+            SimulatedNode('StreamAutoNegotiatePacketSize', False),
+            SimulatedNode('StreamPacketResendEnable', False),
+        ])
+        for name in ('ExposureTime', 'Gain'):
+            self.nodemap[name].add_listener(self._update_gain)
+        for name in ('Width', 'Height', 'OffsetX', 'OffsetY',
+                     'BinningHorizontal', 'BinningVertical'):
+            self.nodemap[name].add_listener(self._update_limits)
+        self._update_limits(None)
+        self._source = None
+        self._outstanding = 0
+
+    def __str__(self: 'SimulatedDevice') -> str:
+        return f'{self.nodemap["DeviceModelName"].value} (simulated)'
+
+    def _brightness_gain(self: 'SimulatedDevice') -> float:
+        exposure = self.nodemap['ExposureTime'].value
+        gain = 10 ** (self.nodemap['Gain'].value / 20.0)
+        if self.replay is not None and self._source is not None \
+                and not np.isnan(self._source.recorded_exposure):
+            return exposure / self._source.recorded_exposure * gain
+        if self.replay is not None:
+            return gain
+        return exposure / self.reference_exposure * gain
+
+    def _update_limits(self: 'SimulatedDevice', node: SimulatedNode):
+        '''
+        Like on the camera: with binning Width/Height count binned pixels,
+            and size + offset never exceed the maximum
+        '''
+        for axis, size, offset, binning, sensor in (
+                ('Width', 'Width', 'OffsetX', 'BinningHorizontal', 'SensorWidth'),
+                ('Height', 'Height', 'OffsetY', 'BinningVertical', 'SensorHeight')):
+            size_node, offset_node = self.nodemap[size], self.nodemap[offset]
+            limit = self.nodemap[sensor].value // self.nodemap[binning].value
+            limit -= (limit - size_node.min) % size_node.inc
+            self.nodemap[f'{axis}Max']._value = limit
+            # the camera shrinks what no longer fits instead of failing
+            if size_node.value > limit:
+                size_node._value = limit
+            if offset_node.value + size_node.value > limit:
+                offset_node._value = 0
+            size_node.max = limit - offset_node.value
+            offset_node.max = limit - size_node.value
+
+    def _update_gain(self: 'SimulatedDevice', node: SimulatedNode):
+        if self._source is not None:
+            self._source.gain = self._brightness_gain()
+
+    def start_stream(self: 'SimulatedDevice', number_of_buffers: int = 10):
+        fps = self.nodemap['AcquisitionFrameRate'].value \
+            if self.nodemap['AcquisitionFrameRateEnable'].value else 0.0
+        region = tuple(self.nodemap[name].value for name in (
+            'OffsetX', 'OffsetY', 'Width', 'Height', 'BinningHorizontal'))
+        pixel_format = self.nodemap['PixelFormat'].value
+        if self.replay is not None:
+            self._source = ReplayFrameSource(self.replay, pixel_format, fps, region=region)
+            print(f'Replaying {self.replay}: '
+                  f'{self._source.width}x{self._source.height}')
+        else:
+            self._source = SyntheticFrameSource(
+                region[2], region[3], pixel_format,
+                fps=fps, pool=self.pool, seed=self.seed)
+        self._source.gain = self._brightness_gain()
+        return _StreamContext(self)
+
+    def stop_stream(self: 'SimulatedDevice'):
+        self._source = None
+
+    def get_buffer(
+            self: 'SimulatedDevice',
+            number: Optional[int] = None,
+            timeout: Optional[int] = None
+    ):
+        if self._source is None:
+            raise RuntimeError('Stream is not started')
+        if number is None:
+            self._outstanding += 1
+            return self._source.get_buffer()
+        self._outstanding += number
+        return [self._source.get_buffer() for _ in range(number)]
+
+    def requeue_buffer(self: 'SimulatedDevice', buffers):
+        self._outstanding -= len(buffers) if isinstance(buffers, list) else 1
+
+
+class _StreamContext:
+    '''
+    Returned by start_stream so it works both as a call and as a with block,
+        like in arena_api
+    '''
+
+    def __init__(self: '_StreamContext', device: SimulatedDevice):
+        self._device = device
+
+    def __enter__(self: '_StreamContext'):
+        return self._device
+
+    def __exit__(self: '_StreamContext', *exc_info):
+        self._device.stop_stream()
+
+
+class SimulatedSystem:
+    '''
+    Stand-in for arena_api.system.system
+    '''
+
+    def __init__(self: 'SimulatedSystem', devices: int = 1, **device_options):
+        self._count = devices
+        self._device_options = device_options
+        self._devices: List[SimulatedDevice] = []
+
+    def create_device(self: 'SimulatedSystem') -> List[SimulatedDevice]:
+        self._devices = [SimulatedDevice(seed=i, **self._device_options)
+                         for i in range(self._count)]
+        return self._devices
+
+    def destroy_device(self: 'SimulatedSystem', device=None):
+        self._devices = []
@@ -0,0 +1,244 @@
+import json
+import math
+import os
+import time
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+'''
+Size distribution: Introduction
+    Running grain-size statistics over sliding time windows without keeping
+    the particles. Every window is a ring of time buckets, each bucket a
+    histogram over the same size classes; the window total is kept up to
+    date by adding the new frame and subtracting buckets as they expire, so
+    the memory is windows x buckets x classes whatever the particle rate.
+
+    Size classes come from one of two modes:
+
+        fixed   - bin_edges given (default: the sqrt(2) classes of
+                  granulometry.py); quantiles are interpolated inside the
+                  class
+        sketch  - log classes gamma**i with gamma = (1 + a) / (1 - a), the
+                  bucketing of a DDSketch: every quantile between min_size
+                  and max_size is within relative_accuracy a of the exact
+                  one. Classes are fixed, so sketches of buckets add and
+                  subtract exactly.
+
+    Sizes below the first or above the last edge are counted in under- and
+    overflow classes. Particles can be weighted by count, area or volume
+    (d ** 2, d ** 3): D50 by volume is the usual sieve-equivalent median.
+
+        distribution = SizeDistribution(windows=(10, 60, 3600), mode='sketch')
+        distribution.add(analysis.particles['equivalent_diameter'], timestamp)
+        distribution.quantiles(60)      # {'D10': ..., 'D50': ..., 'D90': ...}
+'''
+
+FIXED = 'fixed'
+SKETCH = 'sketch'
+
+WEIGHT_POWERS = {'count': 0, 'area': 2, 'volume': 3}
+
+
+class SlidingHistogram:
+    '''
+    Histogram of the last `window` seconds, kept in `buckets` time buckets
+    '''
+
+    def __init__(
+            self: 'SlidingHistogram',
+            window: float,
+            classes: int,
+            buckets: int = 60
+    ):
+        self.window = window
+        self.bucket_width = window / buckets
+        self._buckets = np.zeros((buckets, classes), dtype=np.float64)
+        # which bucket period every slot currently holds
+        self._periods = np.full(buckets, -1, dtype=np.int64)
+        self.total = np.zeros(classes, dtype=np.float64)
+
+    def add(self: 'SlidingHistogram', counts: np.ndarray, timestamp: float):
+        period = int(timestamp // self.bucket_width)
+        slot = period % len(self._periods)
+        if self._periods[slot] > period:
+            # older than the window already
+            return
+        if self._periods[slot] != period:
+            self.total -= self._buckets[slot]
+            self._buckets[slot] = 0.0
+            self._periods[slot] = period
+        self._buckets[slot] += counts
+        self.total += counts
+
+    def expire(self: 'SlidingHistogram', now: float):
+        '''
+        Drop the buckets that are older than the window at `now`
+        '''
+        oldest = int(now // self.bucket_width) - len(self._periods) + 1
+        expired = (self._periods >= 0) & (self._periods < oldest)
+        if expired.any():
+            self.total -= self._buckets[expired].sum(axis=0)
+            self._buckets[expired] = 0.0
+            self._periods[expired] = -1
+            # float drift from add/subtract must not leave negative counts
+            np.maximum(self.total, 0.0, out=self.total)
+
+
+class SizeDistribution:
+    '''
+    Grain-size distribution over several sliding windows
+    '''
+
+    def __init__(
+            self: 'SizeDistribution',
+            windows: Sequence[float] = (10.0, 60.0, 3600.0),
+            mode: str = FIXED,
+            bin_edges: Optional[Sequence[float]] = None,
+            relative_accuracy: float = 0.01,
+            min_size: float = 0.1,
+            max_size: float = 1e4,
+            weight: str = 'count',
+            buckets: int = 60
+    ):
+        if mode == FIXED:
+            if bin_edges is None:
+                # imported here to keep this module usable on its own
+                from granulometry import DEFAULT_BIN_EDGES
+                bin_edges = DEFAULT_BIN_EDGES
+            self.edges = np.asarray(bin_edges, dtype=np.float64)
+        elif mode == SKETCH:
+            self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+            first = math.floor(math.log(min_size, self.gamma))
+            last = math.ceil(math.log(max_size, self.gamma))
+            self.edges = self.gamma ** np.arange(first, last + 1, dtype=np.float64)
+        else:
+            raise ValueError(f'Unknown mode {mode}, expected {FIXED} or {SKETCH}')
+        if weight not in WEIGHT_POWERS:
+            raise ValueError(f'Unknown weight {weight}, expected one of '
+                             f'{sorted(WEIGHT_POWERS)}')
+        self.mode = mode
+        self.weight = weight
+        # underflow + classes between the edges + overflow
+        self.classes = len(self.edges) + 1
+        self.windows: Dict[float, SlidingHistogram] = {
+            window: SlidingHistogram(window, self.classes, buckets)
+            for window in windows}
+        self.particles = 0
+        self.last_timestamp = 0.0
+
+    def add(
+            self: 'SizeDistribution',
+            sizes: np.ndarray,
+            timestamp: Optional[float] = None
+    ):
+        '''
+        Add the particle sizes of one frame
+        '''
+        sizes = np.asarray(sizes, dtype=np.float64)
+        weights = None
+        if WEIGHT_POWERS[self.weight]:
+            weights = sizes ** WEIGHT_POWERS[self.weight]
+        counts = np.bincount(np.searchsorted(self.edges, sizes, side='right'),
+                             weights=weights, minlength=self.classes)
+        self.add_counts(counts, timestamp)
+        self.particles += len(sizes)
+
+    def add_counts(
+            self: 'SizeDistribution',
+            counts: np.ndarray,
+            timestamp: Optional[float] = None
+    ):
+        '''
+        Add an already binned histogram (self.classes entries)
+        '''
+        timestamp = time.time() if timestamp is None else timestamp
+        self.last_timestamp = max(self.last_timestamp, timestamp)
+        for histogram in self.windows.values():
+            histogram.add(counts, timestamp)
+
+    def histogram(
+            self: 'SizeDistribution',
+            window: float,
+            now: Optional[float] = None
+    ) -> np.ndarray:
+        '''
+        Class totals of the window, under- and overflow at both ends
+        '''
+        histogram = self.windows[window]
+        histogram.expire(self.last_timestamp if now is None else now)
+        return histogram.total
+
+    def quantiles(
+            self: 'SizeDistribution',
+            window: float,
+            percents: Sequence[float] = (10, 50, 90),
+            now: Optional[float] = None
+    ) -> Dict[str, float]:
+        '''
+        D10/D50/D90 (or other percents) of the window, nan while it is empty
+        '''
+        counts = self.histogram(window, now)
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        result = {}
+        for percent in percents:
+            key = f'D{percent:g}'
+            if total <= 0:
+                result[key] = float('nan')
+                continue
+            target = percent / 100.0 * total
+            i = min(int(np.searchsorted(cumulative, target)), len(counts) - 1)
+            if i == 0:
+                result[key] = float(self.edges[0])
+            elif i == len(counts) - 1:
+                result[key] = float(self.edges[-1])
+            elif self.mode == SKETCH:
+                # the value that is within the relative accuracy of the
+                # whole class
+                result[key] = float(2.0 * self.edges[i] / (self.gamma + 1.0))
+            else:
+                below = cumulative[i - 1]
+                fraction = (target - below) / counts[i] if counts[i] > 0 else 0.0
+                low, high = self.edges[i - 1], self.edges[i]
+                result[key] = float(low + fraction * (high - low))
+        return result
+
+    def snapshot(
+            self: 'SizeDistribution',
+            now: Optional[float] = None
+    ) -> dict:
+        '''
+        All windows as a JSON-serializable dict for the dashboard
+        '''
+        now = self.last_timestamp if now is None else now
+        windows = {}
+        for window in self.windows:
+            counts = self.histogram(window, now)
+            windows[f'{window:g}s'] = {
+                'total': float(counts.sum()),
+                **self.quantiles(window, now=now),
+                'histogram': counts.tolist(),
+            }
+        return {
+            'timestamp': now,
+            'mode': self.mode,
+            'weight': self.weight,
+            'edges': self.edges.tolist(),
+            'particles': self.particles,
+            'windows': windows,
+        }
+
+    def write_json(
+            self: 'SizeDistribution',
+            path: str,
+            now: Optional[float] = None
+    ):
+        '''
+        Replace path with the current snapshot, readers never see a partial
+            file
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump(self.snapshot(now), snapshot_file)
+        os.replace(tmp_path, path)
@@ -0,0 +1,25 @@
+import time
+
+from exposure_control import ExposureController
+
+
+class Node:
+    def __init__(self, value, minimum, maximum):
+        self.value = value
+        self.min = minimum
+        self.max = maximum
+
+
+def test_convergence_time_starts_at_first_update():
+    controller = ExposureController(min_write_interval=0.0, verbose=False)
+    nodes = {'ExposureTime': Node(2000.0, 100.0, 100000.0)}
+    # the camera is opened and the processes started before the first frame
+    time.sleep(0.5)
+    for _ in range(50):
+        # brightness proportional to the exposure time
+        controller.update(nodes['ExposureTime'].value / 100.0, nodes)
+        if controller.converged:
+            break
+    assert controller.converged
+    assert controller.convergence_frames < 10
+    assert controller.convergence_time < 0.1
@@ -0,0 +1,364 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+from frame_archive import FrameArchiveWriter
+
+'''
+Frame writers: Introduction
+    cv2.imwrite(...png) with default settings is one of the slowest steps of
+    the pipeline at full resolution. The writers below share one interface
+
+        writer = create_writer('png', 'images', compression=1)
+        writer.write(frame, name)       # name without extension
+        writer.write(frame, name, frame_id=..., timestamp=..., exposure=...)
+        writer.close()
+
+    (metadata is ignored by the formats that cannot store it), so the saver
+    can use the cheapest format that still serves the analysis:
+
+        npy     - one raw .npy per frame, no encoding at all
+        memmap  - frames appended into preallocated .npy files of `capacity`
+                  frames, rotated when full
+        chunk   - `frames_per_chunk` frames per uncompressed .npz file
+        png     - lossless, compression 0..9 (0 is fastest, largest)
+        jpeg    - lossy, quality 0..100
+        tiff    - lossless, uncompressed or LZW
+        bmp     - lossless, uncompressed
+        archive - fixed-size records appended to large rotating files with a
+                  sidecar index, see frame_archive.py
+
+    python writers.py prints the throughput of every backend on this
+    machine.
+'''
+
+
+class FrameWriter:
+    '''
+    Base class: subclasses implement write() and may override close()
+    '''
+
+    extension = ''
+
+    def __init__(self: 'FrameWriter', directory: str = 'images'):
+        self.directory = directory
+        self.frames_written = 0
+        self.bytes_written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self: 'FrameWriter', name: str) -> str:
+        return os.path.join(self.directory, f'{name}{self.extension}')
+
+    def write(
+            self: 'FrameWriter',
+            frame: np.ndarray,
+            name: str,
+            **metadata
+    ) -> str:
+        raise NotImplementedError
+
+    def close(self: 'FrameWriter'):
+        pass
+
+
+class ImageWriter(FrameWriter):
+    '''
+    Single image file per frame through cv2.imwrite
+    '''
+
+    def __init__(self: 'ImageWriter', directory: str = 'images', params=None):
+        super().__init__(directory)
+        self.params = [] if params is None else list(params)
+
+    def write(
+            self: 'ImageWriter',
+            frame: np.ndarray,
+            name: str,
+            **metadata
+    ) -> str:
+        path = self.path(name)
+        if not cv2.imwrite(path, frame, self.params):
+            raise IOError(f'Could not write {path}')
+        self.frames_written += 1
+        self.bytes_written += os.path.getsize(path)
+        return path
+
+
+class PngWriter(ImageWriter):
+    extension = '.png'
+
+    def __init__(
+            self: 'PngWriter',
+            directory: str = 'images',
+            compression: Optional[int] = None
+    ):
+        params = None if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        super().__init__(directory, params)
+
+
+class JpegWriter(ImageWriter):
+    extension = '.jpg'
+
+    def __init__(
+            self: 'JpegWriter',
+            directory: str = 'images',
+            quality: int = 95
+    ):
+        super().__init__(directory, [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+
+class TiffWriter(ImageWriter):
+    extension = '.tiff'
+
+    # libtiff compression codes
+    COMPRESSION_NONE = 1
+    COMPRESSION_LZW = 5
+
+    def __init__(
+            self: 'TiffWriter',
+            directory: str = 'images',
+            compression: int = COMPRESSION_NONE
+    ):
+        super().__init__(directory, [cv2.IMWRITE_TIFF_COMPRESSION, compression])
+
+
+class BmpWriter(ImageWriter):
+    extension = '.bmp'
+
+
+class NpyWriter(FrameWriter):
+    '''
+    Raw dump, one .npy per frame
+    '''
+
+    extension = '.npy'
+
+    def write(
+            self: 'NpyWriter',
+            frame: np.ndarray,
+            name: str,
+            **metadata
+    ) -> str:
+        path = self.path(name)
+        np.save(path, frame)
+        self.frames_written += 1
+        self.bytes_written += frame.nbytes
+        return path
+
+
+class MemmapWriter(FrameWriter):
+    '''
+    Frames appended into preallocated .npy files of capacity frames. The
+        file is named after its first frame and rotated when full.
+    '''
+
+    extension = '.npy'
+
+    def __init__(
+            self: 'MemmapWriter',
+            directory: str = 'images',
+            capacity: int = 256
+    ):
+        super().__init__(directory)
+        self.capacity = capacity
+        self._memmap: Optional[np.memmap] = None
+        self._path = ''
+        self._count = 0
+
+    def write(
+            self: 'MemmapWriter',
+            frame: np.ndarray,
+            name: str,
+            **metadata
+    ) -> str:
+        if self._memmap is None:
+            self._path = self.path(name)
+            self._memmap = np.lib.format.open_memmap(
+                self._path, mode='w+', dtype=frame.dtype,
+                shape=(self.capacity,) + frame.shape)
+            self._count = 0
+        self._memmap[self._count] = frame
+        self._count += 1
+        self.frames_written += 1
+        self.bytes_written += frame.nbytes
+        path = self._path
+        if self._count == self.capacity:
+            self._finish()
+        return path
+
+    def _finish(self: 'MemmapWriter'):
+        memmap, self._memmap = self._memmap, None
+        if self._count < self.capacity:
+            # shrink the last file to the frames actually written
+            tmp_path = self._path + '.tmp.npy'
+            np.save(tmp_path, memmap[:self._count])
+            del memmap
+            os.replace(tmp_path, self._path)
+        else:
+            memmap.flush()
+            del memmap
+
+    def close(self: 'MemmapWriter'):
+        if self._memmap is not None:
+            self._finish()
+
+
+class ChunkWriter(FrameWriter):
+    '''
+    frames_per_chunk frames per uncompressed .npz, names are kept as the
+        array keys
+    '''
+
+    extension = '.npz'
+
+    def __init__(
+            self: 'ChunkWriter',
+            directory: str = 'images',
+            frames_per_chunk: int = 64
+    ):
+        super().__init__(directory)
+        self.frames_per_chunk = frames_per_chunk
+        self._chunk: Dict[str, np.ndarray] = {}
+        self._first = ''
+
+    def write(
+            self: 'ChunkWriter',
+            frame: np.ndarray,
+            name: str,
+            **metadata
+    ) -> str:
+        if not self._chunk:
+            self._first = name
+        # the caller may reuse the array (e.g. a ring slot)
+        self._chunk[name] = frame.copy()
+        self.frames_written += 1
+        self.bytes_written += frame.nbytes
+        path = self.path(self._first)
+        if len(self._chunk) == self.frames_per_chunk:
+            self._flush()
+        return path
+
+    def _flush(self: 'ChunkWriter'):
+        np.savez(self.path(self._first), **self._chunk)
+        self._chunk = {}
+
+    def close(self: 'ChunkWriter'):
+        if self._chunk:
+            self._flush()
+
+
+class ArchiveWriter(FrameWriter):
+    '''
+    FrameWriter backend for writers.create_writer('archive', ...)
+    '''
+
+    extension = '.frames'
+
+    def __init__(
+            self: 'ArchiveWriter',
+            directory: str = 'images',
+            max_bytes: int = 4 * 1024 ** 3,
+            max_seconds: float = 3600.0,
+            buffer_size: int = 16 * 1024 ** 2
+    ):
+        super().__init__(directory)
+        self._archive = FrameArchiveWriter(
+            directory, max_bytes, max_seconds, buffer_size)
+
+    def write(
+            self: 'ArchiveWriter',
+            frame: np.ndarray,
+            name: str,
+            **metadata
+    ) -> str:
+        path = self._archive.append(frame, name, **metadata)
+        self.frames_written += 1
+        self.bytes_written += frame.nbytes
+        return path
+
+    def close(self: 'ArchiveWriter'):
+        self._archive.close()
+
+
+WRITERS = {
+    'npy': NpyWriter,
+    'memmap': MemmapWriter,
+    'chunk': ChunkWriter,
+    'png': PngWriter,
+    'jpeg': JpegWriter,
+    'tiff': TiffWriter,
+    'bmp': BmpWriter,
+    'archive': ArchiveWriter,
+}
+
+
+def create_writer(kind: str, directory: str = 'images', **options) -> FrameWriter:
+    try:
+        writer_class = WRITERS[kind]
+    except KeyError:
+        raise ValueError(f'Unknown writer {kind}, expected one of '
+                         f'{sorted(WRITERS)}') from None
+    return writer_class(directory, **options)
+
+
+def measure_throughput(
+        frame: np.ndarray,
+        count: int = 20,
+        backends: Optional[Dict[str, dict]] = None
+) -> Dict[str, Dict[str, float]]:
+    '''
+    Write count copies of frame with every backend into a temporary
+        directory and return frames/s, MB/s of raw frame data and bytes on
+        disk per frame for each
+    '''
+    if backends is None:
+        backends = {
+            'npy': {},
+            'memmap': {'capacity': count},
+            'chunk': {'frames_per_chunk': 16},
+            'png': {},
+            'png-0': {'compression': 0},
+            'png-9': {'compression': 9},
+            'jpeg-95': {'quality': 95},
+            'jpeg-80': {'quality': 80},
+            'tiff': {},
+            'tiff-lzw': {'compression': TiffWriter.COMPRESSION_LZW},
+            'bmp': {},
+            'archive': {},
+        }
+    results = {}
+    for label, options in backends.items():
+        directory = tempfile.mkdtemp(prefix='writer_')
+        try:
+            writer = create_writer(label.split('-')[0], directory, **options)
+            start = time.perf_counter()
+            for i in range(count):
+                writer.write(frame, f'{i:06d}')
+            writer.close()
+            elapsed = time.perf_counter() - start
+            on_disk = sum(entry.stat().st_size for entry in os.scandir(directory))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        results[label] = {
+            'fps': count / elapsed,
+            'mb_per_s': frame.nbytes * count / elapsed / 1e6,
+            'bytes_per_frame': on_disk / count,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    # grayscale frame of the full sensor size with some structure in it,
+    # random noise would make every codec look equally bad
+    height, width = 1464, 1936
+    ys, xs = np.mgrid[0:height, 0:width]
+    test_frame = ((np.sin(xs / 37.0) * np.cos(ys / 23.0) + 1) * 100).astype(np.uint8)
+    print(f'{"backend":<10} {"frames/s":>10} {"MB/s":>10} {"KB/frame":>10}')
+    for backend, result in measure_throughput(test_frame).items():
+        print(f'{backend:<10} {result["fps"]:>10.1f} {result["mb_per_s"]:>10.1f} '
+              f'{result["bytes_per_frame"] / 1024:>10.1f}')